@@ -0,0 +1,12 @@
+# __init__.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Benchmarks of gfbi_core, on synthetic repositories built by
+    benchmarks.synthetic. Run them with:
+
+        python -m benchmarks.run --commits 10000 --output results.json
+"""
@@ -0,0 +1,82 @@
+# imports.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Measures the time needed to import gfbi_core and its modules in a new
+    interpreter, and checks that the backends aren't imported:
+
+        python -m benchmarks.imports --runs 20 --output imports.json
+"""
+
+from optparse import OptionParser
+from subprocess import Popen, PIPE
+import json
+import sys
+import time
+
+from gfbi_core.metrics import percentile
+from benchmarks.run import environment, RESULTS_VERSION
+
+MODULES = ("gfbi_core", "gfbi_core.util", "gfbi_core.validation",
+           "gfbi_core.git_model", "gfbi_core.editable_git_model")
+# Modules that importing gfbi_core shouldn't import.
+BACKENDS = ("git", "pygit2")
+
+SCRIPT = """
+import sys, time
+start = time.time()
+import %s
+duration = time.time() - start
+print duration, " ".join(name for name in %r if name in sys.modules)
+"""
+
+
+def import_time(module):
+    """
+        Imports the module in a new interpreter and returns the duration of
+        the import, and the backends that were imported.
+    """
+    process = Popen([sys.executable, "-c", SCRIPT % (module, BACKENDS)],
+                    stdout=PIPE)
+    output = process.communicate()[0].split()
+    if process.returncode != 0:
+        raise RuntimeError("Couldn't import %s" % module)
+    return float(output[0]), output[1:]
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.imports [options]")
+    parser.add_option("--runs", type="int", default=10)
+    parser.add_option("--output", help="the JSON file of the results")
+    options, arguments = parser.parse_args(argv)
+
+    results = {}
+    for module in MODULES:
+        durations = []
+        backends = set()
+        for run in xrange(options.runs):
+            duration, imported = import_time(module)
+            durations.append(duration)
+            backends.update(imported)
+        durations.sort()
+        results[module] = {"median": percentile(durations, 50),
+                           "min": durations[0],
+                           "max": durations[-1],
+                           "backends": sorted(backends)}
+        sys.stdout.write("%-30s %7.2f ms %s\n" %
+                         (module, results[module]["median"] * 1000,
+                          " ".join(sorted(backends))))
+
+    if options.output:
+        report = dict(version=RESULTS_VERSION, date=int(time.time()),
+                      environment=environment(),
+                      parameters=dict(runs=options.runs), results=results)
+        with open(options.output, "w") as handle:
+            json.dump(report, handle, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# memory.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Measures the memory footprint of populated models against the size of
+    the history, and plots the number of bytes per commit:
+
+        python -m benchmarks.memory --sizes 1000,10000,100000 --output mem.json
+"""
+
+from optparse import OptionParser
+from tempfile import mkdtemp
+import json
+import os
+import shutil
+import sys
+import time
+
+from gfbi_core.editable_git_model import EditableGitModel
+from gfbi_core.util import Index
+from benchmarks.run import environment, RESULTS_VERSION
+from benchmarks.synthetic import generate_repository
+
+PLOT_WIDTH = 50
+
+
+def measure(directory, sweep=True):
+    """
+        Populates a model of the repository and returns its memory footprint.
+
+        :param sweep:
+            If True, every field is read first, to load the lazy attributes
+            of the commits as a user interface would.
+    """
+    model = EditableGitModel(directory)
+    model.populate()
+    if sweep:
+        columns = range(len(model.get_columns()))
+        for row in xrange(model.row_count()):
+            for column in columns:
+                model.data(Index(row, column))
+
+    report = model.memory_footprint()
+    report["commit_count"] = model.row_count()
+    report["bytes_per_commit"] = report["total"] / max(model.row_count(), 1)
+    return report
+
+
+def plot(reports, output=sys.stdout):
+    """
+        Writes a text plot of the bytes per commit by history size.
+    """
+    largest = max(report["bytes_per_commit"] for report in reports) or 1
+    for report in reports:
+        bar = "#" * int(PLOT_WIDTH * report["bytes_per_commit"] / largest)
+        output.write("%10d commits %8d B/commit %s\n" %
+                     (report["commit_count"], report["bytes_per_commit"], bar))
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.memory [options]")
+    parser.add_option("--sizes", default="1000,5000,20000",
+                      help="comma separated numbers of commits")
+    parser.add_option("--files", type="int", default=10)
+    parser.add_option("--width", type="int", default=1)
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--no-sweep", action="store_false", dest="sweep",
+                      default=True, help="don't read the fields first")
+    parser.add_option("--output", help="the JSON file of the results")
+    options, arguments = parser.parse_args(argv)
+
+    parent = mkdtemp(prefix="gfbi_benchmark_")
+    reports = []
+    try:
+        for size in [int(size) for size in options.sizes.split(",")]:
+            directory = os.path.join(parent, str(size))
+            generate_repository(directory, commits=size, files=options.files,
+                                width=options.width, seed=options.seed)
+            reports.append(measure(directory, options.sweep))
+            shutil.rmtree(directory)
+    finally:
+        shutil.rmtree(parent)
+
+    plot(reports)
+
+    if options.output:
+        result = dict(version=RESULTS_VERSION, date=int(time.time()),
+                      environment=environment(),
+                      parameters=dict(files=options.files,
+                                      width=options.width,
+                                      seed=options.seed,
+                                      sweep=options.sweep),
+                      results=reports)
+        with open(options.output, "w") as handle:
+            json.dump(result, handle, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
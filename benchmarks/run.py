@@ -0,0 +1,199 @@
+# run.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Times the main operations of the models on a synthetic repository and
+    writes the results as JSON, so that runs can be compared over time:
+
+        python -m benchmarks.run --commits 100000 --width 4 --output out.json
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+from optparse import OptionParser
+from tempfile import mkdtemp
+import json
+import os
+import platform
+import shutil
+import sys
+import time
+
+from gfbi_core import __version__
+from gfbi_core.editable_git_model import EditableGitModel
+from gfbi_core.util import Index, ConflictSnapshot, run_command
+from benchmarks.synthetic import generate_repository, CONFLICT_BRANCHES
+
+# The format of the results, to be increased when they can't be compared
+# with the previous ones.
+RESULTS_VERSION = 1
+
+
+class Benchmark:
+    """
+        Runs the benchmarks on a repository and collects their durations.
+    """
+
+    def __init__(self, repository, write_depth=100, write=True):
+        """
+            Initialization of the Benchmark.
+
+            :param repository:
+                The SyntheticRepository.
+            :param write_depth:
+                The row of the commit that is modified before the write, the
+                write rewrites this commit and the ones above it.
+            :param write:
+                If False, the write isn't timed.
+        """
+        self.repository = repository
+        self.write_depth = write_depth
+        self.write = write
+        self.results = {}
+
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        yield
+        self.results[name] = time.time() - start
+
+    def run(self):
+        """
+            Runs the benchmarks and returns the results.
+        """
+        directory = self.repository.directory
+        model = EditableGitModel(directory)
+        with self.timed("populate"):
+            model.populate()
+
+        columns = range(len(model.get_columns()))
+        with self.timed("data_sweep"):
+            for row in xrange(model.row_count()):
+                for column in columns:
+                    model.data(Index(row, column))
+
+        row = min(self.write_depth, model.row_count() - 1)
+        model.start_history_event()
+        model.set_data(Index(row, model.get_column("message")),
+                       "Benchmarked commit\n")
+
+        with self.timed("get_start_write_from"):
+            model.get_start_write_from()
+
+        with self.timed("get_to_rewrite_count"):
+            model.get_to_rewrite_count()
+
+        if self.write:
+            with self.timed("write"):
+                model.write(log=False).result()
+
+        with self.timed("reorder_commits"):
+            model.reorder_commits((datetime(2012, 1, 1),
+                                   datetime(2012, 12, 31)),
+                                  ((datetime.min.time(),
+                                    datetime.max.time()),),
+                                  (0, 1, 2, 3, 4))
+
+        if self.repository.conflicts:
+            self.run_conflict_snapshot()
+
+        return self.results
+
+    def run_conflict_snapshot(self):
+        """
+            Merges the conflicting branches and times the reading of the
+            unmerged state.
+        """
+        directory = self.repository.directory
+        ours, theirs = CONFLICT_BRANCHES
+        output, errors = run_command(["git", "symbolic-ref", "HEAD"],
+                                     directory)
+        head = output[0]
+
+        run_command(["git", "checkout", "-q", ours], directory)
+        run_command(["git", "merge", "-q", theirs], directory)
+        try:
+            with self.timed("conflict_snapshot"):
+                snapshot = ConflictSnapshot(ours, theirs, directory)
+                for u_file in snapshot.files.values():
+                    u_file["diff"]
+        finally:
+            run_command(["git", "merge", "--abort"], directory)
+            run_command(["git", "checkout", "-q", head[len("refs/heads/"):]],
+                        directory)
+
+
+def environment():
+    """
+        Returns the versions that the results depend on.
+    """
+    output, errors = run_command(["git", "--version"])
+    return dict(gfbi_core=__version__, git=output[0],
+                python=sys.version.split()[0], platform=platform.platform())
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m benchmarks.run [options]")
+    parser.add_option("--commits", type="int", default=10000)
+    parser.add_option("--files", type="int", default=10)
+    parser.add_option("--width", type="int", default=1,
+                      help="number of parallel lines of development merged "
+                           "together")
+    parser.add_option("--branches", type="int", default=0)
+    parser.add_option("--tags", type="int", default=0)
+    parser.add_option("--conflicts", type="int", default=10,
+                      help="number of conflicting files in the conflict "
+                           "snapshot benchmark, 0 to skip it")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--write-depth", type="int", default=100)
+    parser.add_option("--no-write", action="store_false", dest="write",
+                      default=True)
+    parser.add_option("--directory",
+                      help="where the repository is generated, it is kept "
+                           "(a temporary directory is used by default)")
+    parser.add_option("--output", help="the JSON file of the results "
+                                       "(the standard output by default)")
+    options, arguments = parser.parse_args(argv)
+
+    if options.directory:
+        directory, parent = options.directory, None
+    else:
+        parent = mkdtemp(prefix="gfbi_benchmark_")
+        directory = os.path.join(parent, "repository")
+
+    try:
+        start = time.time()
+        repository = generate_repository(directory, commits=options.commits,
+                                         files=options.files,
+                                         width=options.width,
+                                         branches=options.branches,
+                                         tags=options.tags,
+                                         conflicts=options.conflicts,
+                                         seed=options.seed)
+        generation = time.time() - start
+
+        benchmark = Benchmark(repository, write_depth=options.write_depth,
+                              write=options.write)
+        results = benchmark.run()
+    finally:
+        if parent is not None:
+            shutil.rmtree(parent)
+
+    report = dict(version=RESULTS_VERSION, date=int(time.time()),
+                  environment=environment(),
+                  parameters=repository.parameters(),
+                  generation=generation, results=results)
+
+    if options.output:
+        with open(options.output, "w") as handle:
+            json.dump(report, handle, indent=4, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=4, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# synthetic.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from subprocess import Popen, PIPE
+from random import Random
+import os
+
+from gfbi_core.util import GfbiException, run_command
+
+# The date of the first commit, the next ones are a minute apart.
+START_DATE = 1331467200
+TIMEZONE = "+0100"
+LINES_PER_FILE = 20
+MAIN_BRANCH = "refs/heads/master"
+CONFLICT_BRANCHES = ("refs/heads/conflict_ours", "refs/heads/conflict_theirs")
+
+
+class SyntheticRepository:
+    """
+        Writes a deterministic repository through a single git fast-import
+        stream: the same parameters always give the same hexshas.
+
+        Every commit changes one line of one file. With a width greater than
+        1, the history is made of rounds of width commits on parallel lines
+        of development, starting from the same commit and merged together by
+        the next commit.
+    """
+
+    def __init__(self, directory, commits=10000, files=10, width=1,
+                 branches=0, tags=0, conflicts=0, seed=0):
+        """
+            Initialization of the SyntheticRepository.
+
+            :param directory:
+                The directory of the repository, which is created.
+            :param commits:
+                The number of commits of the main branch, merges included.
+            :param files:
+                The number of files of the tree.
+            :param width:
+                The number of parallel lines of development merged together.
+            :param branches:
+                The number of branches pointing at regularly spaced commits.
+            :param tags:
+                The number of annotated tags pointing at regularly spaced
+                commits.
+            :param conflicts:
+                If set, two branches (see CONFLICT_BRANCHES) are created from
+                the top commit, changing the same line of this number of files
+                differently.
+            :param seed:
+                The seed of the random choices.
+        """
+        if files < 1 or width < 1 or commits < 1:
+            raise GfbiException("A repository needs commits, files and a "
+                                "width of at least 1.")
+        self.directory = directory
+        self.commits = commits
+        self.files = files
+        self.width = width
+        self.branches = branches
+        self.tags = tags
+        self.conflicts = min(conflicts, files)
+        self.seed = seed
+
+        self._random = Random(seed)
+        self._contents = [["file %d line %d\n" % (number, line)
+                           for line in xrange(LINES_PER_FILE)]
+                          for number in xrange(files)]
+        self._date = START_DATE
+
+    def parameters(self):
+        """
+            Returns the parameters of the repository, as a dictionnary.
+        """
+        return dict(commits=self.commits, files=self.files, width=self.width,
+                    branches=self.branches, tags=self.tags,
+                    conflicts=self.conflicts, seed=self.seed)
+
+    def generate(self):
+        """
+            Creates the repository and checks out the main branch.
+        """
+        if os.path.exists(self.directory):
+            raise GfbiException("%s already exists." % self.directory)
+        os.makedirs(self.directory)
+        run_command(["git", "init", "-q"], self.directory)
+
+        process = Popen(["git", "fast-import", "--quiet"], cwd=self.directory,
+                        stdin=PIPE)
+        try:
+            self._write_stream(process.stdin)
+        finally:
+            process.stdin.close()
+        if process.wait() != 0:
+            raise GfbiException("git fast-import failed.")
+
+        run_command(["git", "symbolic-ref", "HEAD", MAIN_BRANCH],
+                    self.directory)
+        run_command(["git", "reset", "-q", "--hard"], self.directory)
+
+    def _write_stream(self, stream):
+        # The last commit of every parallel line of development, merged by
+        # the next merge commit.
+        heads = []
+        base = None
+        for number in xrange(self.commits):
+            last = number == self.commits - 1
+            if base is None:
+                parents = []
+            elif heads and (len(heads) == self.width or last):
+                parents, heads = heads, []
+            else:
+                parents = [base]
+
+            self._write_commit(stream, MAIN_BRANCH, number, parents)
+            if self.width == 1 or base is None or parents != [base]:
+                base = number + 1
+            else:
+                heads.append(number + 1)
+
+        top = self.commits
+        stream.write("reset %s\nfrom :%d\n\n" % (MAIN_BRANCH, top))
+
+        for number in xrange(self.branches):
+            mark = 1 + number * self.commits // self.branches
+            stream.write("reset refs/heads/branch_%d\nfrom :%d\n\n" %
+                         (number, mark))
+
+        for number in xrange(self.tags):
+            mark = 1 + number * self.commits // self.tags
+            message = "Tag %d\n" % number
+            stream.write("tag v%d\nfrom :%d\n"
+                         "tagger Tagger <tagger@example.com> %d %s\n"
+                         "data %d\n%s\n" % (number, mark, self._date,
+                                            TIMEZONE, len(message), message))
+
+        if self.conflicts:
+            mark = top
+            for side, branch in enumerate(CONFLICT_BRANCHES):
+                mark += 1
+                stream.write("commit %s\nmark :%d\n" % (branch, mark))
+                self._write_signatures(stream, "Conflict %s\n" % side)
+                stream.write("from :%d\n" % top)
+                for number in xrange(self.conflicts):
+                    content = "".join(self._contents[number][1:])
+                    self._write_file(stream, number,
+                                     "%s side\n%s" % (side, content))
+                stream.write("\n")
+
+    def _write_commit(self, stream, branch, number, parents):
+        """
+            Writes the commit of the given number (its mark is number + 1).
+        """
+        stream.write("commit %s\nmark :%d\n" % (branch, number + 1))
+        self._write_signatures(stream, "Commit %d\n" % number)
+        if parents:
+            stream.write("from :%d\n" % parents[0])
+        for parent in parents[1:]:
+            stream.write("merge :%d\n" % parent)
+
+        file_number = self._random.randrange(self.files)
+        line = self._random.randrange(LINES_PER_FILE)
+        self._contents[file_number][line] = "commit %d\n" % number
+        self._write_file(stream, file_number,
+                         "".join(self._contents[file_number]))
+        stream.write("\n")
+
+    def _write_signatures(self, stream, message):
+        self._date += 60
+        for role, name in (("author", "Author"), ("committer", "Committer")):
+            stream.write("%s %s <%s@example.com> %d %s\n" %
+                         (role, name, name.lower(), self._date, TIMEZONE))
+        stream.write("data %d\n%s" % (len(message), message))
+
+    def _write_file(self, stream, number, content):
+        stream.write("M 644 inline file_%d\ndata %d\n%s\n" %
+                     (number, len(content), content))
+
+
+def generate_repository(directory, **parameters):
+    """
+        Generates a synthetic repository and returns its SyntheticRepository.
+        See SyntheticRepository for the parameters.
+    """
+    repository = SyntheticRepository(directory, **parameters)
+    repository.generate()
+    return repository
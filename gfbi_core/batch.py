@@ -0,0 +1,213 @@
+# batch.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from multiprocessing import Pool
+import time
+import traceback
+
+from gfbi_core import TIME_FIELDS
+
+# The statuses of the rewrite of a repository.
+WRITTEN = "written"
+UNCHANGED = "unchanged"
+CONFLICT = "conflict"
+FAILED = "failed"
+DRY_RUN = "dry-run"
+STATUSES = (WRITTEN, UNCHANGED, CONFLICT, FAILED, DRY_RUN)
+
+DEFAULT_WRITE_OPTIONS = {"log": False, "force_committed_date": True}
+
+
+class Policy:
+    """
+        The modifications applied to every repository of a batch. The policy
+        is sent to the worker processes, so it must be picklable: subclasses
+        overriding apply() should be defined at the top level of a module.
+    """
+
+    def __init__(self, identities=None, time_shift=0):
+        """
+            Initialization of the Policy.
+
+            :param identities:
+                A dictionnary of the emails to replace, and of the (name,
+                email) tuples replacing them, for the authors and the
+                committers.
+            :param time_shift:
+                A number of seconds added to the authored and committed
+                dates.
+        """
+        self.identities = dict(identities or {})
+        self.time_shift = time_shift
+
+    def apply(self, model):
+        """
+            Modifies the populated EditableGitModel.
+        """
+        for commit in model.get_commits():
+            for role in ("author", "committer"):
+                email = model.c_data(commit, role + "_email")
+                if email in self.identities:
+                    new_name, new_email = self.identities[email]
+                    if model.c_data(commit, role + "_name") != new_name:
+                        model.set_field_data(commit, role + "_name", new_name)
+                    if email != new_email:
+                        model.set_field_data(commit, role + "_email",
+                                             new_email)
+
+            if self.time_shift:
+                for field in TIME_FIELDS:
+                    timestamp, tz = model.c_data(commit, field)
+                    model.set_field_data(commit, field,
+                                         (timestamp + self.time_shift, tz))
+
+
+def rewrite_repository(directory, policy, write_options=None, dry_run=False):
+    """
+        Populates a model of the current branch of the repository, applies
+        the policy and writes the model. Returns a dictionnary describing the
+        rewrite: the directory, the status (see STATUSES), the number of
+        modified commits, the number of commits to rewrite, the error if any,
+        and the durations of the populate, edit and write steps.
+
+        This is run by the worker processes of BatchRunner, and can be used
+        on its own.
+    """
+    # Imported here, so that the workers only import the backends when they
+    # get their first repository.
+    from gfbi_core.editable_git_model import EditableGitModel
+
+    result = {"directory": directory, "status": None, "modified": 0,
+              "to_rewrite": 0, "error": None, "timings": {}}
+    timings = result["timings"]
+    step_start = start = time.time()
+    try:
+        model = EditableGitModel(directory)
+        model.populate()
+        timings["populate"] = time.time() - step_start
+
+        step_start = time.time()
+        policy.apply(model)
+        result["modified"] = model.get_modified_count()
+        timings["edit"] = time.time() - step_start
+
+        if not result["modified"]:
+            result["status"] = UNCHANGED
+        else:
+            result["to_rewrite"] = model.get_to_rewrite_count()
+            if dry_run:
+                result["status"] = DRY_RUN
+            else:
+                step_start = time.time()
+                options = dict(DEFAULT_WRITE_OPTIONS)
+                options.update(write_options or {})
+                if model.write(**options).result():
+                    result["status"] = WRITTEN
+                else:
+                    result["status"] = CONFLICT
+                timings["write"] = time.time() - step_start
+    except Exception:
+        result["status"] = FAILED
+        result["error"] = traceback.format_exc()
+
+    timings["total"] = time.time() - start
+    return result
+
+
+def _rewrite_task(arguments):
+    return rewrite_repository(*arguments)
+
+
+class BatchRunner:
+    """
+        Applies the same policy to several repositories, in a bounded pool of
+        processes. Each repository is rewritten by rewrite_repository() in a
+        worker process, and the results are yielded as soon as they are
+        available.
+    """
+
+    def __init__(self, directories, policy, processes=4, write_options=None,
+                 dry_run=False, tasks_per_process=None):
+        """
+            Initialization of the BatchRunner.
+
+            :param directories:
+                The directories of the repositories. Their current branch is
+                rewritten.
+            :param policy:
+                The Policy applied to every repository.
+            :param processes:
+                The maximum number of repositories rewritten at the same
+                time.
+            :param write_options:
+                The keyword arguments of EditableGitModel.write(), see
+                DEFAULT_WRITE_OPTIONS.
+            :param dry_run:
+                If True, the models are modified but not written.
+            :param tasks_per_process:
+                If set, the worker processes are replaced after this number
+                of repositories, to give their memory back.
+        """
+        self._directories = list(directories)
+        self._policy = policy
+        self._processes = processes
+        self._write_options = write_options
+        self._dry_run = dry_run
+        self._tasks_per_process = tasks_per_process
+
+    def iter_results(self):
+        """
+            Yields the result of every repository (see rewrite_repository),
+            in the order in which they are done.
+        """
+        tasks = [(directory, self._policy, self._write_options,
+                  self._dry_run)
+                 for directory in self._directories]
+        if not tasks:
+            return
+
+        pool = Pool(min(self._processes, len(tasks)),
+                    maxtasksperchild=self._tasks_per_process)
+        try:
+            for result in pool.imap_unordered(_rewrite_task, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run(self, progress=None):
+        """
+            Runs the batch and returns a dictionnary with the number of
+            repositories of each status, the elapsed time, the sum of the
+            durations of every step, and the results sorted by directory.
+
+            :param progress:
+                If set, called with the result, the number of repositories
+                done and the total number of repositories, every time a
+                repository is done.
+        """
+        start = time.time()
+        results = []
+        for result in self.iter_results():
+            results.append(result)
+            if progress is not None:
+                progress(result, len(results), len(self._directories))
+
+        summary = dict((status, 0) for status in STATUSES)
+        timings = {}
+        for result in results:
+            summary[result["status"]] += 1
+            for step, duration in result["timings"].items():
+                timings[step] = timings.get(step, 0.) + duration
+
+        summary.update({"total": len(results),
+                        "elapsed": time.time() - start,
+                        "timings": timings,
+                        "results": sorted(results,
+                                          key=lambda result:
+                                                result["directory"])})
+        return summary
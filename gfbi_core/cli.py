@@ -0,0 +1,176 @@
+# cli.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Command line entry point: loads the current branch of a repository,
+    applies an edit plan (see gfbi_core.plan) and writes the branch.
+
+        gfbi -C path/to/repository plan.json
+        gfbi --dry-run --format csv - < plan.csv
+"""
+
+from optparse import OptionParser
+import json
+import os
+import sys
+
+from gfbi_core.plan import FORMATS, read_plan, apply_plan, PlanError
+
+USAGE = "%prog [options] PLAN\n\n" \
+        "Applies the edit plan PLAN (a file, or - for the standard input) " \
+        "to the current branch of the repository."
+
+# The exit codes
+SUCCESS = 0
+# The repository couldn't be loaded or written
+FAILED = 1
+BAD_PLAN = 2
+
+
+def build_parser():
+    parser = OptionParser(usage=USAGE)
+    parser.add_option("-C", "--directory", default=".",
+                      help="the repository (the current directory by "
+                           "default)")
+    parser.add_option("--format", choices=FORMATS,
+                      help="json or csv (guessed from the extension of the "
+                           "plan, json by default)")
+    parser.add_option("-n", "--dry-run", action="store_true", default=False,
+                      help="apply the plan to the model without writing it")
+    parser.add_option("--fast-import", action="store_true", default=False,
+                      help="write the commits through git fast-import")
+    parser.add_option("--workers", type="int", default=1,
+                      help="number of parallel lines of development picked "
+                           "at the same time")
+    parser.add_option("--keep-committer", action="store_false",
+                      dest="force_committed_date", default=True,
+                      help="let git set the committer and the committed "
+                           "date of the rewritten commits")
+    parser.add_option("--progress", action="store_true", default=False,
+                      help="report the progress of the write on the error "
+                           "output")
+    return parser
+
+
+def plan_format(path, format=None):
+    """
+        Returns the format of the plan file.
+
+        >>> plan_format("plan.csv")
+        'csv'
+        >>> plan_format("-")
+        'json'
+    """
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension in FORMATS:
+        return extension
+    return "json"
+
+
+def write_summary(summary, stdout):
+    json.dump(summary, stdout, indent=4, sort_keys=True)
+    stdout.write("\n")
+
+
+def describe_error(error):
+    return "%s: %s" % (error.__class__.__name__, error)
+
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    """
+        Runs the command line and returns its exit code. A summary of the
+        plan and of the write is written as JSON on the standard output,
+        including when the repository or the plan can't be read, or the
+        repository can't be written: the status is then "error".
+    """
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    parser = build_parser()
+    options, arguments = parser.parse_args(argv)
+    if len(arguments) != 1:
+        parser.error("expected a single plan")
+    path = arguments[0]
+
+    # Imported here, so that --help doesn't import the backends.
+    from gfbi_core.editable_git_model import EditableGitModel
+
+    try:
+        model = EditableGitModel(options.directory)
+        model.populate()
+    except Exception, error:
+        # Missing or invalid repository, git errors...
+        write_summary({"status": "error", "error": describe_error(error)},
+                      stdout)
+        return FAILED
+
+    try:
+        stream = stdin if path == "-" else open(path, "rb")
+    except IOError, error:
+        stderr.write("%s: %s\n" % (path, error.strerror))
+        write_summary({"status": "error", "error": describe_error(error)},
+                      stdout)
+        return BAD_PLAN
+
+    try:
+        stats = apply_plan(model,
+                           read_plan(stream, plan_format(path,
+                                                         options.format)))
+    except PlanError, error:
+        stderr.write("%s: %s\n" % (path, error))
+        write_summary({"status": "error", "error": describe_error(error),
+                       "line": error.line_number}, stdout)
+        return BAD_PLAN
+    finally:
+        if stream is not stdin:
+            stream.close()
+
+    summary = {"operations": stats,
+               "modified": model.get_modified_count(),
+               "deleted": model.get_deleted_count(),
+               "branch": model.get_new_branch_name() or None}
+    if summary["modified"] or summary["deleted"]:
+        summary["to_rewrite"] = model.get_to_rewrite_count()
+
+    exit_code = SUCCESS
+    if options.dry_run:
+        summary["status"] = "dry-run"
+    elif not (summary["modified"] or summary["deleted"] or
+              model.is_name_modified()):
+        summary["status"] = "unchanged"
+    else:
+        try:
+            handle = model.write(
+                            log=False,
+                            force_committed_date=options.force_committed_date,
+                            fast_import=options.fast_import,
+                            workers=options.workers)
+            if options.progress:
+                for progress in handle.progress_updates():
+                    stderr.write("\r%3d%%" % (progress * 100))
+                stderr.write("\n")
+            if handle.result():
+                summary["status"] = "written"
+            else:
+                summary["status"] = "conflict"
+                summary["conflicting_commit"] = \
+                        model.get_conflicting_commit().hexsha
+                exit_code = FAILED
+        except Exception, error:
+            # Dirty working tree, repository changed since the populate...
+            summary["status"] = "error"
+            summary["error"] = describe_error(error)
+            exit_code = FAILED
+
+    write_summary(summary, stdout)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,337 @@
+# conflict_scan.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from threading import Thread
+from Queue import Queue
+from tempfile import mkdtemp
+import os
+import shutil
+
+from gfbi_core.util import DummyCommit, run_command, run_command_with_status, \
+                           read_blobs
+from gfbi_core.git_filter_rebase import schedule, ready_commits, \
+                                        release_children
+
+SPECIAL_MODES = ("120000", "160000")
+EMPTY_TREE = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+
+
+class ConflictScanner:
+    """
+        Simulates the rewrite of an EditableGitModel without touching the
+        working tree, and reports every commit that will conflict.
+
+        Each commit is merged onto the simulated tree of its new parent in a
+        temporary index (git read-tree -m), the files modified on both sides
+        being merged with git merge-file. The simulation doesn't detect
+        renames, as the cherry-pick does, so it is an approximation.
+
+        The solutions already given for a commit (see
+        EditableGitModel.set_conflict_solutions) are applied to its simulated
+        tree. After a conflict without solutions, the simulation goes on with
+        the original tree of the conflicting commit, as if the conflict was
+        solved that way.
+    """
+
+    def __init__(self, model, workers=1):
+        """
+            Initialization of the ConflictScanner.
+
+            :param model:
+                The EditableGitModel we want to write.
+            :param workers:
+                The number of commits merged at the same time. Independent
+                lines of development are scanned in parallel.
+        """
+        self._model = model
+        self._directory = model._directory
+        self._workers = max(workers, 1)
+        self._solutions = model.get_conflict_solutions()
+        self._trees = {}
+
+    def scan(self):
+        """
+            Returns a dictionnary of the conflicting commits, with for each
+            one the dictionnary of its unmerged paths and their git status
+            (see EditableGitModel.set_unmerged_files).
+        """
+        model = self._model
+
+        conflicts = {}
+        tasks = Queue()
+        results = Queue()
+        temp_dir = mkdtemp(prefix=".gitbuster_scan")
+        for worker in xrange(self._workers):
+            index_file = os.path.join(temp_dir, "index%d" % worker)
+            thread = Thread(target=self.merge_worker,
+                            args=(index_file, tasks, results))
+            thread.setDaemon(True)
+            thread.start()
+
+        waiting = schedule(model, model.get_start_write_from())
+        ready = ready_commits(model, waiting)
+        in_flight = 0
+        error = None
+        try:
+            while ready or in_flight:
+                while ready and error is None:
+                    commit = ready.popleft()
+                    if model.is_deleted(commit):
+                        release_children(model, commit, waiting, ready)
+                        continue
+                    tasks.put(self.prepare_task(commit))
+                    in_flight += 1
+
+                if not in_flight:
+                    break
+
+                commit, tree, unmerged = results.get()
+                in_flight -= 1
+                if isinstance(unmerged, Exception):
+                    error = unmerged
+                    continue
+
+                if unmerged:
+                    conflicts[commit] = unmerged
+                self._trees[commit] = tree
+                release_children(model, commit, waiting, ready)
+
+            if error is not None:
+                raise error
+        finally:
+            for worker in xrange(self._workers):
+                tasks.put(None)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return conflicts
+
+    def tree_of(self, commit):
+        """
+            Returns the simulated tree of a commit, or None if it is unknown.
+        """
+        if commit in self._trees:
+            return self._trees[commit]
+        if isinstance(commit, DummyCommit):
+            return None
+        return self._model.orig_c_data(commit, "tree").hexsha
+
+    def prepare_task(self, commit):
+        """
+            Returns what a worker needs to merge the given commit:
+            (commit, to_pick_hexsha, orig_tree, parent_tree, reusable,
+             solutions). reusable is True when the original tree is still
+            valid, parent_tree is then not needed.
+        """
+        model = self._model
+
+        to_pick_hexsha = model.c_data(commit, "hexsha")
+        parents = model.c_data(commit, "parents")
+        orig_tree = None
+        orig_parents = []
+        if not isinstance(commit, DummyCommit):
+            orig_tree = model.orig_c_data(commit, "tree").hexsha
+            orig_parents = model.orig_c_data(commit, "parents")
+
+        parent_tree = None
+        reusable = orig_tree is not None
+        if parents and (orig_parents or orig_tree is None):
+            parent_tree = self.tree_of(parents[0])
+            if parent_tree is None:
+                # The simulated tree of the parent is unknown, merge onto the
+                # tree it picks.
+                parent_tree = model.c_data(parents[0], "hexsha") + "^{tree}"
+            reusable = bool(orig_parents) and \
+                    parent_tree == orig_parents[0].tree.hexsha
+
+        return (commit, to_pick_hexsha, orig_tree, parent_tree, reusable,
+                self._solutions.get(commit))
+
+    def merge_worker(self, index_file, tasks, results):
+        """
+            Merges the commits given in the tasks queue, using its own index
+            file, until it gets None.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            (commit, to_pick_hexsha, orig_tree, parent_tree, reusable,
+             solutions) = task
+            try:
+                unmerged = {}
+                tree = orig_tree
+                if not reusable and parent_tree is not None:
+                    tree, unmerged = self.merge(index_file, to_pick_hexsha,
+                                                parent_tree, solutions)
+                    if unmerged:
+                        # Goes on as if the conflict was solved with the
+                        # original tree, unknown for inserted commits.
+                        tree = orig_tree
+                results.put((commit, tree, unmerged))
+            except Exception, err:
+                results.put((commit, None, err))
+
+    def git(self, index_file, arguments, input=None):
+        """
+            Runs a git command on the given index file, and returns its output
+            and exit code.
+        """
+        output, errors, status = run_command_with_status(
+                            ["git"] + arguments, self._directory,
+                            env={"GIT_INDEX_FILE": index_file}, input=input)
+        return output, status
+
+    def merge(self, index_file, to_pick_hexsha, parent_tree, solutions=None):
+        """
+            Merges the changes of the given commit onto the given tree, and
+            returns (tree, unmerged) where unmerged is a dictionnary of the
+            unmerged paths and their git status. The tree is None if there
+            are unmerged paths.
+
+            :param solutions:
+                The solutions of the conflicts of this commit (see
+                EditableGitModel.set_conflict_solutions), applied to the
+                unmerged paths they cover.
+        """
+        solutions = solutions or {}
+        base_tree = EMPTY_TREE
+        output, status = self.git(index_file, ["rev-parse", "-q", "--verify",
+                                               to_pick_hexsha + "^^{tree}"])
+        if status == 0:
+            base_tree = output[0].strip()
+        self.git(index_file, ["read-tree", "-m", "-i", "--aggressive",
+                              base_tree, parent_tree, to_pick_hexsha + "^{tree}"])
+
+        output, status = self.git(index_file, ["ls-files", "-u", "-z"])
+        stages = {}
+        for entry in "\n".join(output).split("\0"):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, hexsha, stage = info.split(" ")
+            stages.setdefault(path, {})[int(stage)] = (mode, hexsha)
+
+        unmerged = {}
+        index_info = ""
+        for path, entries in stages.items():
+            result = self.merge_entries(entries)
+            if isinstance(result, str):
+                if path not in solutions:
+                    unmerged[path] = result
+                    continue
+                result = self.solve_entries(entries, solutions[path])
+                if result is None:
+                    index_info += "0 %s\t%s\0" % ("0" * 40, path)
+                    continue
+            mode, hexsha = result
+            # Replace the unmerged stages by the merged entry
+            index_info += "0 %s\t%s\0" % ("0" * 40, path)
+            index_info += "%s %s\t%s\0" % (mode, hexsha, path)
+
+        if index_info:
+            self.git(index_file, ["update-index", "-z", "--index-info"],
+                     input=index_info)
+
+        if unmerged:
+            return None, unmerged
+
+        output, status = self.git(index_file, ["write-tree"])
+        return output[0].strip(), unmerged
+
+    def merge_entries(self, entries):
+        """
+            Merges the stages of an unmerged path. Returns the merged
+            (mode, hexsha), or the git status of the conflict.
+        """
+        base = entries.get(1)
+        ours = entries.get(2)
+        theirs = entries.get(3)
+
+        if ours is None and theirs is None:
+            return "DD"
+        if ours is None:
+            return "DU" if base else "UA"
+        if theirs is None:
+            return "UD" if base else "AU"
+
+        status = "UU" if base else "AA"
+        if base is not None and ours[0] == base[0]:
+            mode = theirs[0]
+        elif base is not None and theirs[0] == base[0]:
+            mode = ours[0]
+        elif ours[0] == theirs[0]:
+            mode = ours[0]
+        else:
+            return status
+        if mode in SPECIAL_MODES or ours[0] in SPECIAL_MODES or \
+           theirs[0] in SPECIAL_MODES:
+            return status
+
+        hexsha = self.merge_file(base and base[1], ours[1], theirs[1])
+        if hexsha is None:
+            return status
+        return mode, hexsha
+
+    def solve_entries(self, entries, solution):
+        """
+            Applies a solution to the stages of an unmerged path, as the write
+            does in the working tree. Returns the (mode, hexsha) of the path,
+            or None if it is deleted.
+        """
+        action = solution[0]
+        if action == "delete":
+            return None
+
+        ours = entries.get(2)
+        theirs = entries.get(3)
+        mode = (ours or theirs)[0]
+        if action == "add_custom":
+            output, errors = run_command(["git", "hash-object", "-w",
+                                          "--stdin"], self._directory,
+                                         input=solution[1].encode("utf-8"))
+            return mode, output[0].strip()
+
+        # "add" keeps the file left by the cherry-pick, with the conflict
+        # markers if both sides are there.
+        if ours is None or theirs is None:
+            return ours or theirs
+        base = entries.get(1)
+        return mode, self.merge_file(base and base[1], ours[1], theirs[1],
+                                     keep_conflicts=True)
+
+    def merge_file(self, base, ours, theirs, keep_conflicts=False):
+        """
+            Runs git merge-file on the given blobs, and returns the hexsha of
+            the merged blob or None if there is a conflict.
+
+            :param keep_conflicts:
+                If True, the blob with the conflict markers is returned
+                instead of None.
+        """
+        blobs = read_blobs([hexsha for hexsha in (ours, base, theirs)
+                            if hexsha is not None], self._directory)
+        temp_dir = mkdtemp(prefix=".gitbuster_merge")
+        try:
+            paths = []
+            for name, hexsha in (("ours", ours), ("base", base),
+                                 ("theirs", theirs)):
+                path = os.path.join(temp_dir, name)
+                with open(path, "wb") as handle:
+                    handle.write(blobs.get(hexsha, ""))
+                paths.append(path)
+
+            output, errors, status = run_command_with_status(
+                            ["git", "merge-file", "-q"] + paths,
+                            self._directory)
+            if status != 0 and not keep_conflicts:
+                return None
+
+            output, errors = run_command(["git", "hash-object", "-w",
+                                          paths[0]], self._directory)
+            return output[0].strip()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
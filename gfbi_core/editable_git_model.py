@@ -5,6 +5,7 @@
 # License: http://www.gnu.org/licenses/gpl-3.0.txt
 
 from time import mktime
+from logging import DEBUG
 
 from random import random
 #from random import uniform
@@ -12,10 +13,12 @@ from random import random
 from gfbi_core import NAMES
 from gfbi_core.util import DummyCommit, InsertAction, SetAction, RemoveAction, \
                            SetBranchNameAction, DummyBranch, GfbiException, \
-                           Index
-from gfbi_core.git_model import GitModel
+                           Index, Timezone
+from gfbi_core.git_model import GitModel, git, git_util
 from gfbi_core import TIME_FIELDS
 from gfbi_core.git_filter_rebase import git_filter_rebase
+from gfbi_core.conflict_scan import ConflictScanner
+from gfbi_core.write_handle import WriteHandle
 from gfbi_core.non_continuous_timelapse import non_continuous_timelapse
 from gfbi_core.validation import validate_branch_name
 
@@ -27,25 +30,33 @@ class EditableGitModel(GitModel):
         used in other ways than gitbuster.
     """
 
-    def __init__(self, directory=".", fake_branch_name="", from_commits=False):
+    def __init__(self, directory=".", fake_branch_name="", from_commits=False,
+                 refs=None):
         """
             Initializes the model with the repository root directory.
 
             :param directory:
                 Root directory of the git repository.
+            :param refs:
+                Other references rewritten along with the current branch, see
+                GitModel.
         """
         if fake_branch_name:
             # This is an empy gitModel that will be filled with data from
             # another model
             self.orig_model = None
         else:
-            self.orig_model = GitModel(directory=directory)
+            self.orig_model = GitModel(directory=directory, refs=refs)
 
+        self._commit_map = {}
+        # The last write process. It isn't reset by populate(), so that the
+        # results of a write stay readable after the refresh of the model.
+        self._git_process = None
         self.init_attributes()
 
         GitModel.__init__(self, directory=directory,
                           fake_branch_name=fake_branch_name,
-                          from_commits=from_commits)
+                          from_commits=from_commits, refs=refs)
 
     def init_attributes(self):
         """
@@ -60,9 +71,9 @@ class EditableGitModel(GitModel):
         self._unmerged_files = None
         self._solutions = {}
         self._new_branch_name = ""
-        self._git_process = None
         self._start_write_cache = {}
         self._children_cache = {}
+        self._write_checkpoint = None
 
     def populate(self):
         """
@@ -76,6 +87,121 @@ class EditableGitModel(GitModel):
 
         GitModel.populate(self)
 
+    def apply_commit_map(self, commit_map):
+        """
+            Updates the model after a write, without walking the history
+            again: the rewritten commits are replaced by their new version
+            and the deleted ones are dropped. If the tip of the branch isn't
+            the one we expect, something else changed the repository and the
+            model is populated again.
+
+            Returns True if the model was patched, False if it was populated.
+
+            :param commit_map:
+                The dictionnary of the rewritten commits of the model (the
+                inserted ones too) and their new hexsha.
+        """
+        if self.is_fake_model() or self._remote_ref:
+            self.populate()
+            return False
+
+        replaced = {}
+        commits = []
+        parents = {}
+        for commit in self._commits:
+            if self.is_deleted(commit):
+                continue
+            new_commit = commit
+            if commit in commit_map:
+                new_commit = git.Commit(self._repo,
+                                        git_util.hex_to_bin(commit_map[commit]))
+                replaced[commit] = new_commit
+            commits.append(new_commit)
+            parents[new_commit] = self.c_data(commit, "parents")
+
+        if not commits or self._current_branch.commit != commits[0]:
+            self.populate()
+            return False
+
+        children = {}
+        for commit in commits:
+            for parent in parents[commit]:
+                parent = replaced.get(parent, parent)
+                children.setdefault(parent, []).append(commit)
+
+        unpushed = set(self._unpushed) | set(replaced.values())
+        unpushed = [commit for commit in commits if commit in unpushed]
+
+        self.init_attributes()
+        for model in (self, self.orig_model):
+            model._commits = list(commits)
+            model._children = dict((parent, list(_children))
+                                   for parent, _children in children.items())
+            model._unpushed = list(unpushed)
+        return True
+
+    def set_commit_map(self, commit_map):
+        """
+            Sets the hexshas of the commits rewritten by the last write, as a
+            dictionnary of the old hexsha and the new one (None if the commit
+            was deleted).
+        """
+        self._commit_map = commit_map
+
+    def get_commit_map(self):
+        """
+            Returns the hexshas of the commits rewritten by the last write,
+            see set_commit_map().
+        """
+        return self._commit_map
+
+    def export_commit_map(self, output):
+        """
+            Writes the commit map of the last write, one "old new" line per
+            commit after an "old new" header, as git filter-repo does. The
+            deleted commits are mapped to the null hexsha.
+
+            :param output:
+                A path, or a file object.
+        """
+        handle = output
+        if isinstance(output, basestring):
+            handle = open(output, "w")
+        try:
+            handle.write("old new\n")
+            for old_hexsha, new_hexsha in self._commit_map.iteritems():
+                handle.write("%s %s\n" % (old_hexsha, new_hexsha or "0" * 40))
+        finally:
+            if handle is not output:
+                handle.close()
+
+    def memory_categories(self):
+        """
+            Returns the (name, object) tuples whose size is reported by
+            memory_footprint(): the categories of GitModel, the modifications
+            and the history of the model, its caches, and the commits of the
+            original model.
+        """
+        categories = GitModel.memory_categories(self)
+        categories += [("modifications", [self._modifications,
+                                          self._deleted_commits,
+                                          self._solutions]),
+                       ("history", self._history),
+                       ("caches", [self._start_write_cache,
+                                   self._children_cache,
+                                   self._commit_map])]
+        if self.orig_model is not None:
+            categories.append(("orig_model",
+                               [category for name, category
+                                in self.orig_model.memory_categories()]))
+        return categories
+
+    def memory_ignored(self):
+        ignored = GitModel.memory_ignored(self)
+        if self.orig_model is not None:
+            ignored += self.orig_model.memory_ignored()
+        return ignored
+
     def set_current_branch(self, branch, force=False):
         """
             Sets the model's current branch.
@@ -89,7 +215,8 @@ class EditableGitModel(GitModel):
         if self.is_fake_model():
             # This is the moment after we wrote the model, the model is getting
             # real (not fake).
-            self.orig_model = GitModel(directory=self._directory)
+            self.orig_model = GitModel(directory=self._directory,
+                                       refs=self._refs)
 
         self.orig_model.set_current_branch(branch, force=force)
         self._modifications = {}
@@ -112,6 +239,12 @@ class EditableGitModel(GitModel):
                 not self.is_deleted(commit)])
         return len(modified)
 
+    def get_deleted_commits(self):
+        """
+            Returns the list of the deleted commits.
+        """
+        return self._deleted_commits
+
     def get_deleted_count(self):
         """
             Returns the number of deleted commits.
@@ -152,6 +285,14 @@ class EditableGitModel(GitModel):
         col = self.get_column(field)
         return self.data(Index(row, col))
 
+    def orig_c_data(self, commit, field):
+        """
+            Same as c_data(), but ignoring the modifications of the model.
+        """
+        row = self.row_of(commit)
+        col = self.get_column(field)
+        return self.orig_data(Index(row, col))
+
     def modified_data(self, index):
         commit = self._commits[index.row()]
         column = index.column()
@@ -340,6 +481,44 @@ class EditableGitModel(GitModel):
                         action = RemoveAction(position, commit, modifications)
                         self._history[self._last_history_event].append(action)
 
+    def delete_commits(self, commits):
+        """
+            Marks the given commits as deleted, without history entries. This
+            is the bulk version of remove_rows(). The children of a deleted
+            commit are reparented on its parents, as the set_data() calls
+            following remove_rows() do.
+        """
+        deleted = set(self._deleted_commits)
+        for commit in commits:
+            if commit in deleted:
+                continue
+            deleted.add(commit)
+            self._deleted_commits.append(commit)
+
+            parents = self.c_data(commit, "parents")
+            children = self.c_data(commit, "children")
+            for child in children:
+                self._replace_link(child, "parents", commit, parents)
+            for parent in parents:
+                self._replace_link(parent, "children", commit, children)
+
+    def _replace_link(self, commit, field, old_commit, new_commits):
+        """
+            Replaces old_commit by new_commits in the parents or the children
+            of commit. The commits that aren't in the model are left alone.
+        """
+        try:
+            links = self.c_data(commit, field)
+        except ValueError:
+            return
+
+        new_links = []
+        for link in links:
+            for new_link in (new_commits if link == old_commit else [link]):
+                if new_link not in new_links:
+                    new_links.append(new_link)
+        self.set_field_data(commit, field, new_links)
+
     def is_deleted(self, indexorcommit):
         """
             If indexorcommit:
@@ -401,22 +580,47 @@ class EditableGitModel(GitModel):
                 return True
         return False
 
-    def write(self, log=True, force_committed_date=False, dont_populate=False):
+    def write(self, log=True, force_committed_date=False, dont_populate=False,
+              fast_import=False, workers=1, log_level=DEBUG,
+              log_flush_interval=None, progress_callback=None):
         """
             Start the git filter-branch command and therefore write the
             modifications stored in _modifications.
 
             :param log:
                 Boolean, set to True to log the git command.
+            :param log_level:
+                The level of the logged records, see the logging module. Use
+                INFO to skip the output of the git commands.
+            :param log_flush_interval:
+                If set, the log is written every log_flush_interval seconds
+                by a background thread.
             :param force_committed_date:
                 As the git way updates the committed author/date when
                 cherry-picking, and since we offer to modify these values, we
                 offer the user the choice to force the committed author/date
                 or to let git update it.
+            :param fast_import:
+                Boolean, set to True to write all the commits through a single
+                git fast-import stream.
+            :param workers:
+                Number of workers picking the independent lines of development
+                at the same time, each one in its own worktree.
+            :param progress_callback:
+                If set, called with the progress from the thread of the
+                process every time a commit is rewritten, before the next one
+                is. Unlike the updates of the WriteHandle, it sees every
+                commit from the start of the write.
+
+            Returns a WriteHandle, to follow the write without polling the
+            model, and to cancel it.
         """
         self._git_process = git_filter_rebase(self, log=log,
                                     force_committed_date=force_committed_date,
-                                    dont_populate=dont_populate)
+                                    dont_populate=dont_populate,
+                                    fast_import=fast_import,
+                                    workers=workers, log_level=log_level,
+                                    log_flush_interval=log_flush_interval)
                            # git_filter_branch_process(self,
                            #        directory=self._directory,
                            #        commits=self._commits,
@@ -424,7 +628,11 @@ class EditableGitModel(GitModel):
                            #        oldest_commit_parent=oldest_commit_parent,
                            #        log=log, script=script)
 
+        if progress_callback is not None:
+            self._git_process.add_progress_callback(progress_callback)
+        handle = WriteHandle(self._git_process)
         self._git_process.start()
+        return handle
 
     def is_finished_writing(self):
         """
@@ -442,6 +650,16 @@ class EditableGitModel(GitModel):
             return self._git_process.progress()
         return 0
 
+    def write_metrics(self):
+        """
+            Returns the metrics of the git command process (the number of
+            commits per second, the ETA, the durations of every phase), or
+            None if there is no process.
+        """
+        if self._git_process is not None:
+            return self._git_process.metrics()
+        return None
+
     def is_write_success(self):
         """
             Returns True if the write process went through without failing.
@@ -465,29 +683,43 @@ class EditableGitModel(GitModel):
             Returns the parents of the commits that are modified.
         """
         modified_commits = tuple(self._modifications.keys())
-        if modified_commits in self._start_write_cache.keys():
+        if modified_commits in self._start_write_cache:
             return self._start_write_cache[modified_commits]
+        if self._instrumentation is not None:
+            self._instrumentation.cache_miss("get_start_write_from")
 
+        deleted = set(self._deleted_commits)
         parents = set()
-        for commit in (set(self._modifications) | set(self._deleted_commits)):
-            if self.commit_is_modified(commit) or self.is_deleted(commit):
+        for commit in (set(self._modifications) | deleted):
+            if commit in deleted or self.commit_is_modified(commit):
                 parents.add(commit)
 
-        smaller_parent_set = set(parents)
+        # The start commits are the modified commits without any modified
+        # ancestor. Every ancestor is visited once.
+        known = set(self._commits)
+        has_modified_ancestor = {}
         for parent in parents:
-            # Check that parent isn't in any of the other parents history tree
-            if parent not in smaller_parent_set:
-                continue
-
-            for _parent in parents - set([parent]):
-                # Go down the history tree of _parent
-                this_parent_parents = self.c_data(_parent, "parents")
-                if _parent in smaller_parent_set and \
-                   parent in self.all_parents(_parent):
-                    # Parent is present in the _parent history tree
-                    # That means _parent must be removed from
-                    # smaller_parent_set.
-                    smaller_parent_set.remove(_parent)
+            to_look = [parent]
+            while to_look:
+                commit = to_look[-1]
+                if commit in has_modified_ancestor:
+                    to_look.pop()
+                    continue
+                commit_parents = [_parent for _parent
+                                  in self.c_data(commit, "parents")
+                                  if _parent in known]
+                pending = [_parent for _parent in commit_parents
+                           if _parent not in has_modified_ancestor]
+                if pending:
+                    to_look.extend(pending)
+                    continue
+                to_look.pop()
+                has_modified_ancestor[commit] = any(
+                        _parent in parents or has_modified_ancestor[_parent]
+                        for _parent in commit_parents)
+
+        smaller_parent_set = set(parent for parent in parents
+                                 if not has_modified_ancestor[parent])
 
         if parents == set([]) and self.is_fake_model():
             # Special case: no commit has really been modified, and this is a
@@ -508,6 +740,9 @@ class EditableGitModel(GitModel):
         while parents_to_look:
             commit = parents_to_look.pop()
             for parent in self.c_data(commit, "parents"):
+                if parent in parents:
+                    continue
+                parents.add(parent)
                 yield parent
                 parents_to_look.add(parent)
 
@@ -518,8 +753,10 @@ class EditableGitModel(GitModel):
         children = set()
 
         modified_commits = tuple(self._modifications.keys())
-        if modified_commits in self._children_cache.keys():
+        if modified_commits in self._children_cache:
             return self._children_cache[modified_commits]
+        if self._instrumentation is not None:
+            self._instrumentation.cache_miss("all_children")
 
         children_to_look = set(commits)
         while children_to_look:
@@ -572,17 +809,20 @@ class EditableGitModel(GitModel):
         total_seconds = timelapse.get_total_seconds()
         distribution = [int(random() * total_seconds)
                         for commit in xrange(len(self._commits))]
-        distribution.sort()
+        # The first rows are the most recent commits
+        distribution.sort(reverse=True)
 
         index = 0
         for commit in self._commits:
             this_distribution = distribution[index]
             new_commit_time = timelapse.datetime_from_seconds(
                                                             this_distribution)
-            self.set_field_data(commit, "authored_date",
-                                int(mktime(new_commit_time.timetuple())))
-            self.set_field_data(commit, "committed_date",
-                                int(mktime(new_commit_time.timetuple())))
+            timestamp = int(mktime(new_commit_time.timetuple()))
+            # The dates are stored with their timezone, as in data()
+            for field in TIME_FIELDS:
+                value = self.c_data(commit, field)
+                tz = value[1] if value else Timezone("+0000")
+                self.set_field_data(commit, field, (timestamp, tz))
 
             index += 1
 
@@ -648,9 +888,10 @@ class EditableGitModel(GitModel):
         """
         return self._unmerged_files
 
-    def set_conflict_solutions(self, solutions):
+    def set_conflict_solutions(self, solutions, commit=None):
         """
-            Sets the solutions for the current conflicting commit.
+            Sets the solutions for the current conflicting commit, or for the
+            given commit (for instance one reported by scan_conflicts).
 
             :param solutions:
                 This is a dictionnary like:
@@ -664,8 +905,13 @@ class EditableGitModel(GitModel):
                     add         : git add filepath
                     add_custom  : echo $custom_content > filepath
                                   git add filepath
+            :param commit:
+                The commit the solutions are for. Defaults to the current
+                conflicting commit.
         """
-        self._solutions[self._conflicting_commit] = solutions
+        if commit is None:
+            commit = self._conflicting_commit
+        self._solutions[commit] = solutions
 
     def get_conflict_solutions(self):
         """
@@ -673,6 +919,32 @@ class EditableGitModel(GitModel):
         """
         return self._solutions
 
+    def scan_conflicts(self, workers=1):
+        """
+            Simulates the write without touching the working directory, and
+            returns a dictionnary of the commits that will conflict, with for
+            each one a dictionnary of its unmerged paths and their git status.
+            Solutions can then be given for all of them before writing.
+
+            :param workers:
+                The number of commits merged at the same time.
+        """
+        return ConflictScanner(self, workers=workers).scan()
+
+    def set_write_checkpoint(self, checkpoint):
+        """
+            Sets the state of the last write, interrupted by a conflict. The
+            next write resumes from it if the model didn't change meanwhile.
+        """
+        self._write_checkpoint = checkpoint
+
+    def get_write_checkpoint(self):
+        """
+            Returns the state of the last write interrupted by a conflict, or
+            None.
+        """
+        return self._write_checkpoint
+
     def is_valid_branch_name(self, name):
         """
             This allows us to check if the name is valid before setting it.
@@ -0,0 +1,275 @@
+# fast_import.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from subprocess import Popen, PIPE
+from tempfile import mkstemp
+import os
+import time
+
+from gfbi_core.util import GfbiException, run_command, \
+                           run_command_with_status
+
+FAST_IMPORT_REF = "refs/heads/gitbuster_rebase"
+# The number of streamed commits between two progress requests, which wait
+# for fast-import to go through the stream.
+PROGRESS_INTERVAL = 100
+
+
+class FastImportUnsupported(GfbiException):
+    """
+        Raised when a commit can't be rewritten by the fast-import stream,
+        because it would need a real merge (as the cherry-pick does).
+    """
+    pass
+
+
+def quote_path(path):
+    """
+        Returns the C-style quoted form of the path, as accepted by
+        git fast-import.
+    """
+    path = path.replace('\\', '\\\\').replace('"', '\\"')
+    path = path.replace('\n', '\\n')
+    return '"%s"' % path
+
+
+def format_ident(name, email, date):
+    """
+        Returns an identity line suitable for the author and committer
+        commands of the stream.
+
+        :param date:
+            The date in the "<timestamp> <tz>" format, as given to
+            GIT_AUTHOR_DATE.
+    """
+    return "%s <%s> %s" % (encode(name), encode(email), encode(date))
+
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class FastImportStream:
+    """
+        A single long-lived git fast-import process, fed with one commit at a
+        time. All the new objects end up in one pack.
+
+        As with git commit-tree, the commits without a committer date get the
+        current date, unless GIT_COMMITTER_DATE is set in the environment.
+    """
+
+    def __init__(self, directory, log=None):
+        """
+            Starts the git fast-import process.
+
+            :param directory:
+                The directory of the git repository.
+            :param log:
+                A callable used to log the commits sent to the process, called
+                with a message and keyword fields.
+        """
+        self._directory = directory
+        self._log = log
+        self._next_mark = 1
+        self._last_progress = 0
+
+        # Read before starting the process, so that nothing is left behind
+        # if there is no identity.
+        output, errors, status = run_command_with_status(
+                            ["git", "var", "GIT_COMMITTER_IDENT"], directory)
+        # "Name <email> timestamp tz"
+        parts = output[0].strip().rsplit(" ", 2) if output else []
+        if status != 0 or len(parts) != 3:
+            raise GfbiException("Can't read the committer identity: %s" %
+                                "\n".join(errors).strip())
+        self._default_ident, timestamp, self._default_tz = parts
+        self._fixed_date = None
+        if "GIT_COMMITTER_DATE" in os.environ:
+            self._fixed_date = timestamp
+
+        handle, self._marks_file = mkstemp(prefix=".gitbuster_marks")
+        os.close(handle)
+
+        self._process = Popen(["git", "fast-import", "--quiet", "--force",
+                               "--export-marks=%s" % self._marks_file],
+                              cwd=directory, stdin=PIPE, stdout=PIPE)
+
+    def default_committer(self):
+        """
+            Returns the committer line of a commit without committer fields,
+            as git commit-tree would set it now.
+        """
+        timestamp = self._fixed_date or "%d" % time.time()
+        return "%s %s %s" % (self._default_ident, timestamp, self._default_tz)
+
+    def write(self, data):
+        self._process.stdin.write(data)
+
+    def read_line(self):
+        """
+            Flushes the stream and reads one line of fast-import's output.
+        """
+        self._process.stdin.flush()
+        line = self._process.stdout.readline()
+        if not line:
+            raise GfbiException("git fast-import exited unexpectedly.")
+        return line.rstrip("\n")
+
+    def ls(self, dataref, path):
+        """
+            Returns the (mode, hexsha) of the given path in the given commit,
+            or None if the path is missing.
+
+            :param dataref:
+                A mark (":12") or the hexsha of a commit or a tree.
+            :param path:
+                A path relative to the root of the tree. "" is the root tree.
+        """
+        self.write("ls %s %s\n" % (dataref, quote_path(path)))
+        line = self.read_line()
+        if line.startswith("missing "):
+            return None
+        mode, _type, hexsha = line.split("\t", 1)[0].split(" ")
+        return mode, hexsha
+
+    def commit(self, fields, message, parents, tree=None, operations=()):
+        """
+            Writes a commit to the stream and returns its mark.
+
+            :param fields:
+                The dictionnary of the environment variables (as in ENV_FIELDS)
+                describing the commit. Committer fields that are missing are
+                set to the default identity of the repository.
+            :param message:
+                The commit message.
+            :param parents:
+                The list of the parents, as marks or hexshas.
+            :param tree:
+                If set, the hexsha of the tree of the commit.
+            :param operations:
+                Otherwise, a list of (mode, hexsha, path) modifications to
+                apply on the first parent. A None hexsha means the path is
+                deleted.
+        """
+        mark = ":%d" % self._next_mark
+        self._next_mark += 1
+
+        if "GIT_COMMITTER_DATE" in fields:
+            committer = format_ident(fields["GIT_COMMITTER_NAME"],
+                                     fields["GIT_COMMITTER_EMAIL"],
+                                     fields["GIT_COMMITTER_DATE"])
+        else:
+            committer = self.default_committer()
+
+        message = encode(message)
+
+        if not parents:
+            self.write("reset %s\n" % FAST_IMPORT_REF)
+        self.write("commit %s\n" % FAST_IMPORT_REF)
+        self.write("mark %s\n" % mark)
+        self.write("author %s\n" % format_ident(fields["GIT_AUTHOR_NAME"],
+                                                fields["GIT_AUTHOR_EMAIL"],
+                                                fields["GIT_AUTHOR_DATE"]))
+        self.write("committer %s\n" % committer)
+        self.write("data %d\n%s\n" % (len(message), message))
+        if parents:
+            self.write("from %s\n" % parents[0])
+        for parent in parents[1:]:
+            self.write("merge %s\n" % parent)
+
+        if tree is not None:
+            self.write('M 040000 %s ""\n' % tree)
+        for mode, hexsha, path in operations:
+            if hexsha is None:
+                self.write("D %s\n" % quote_path(path))
+            else:
+                self.write("M %s %s %s\n" % (mode, hexsha, quote_path(path)))
+        self.write("\n")
+
+        if self._log is not None:
+            self._log("Streamed commit", mark=mark, parents=list(parents),
+                      tree=tree, operations=len(operations))
+        return mark
+
+    def progress(self, force=False):
+        """
+            Returns the number of commits fast-import went through. It is only
+            asked to fast-import every PROGRESS_INTERVAL commits, since this
+            waits for fast-import to catch up with the stream.
+
+            :param force:
+                If True, fast-import is asked whatever the number of commits
+                since the last time.
+        """
+        streamed = self._next_mark - 1
+        if not force and streamed - self._last_progress < PROGRESS_INTERVAL:
+            return self._last_progress
+
+        self.write("progress %d\n" % streamed)
+        line = self.read_line()
+        self._last_progress = int(line.split(" ")[1])
+        return self._last_progress
+
+    def close(self):
+        """
+            Ends the stream and returns a dictionnary of the marks and the
+            hexsha of the commits they stand for.
+        """
+        self._process.stdin.close()
+        self._process.stdout.read()
+        if self._process.wait() != 0:
+            raise GfbiException("git fast-import failed.")
+
+        marks = {}
+        with open(self._marks_file) as handle:
+            for line in handle:
+                mark, hexsha = line.split()
+                marks[mark] = hexsha
+        os.remove(self._marks_file)
+
+        return marks
+
+    def abort(self):
+        """
+            Kills the fast-import process, leaving the repository untouched.
+            The process is killed before its input is closed: on the end of
+            its input, fast-import would write the pack and the reference.
+        """
+        self._process.kill()
+        self._process.wait()
+        for pipe in (self._process.stdin, self._process.stdout):
+            try:
+                pipe.close()
+            except IOError:
+                # Data left in the buffer of the dead process's input
+                pass
+        if os.path.exists(self._marks_file):
+            os.remove(self._marks_file)
+
+
+def diff_operations(from_hexsha, to_hexsha, directory=None):
+    """
+        Returns the list of (src_mode, src_hexsha, dst_mode, dst_hexsha, path)
+        describing the changes between the two commits. Missing sides are
+        described by a None hexsha.
+    """
+    command = ["git", "diff-tree", "-r", "-z", "--no-renames", "--raw",
+               from_hexsha, to_hexsha]
+    output, errors = run_command(command, directory)
+
+    fields = "\n".join(output).split("\0")
+    changes = []
+    for header, path in zip(fields[0::2], fields[1::2]):
+        src_mode, dst_mode, src_hexsha, dst_hexsha, status = \
+                header.lstrip(":").split(" ")
+        if status == "A":
+            src_hexsha = None
+        elif status == "D":
+            dst_hexsha = None
+        changes.append((src_mode, src_hexsha, dst_mode, dst_hexsha, path))
+    return changes
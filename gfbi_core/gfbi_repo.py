@@ -1,8 +1,13 @@
-from os.path import join
+from os.path import join, getmtime
+from weakref import WeakValueDictionary
+from bisect import bisect_left
 #import GitPython
 #import dulwich
-import pygit2
-from gfbi_core.util import Timezone
+from gfbi_core.util import Timezone, GfbiException, git_dirs, RefsWatcher, \
+                           LazyModule
+from gfbi_core import PYGIT2_HINT
+
+pygit2 = LazyModule("pygit2", PYGIT2_HINT)
 
 #class Repo:
 #    """
@@ -33,8 +38,67 @@ class Repo:
             :param directory:
                 The directory of the git repository.
         """
-        self._repo = pygit2.Repository(join(directory, ".git"))
+        self._git_dir, self._common_dir = git_dirs(directory)
+        self._repo = pygit2.Repository(self._git_dir)
         self._directory = directory
+        # Every commit has a single wrapper, as long as it is used.
+        self._commits = WeakValueDictionary()
+
+        # The sorted reference names and the branch objects, valid as long as
+        # the stamp of the RefsWatcher doesn't change.
+        self._refs = RefsWatcher(self._common_dir)
+        self._refs_stamp = None
+        # Incremented every time a reference changed, see
+        # BranchFromPygit2.commit
+        self._refs_generation = 0
+        self._ref_names = []
+        self._branches = {}
+        self._head = (None, None)
+
+    def _check_refs_cache(self):
+        """
+            Empties the reference cache if a reference changed on disk.
+        """
+        stamp = self._refs.stamp()
+        if stamp != self._refs_stamp:
+            self._ref_names = sorted(self._repo.listall_references())
+            self._branches = {}
+            self._refs_stamp = stamp
+            self._refs_generation += 1
+
+    def references(self, prefix=""):
+        """
+            Returns the sorted names of the references starting with the
+            given prefix, for instance "refs/heads/" or "refs/tags/v1.".
+        """
+        self._check_refs_cache()
+        names = self._ref_names
+        start = bisect_left(names, prefix)
+        end = start
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return names[start:end]
+
+    def branch(self, ref):
+        """
+            Returns the BranchFromPygit2 object of the given reference, which
+            must be like "refs/heads/master". The objects are cached until a
+            reference changes.
+        """
+        self._check_refs_cache()
+        return self._get_branch_from_ref(ref)
+
+    def wrap_commit(self, commit_object):
+        """
+            Returns the CommitFromPygit2 object of the given pygit2.Commit,
+            reusing the existing wrapper if there is one.
+        """
+        hexsha = commit_object.sha
+        commit = self._commits.get(hexsha)
+        if commit is None:
+            commit = CommitFromPygit2(commit_object, self)
+            self._commits[hexsha] = commit
+        return commit
 
     @property
     def active_branch(self):
@@ -42,19 +106,24 @@ class Repo:
             Returns the current checked out branch or raises an exception if
             the git repository is in detached HEAD state.
         """
-        refs = []
-        with open(join(self._directory, '.git/HEAD')) as handle:
-            refs = [line.strip()
-                    for line in handle.readlines()
-                    if line[:5] == 'ref: ']
-
-        if not refs:
+        head_file = join(self._git_dir, 'HEAD')
+        mtime = getmtime(head_file)
+        head_mtime, active_branch = self._head
+        if mtime != head_mtime:
+            refs = []
+            with open(head_file) as handle:
+                refs = [line.strip()
+                        for line in handle.readlines()
+                        if line[:5] == 'ref: ']
+
+            # here refs should be like : ["ref: refs/heads/master"]
+            active_branch = refs[0].split(" ")[1] if refs else None
+            self._head = (mtime, active_branch)
+
+        if active_branch is None:
             raise GfbiException("Repository is in detached HEAD state.")
 
-        # here refs should be like : ["ref: refs/heads/master"]
-        active_branch = refs[0].split(" ")[1]
-
-        return self._get_branch_from_ref(active_branch)
+        return self.branch(active_branch)
 
     def _get_branch_from_ref(self, ref):
         """
@@ -63,9 +132,11 @@ class Repo:
         """
         assert ref[:11] == "refs/heads/", "Reference isn't correct: %s" % ref
 
-        reference = self._repo.lookup_reference(ref)
-        commit = CommitFromPygit2(self._repo[reference.sha])
-        return BranchFromPygit2(reference, commit)
+        branch = self._branches.get(ref)
+        if branch is None:
+            branch = BranchFromPygit2(self, ref)
+            self._branches[ref] = branch
+        return branch
 
     def all_commits(self, rev=None):
         """
@@ -80,17 +151,45 @@ class Repo:
                     * "refs/tags/v0.1"
                     * CommitFromPygit2()
         """
+        return list(self.iter_commits(rev))
+
+    def iter_commits(self, rev=None, limit=None, until=None):
+        """
+            Yields the commits in the history of the given revision, in
+            topological order, without building the whole list.
+
+            :param rev:
+                The revision from which we list the history, in the formats
+                accepted by all_commits().
+            :param limit:
+                If set, the maximum number of commits yielded.
+            :param until:
+                If set, a revision (in the same formats) whose history isn't
+                listed: the walk stops at it, as with "until..rev".
+        """
         assert rev is not None
 
-        if rev in self._repo.listall_references():
-            rev = self._repo.lookup_reference(rev).sha
+        walker = self._repo.walk(self._resolve(rev),
+                                 pygit2.GIT_SORT_TOPOLOGICAL)
+        if until is not None:
+            walker.hide(self._resolve(until))
 
+        for count, commit in enumerate(walker):
+            if limit is not None and count >= limit:
+                return
+            yield self.wrap_commit(commit)
+
+    def _resolve(self, rev):
+        """
+            Returns the hexsha of the given revision.
+        """
         if isinstance(rev, CommitFromPygit2):
-            rev = rev.hexsha
+            return rev.hexsha
+
+        if rev.startswith("refs/") and rev in self.references(rev):
+            return self._repo.lookup_reference(rev).sha
 
-        return [CommitFromPygit2(commit)
-                for commit in self._repo.walk(rev,
-                                              pygit2.GIT_SORT_TOPOLOGICAL)]
+        return rev
 
     @property
     def branches(self):
@@ -98,115 +197,199 @@ class Repo:
             Returns the branches in the form of a list of BranchFromPygit2
             objects.
         """
-        return [self._get_branch_from_ref(ref)
-                for ref in self._repo.listall_references()
-                if ref[:11] == "refs/heads/"]
+        return [self.branch(ref) for ref in self.references("refs/heads/")]
 
-    def is_dirty(self):
+    def is_dirty(self, untracked_files=False):
         """
-            Not implemented yet.
+            Returns True if the index or the working tree differ from HEAD.
+            libgit2 computes the status in a single pass and uses the stat
+            data of the index, so unchanged files aren't read.
+
+            :param untracked_files:
+                If True, untracked files also make the repository dirty.
         """
-        return False
+        ignored = pygit2.GIT_STATUS_IGNORED
+        if not untracked_files:
+            ignored |= pygit2.GIT_STATUS_WT_NEW
+        return any(flags & ~ignored
+                   for flags in self._repo.status().itervalues())
 
-class CommitFromPygit2:
+def tz_string(offset):
+    """
+        Returns the "+0100" form of an offset to UTC given in minutes.
+    """
+    sign = "+" if offset >= 0 else "-"
+    return "%s%02d%02d" % (sign, abs(offset) / 60, abs(offset) % 60)
+
+
+class CommitFromPygit2(object):
     """
         Wrapper class to provide a common API for different bindings. Here, we
         provide a wrapper for pygit2 Commit objects.
+
+        The wrappers are built by Repo.wrap_commit(), so that there is only one
+        wrapper per commit. The fields are read from pygit2 once.
     """
 
-    def __init__(self, commit_object):
+    __slots__ = ("_commit_object", "_repo", "_hexsha", "_hash", "_parents",
+                 "_author_name", "_author_email", "_authored_date",
+                 "_author_tz", "_committer_name", "_committer_email",
+                 "_committed_date", "_committer_tz", "_message", "_summary",
+                 "__weakref__")
+
+    def __init__(self, commit_object, repo=None):
         """
             Initializes the CommitFromPygit2 object with a pygit2.Commit
             object.
 
             :param commit_object:
                 The pygit2.Commit we are wrapping.
+            :param repo:
+                The Repo whose identity map is used for the parents.
         """
         assert isinstance(commit_object, pygit2.Commit), commit_object
         self._commit_object = commit_object
+        self._repo = repo
+        self._hexsha = commit_object.sha
+        self._hash = hash(self._hexsha)
+        self._parents = None
+        # The signatures and the message are read on first access, a whole
+        # signature at once.
+        self._author_name = None
+        self._author_email = None
+        self._authored_date = None
+        self._author_tz = None
+        self._committer_name = None
+        self._committer_email = None
+        self._committed_date = None
+        self._committer_tz = None
+        self._message = None
+        self._summary = None
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not hasattr(other, "hexsha"):
             return False
-        return self.hexsha == other.hexsha
+        return self._hexsha == other.hexsha
 
-    def __neq__(self, other):
+    def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.hexsha)
+        return self._hash
+
+    def _read_committer(self):
+        name, email, date, offset = self._commit_object.committer[:4]
+        self._committer_name = name
+        self._committer_email = email
+        self._committed_date = date
+        self._committer_tz = Timezone(tz_string(offset))
+
+    def _read_author(self):
+        name, email, date, offset = self._commit_object.author[:4]
+        self._author_name = name
+        self._author_email = email
+        self._authored_date = date
+        self._author_tz = Timezone(tz_string(offset))
 
     @property
     def committer_name(self):
-        return self._commit_object.committer[0]
+        if self._committer_tz is None:
+            self._read_committer()
+        return self._committer_name
 
     @property
     def committer_email(self):
-        return self._commit_object.committer[1]
+        if self._committer_tz is None:
+            self._read_committer()
+        return self._committer_email
 
     @property
     def committed_date(self):
-        return self._commit_object.committer[2]
+        if self._committer_tz is None:
+            self._read_committer()
+        return self._committed_date
 
     @property
     def committer_tz(self):
-        return Timezone(mnts_offset=self._commit_object.committer[3])
+        if self._committer_tz is None:
+            self._read_committer()
+        return self._committer_tz
 
     @property
     def author_name(self):
-        return self._commit_object.author[0]
+        if self._author_tz is None:
+            self._read_author()
+        return self._author_name
 
     @property
     def author_email(self):
-        return self._commit_object.author[1]
+        if self._author_tz is None:
+            self._read_author()
+        return self._author_email
 
     @property
     def authored_date(self):
-        return self._commit_object.author[2]
+        if self._author_tz is None:
+            self._read_author()
+        return self._authored_date
 
     @property
     def author_tz(self):
-        return Timezone(mnts_offset=self._commit_object.author[3])
+        if self._author_tz is None:
+            self._read_author()
+        return self._author_tz
 
     @property
     def parents(self):
-        return [CommitFromPygit2(commit)
-                for commit in self._commit_object.parents]
+        if self._parents is None:
+            if self._repo is not None:
+                wrap = self._repo.wrap_commit
+            else:
+                wrap = CommitFromPygit2
+            self._parents = tuple(wrap(commit)
+                                  for commit in self._commit_object.parents)
+        return list(self._parents)
 
     @property
     def summary(self):
-        return self._commit_object.message_short
+        if self._summary is None:
+            self._summary = self._commit_object.message_short
+        return self._summary
 
     @property
     def message(self):
-        return self._commit_object.message
+        if self._message is None:
+            self._message = self._commit_object.message
+        return self._message
 
     @property
     def hexsha(self):
-        return self._commit_object.sha
+        return self._hexsha
 
 
 class BranchFromPygit2:
     """
         Wrapper class to provide a common API for different bindings. Here, we
         provide a wrapper for branches when we're using pygit2. We're wrapping
-        pygit2.Reference and CommitFromPygit2.
+        pygit2.Reference and CommitFromPygit2, which are only looked up when
+        the commit is needed.
     """
 
-    def __init__(self, reference, commit):
+    def __init__(self, repo, name):
         """
             Initialization of the BranchFromPygit2 object.
 
-            :param reference:
-                The pygit2.Reference object related to the branch.
-            :param commit:
-                The CommitFromPygit2 object pointed by the branch reference.
+            :param repo:
+                The Repo of the branch.
+            :param name:
+                The name of the reference, like "refs/heads/master".
         """
-        assert isinstance(reference, pygit2.Reference), reference
-        assert isinstance(commit, CommitFromPygit2), commit
-
-        self._reference = reference
-        self._commit = commit
+        self._repo = repo
+        self._name = name
+        self._commit = None
+        self._generation = None
 
     @property
     def name(self):
@@ -214,14 +397,21 @@ class BranchFromPygit2:
             Returns the name of the reference, in the format of
             "refs/heads/master".
         """
-        return self._reference.name
+        return self._name
 
     @property
     def commit(self):
         """
             Returns the CommitFromPygit2 object pointed by the branch
-            reference.
+            reference. It is looked up again when a reference changed.
         """
+        self._repo._check_refs_cache()
+        if self._commit is None or \
+           self._generation != self._repo._refs_generation:
+            pygit2_repo = self._repo._repo
+            reference = pygit2_repo.lookup_reference(self._name)
+            self._commit = self._repo.wrap_commit(pygit2_repo[reference.sha])
+            self._generation = self._repo._refs_generation
         return self._commit
 
     def tracking_branch(self):
@@ -4,20 +4,137 @@
 # This module is part of gfbi_core and is released under the GPLv3
 # License: http://www.gnu.org/licenses/gpl-3.0.txt
 
-from threading import Thread
+from threading import Thread, Event, local
+from logging import DEBUG, INFO, WARNING, ERROR
+from collections import deque
+from Queue import Queue
+from tempfile import mkdtemp
 import os
 import time
-import codecs
-from git import Repo
 
-from gfbi_core.util import Index, run_command, apply_solutions, \
-                           get_unmerged_files, GfbiException
+from gfbi_core.util import Index, Command, apply_solutions, \
+                           get_unmerged_files, GfbiException, DummyCommit, \
+                           list_refs, is_dirty
+from gfbi_core.fast_import import FastImportStream, FastImportUnsupported, \
+                                  diff_operations, FAST_IMPORT_REF
+from gfbi_core.logger import BufferedLogger, decode
+from gfbi_core.metrics import WriteMetrics
+from gfbi_core.git_model import git
 from gfbi_core import ENV_FIELDS, ACTOR_FIELDS, TIME_FIELDS
 
 
-def add_assign(commit_settings, field, value):
-    commit_settings += ENV_FIELDS[field] + "='%s'" % value + " "
-    return commit_settings
+class WriteCancelled(GfbiException):
+    """
+        Raised in the write process when it has been cancelled.
+    """
+    pass
+
+
+def schedule(model, start_commits):
+    """
+        Returns a dictionnary of the commits that should be updated, with the
+        number of their parents that have to be updated before them.
+
+        The commits are the start commits and their children. We don't look
+        further than deleted commits, since they won't be written.
+    """
+    waiting = {}
+    to_look = list(start_commits)
+    while to_look:
+        commit = to_look.pop()
+        if commit in waiting:
+            continue
+
+        waiting[commit] = 0
+        if not model.is_deleted(commit):
+            to_look.extend(model.c_data(commit, "children"))
+
+    for commit in waiting:
+        if model.is_deleted(commit):
+            continue
+        for child in set(model.c_data(commit, "children")):
+            waiting[child] += 1
+
+    return waiting
+
+
+def ready_commits(model, waiting):
+    """
+        Returns the commits that don't wait for any parent, the oldest first.
+    """
+    return deque(sorted([commit for commit, count in waiting.items()
+                         if count == 0],
+                        key=model.row_of, reverse=True))
+
+
+def release_children(model, commit, waiting, ready):
+    """
+        Called once the given commit is updated: the children of the commit
+        that don't wait for other parents anymore are added to the ready list.
+    """
+    if model.is_deleted(commit):
+        return
+
+    for child in set(model.c_data(commit, "children")):
+        waiting[child] -= 1
+        if waiting[child] == 0:
+            ready.append(child)
+
+
+def snapshot_modifications(model):
+    """
+        Returns a copy of the modifications and of the deleted commits of the
+        model, used to check that the model didn't change since a checkpoint.
+    """
+    modifications = dict((commit, dict(fields))
+                         for commit, fields in model.get_modifications().items())
+    return modifications, set(model.get_deleted_commits())
+
+
+class WriteCheckpoint:
+    """
+        The state of a rewrite interrupted by a conflict. The next write of
+        the model resumes from the conflicting commit rather than rewriting
+        every commit again.
+    """
+
+    def __init__(self, model, start_commits, to_rewrite_count, waiting, ready,
+                 updated_refs, updated_trees, progress):
+        """
+            Initialization of the WriteCheckpoint object.
+
+            :param waiting:
+                The scheduler dictionnary of the commits that weren't updated
+                yet, with the number of parents they wait for.
+            :param ready:
+                The commits ready to be updated, the conflicting commit first.
+            :param updated_refs, updated_trees:
+                The commits that were already rewritten, with their new hexsha
+                and the hexsha of their tree.
+        """
+        self._modifications = snapshot_modifications(model)
+        self.start_commits = set(start_commits)
+        self.to_rewrite_count = to_rewrite_count
+        self._waiting = dict(waiting)
+        self._ready = list(ready)
+        self._updated_refs = dict(updated_refs)
+        self._updated_trees = dict(updated_trees)
+        self.progress = progress
+
+    def is_valid_for(self, model):
+        """
+            Returns True if the model wasn't modified since the checkpoint
+            (the conflict solutions may have been set).
+        """
+        return snapshot_modifications(model) == self._modifications
+
+    def restore(self):
+        """
+            Returns copies of the scheduler state and of the rewritten
+            commits: (waiting, ready, updated_refs, updated_trees).
+        """
+        return (dict(self._waiting), deque(self._ready),
+                dict(self._updated_refs), dict(self._updated_trees))
 
 
 class git_filter_rebase(Thread):
@@ -27,7 +144,8 @@ class git_filter_rebase(Thread):
     """
 
     def __init__(self, parent, log=True, force_committed_date=False,
-                 dont_populate=False):
+                 dont_populate=False, fast_import=False, workers=1,
+                 log_level=DEBUG, log_flush_interval=None):
         """
             Initialization of the GitFilterRebase thread.
 
@@ -35,6 +153,14 @@ class git_filter_rebase(Thread):
                 GitModel object, parent of this thread.
             :param log:
                 If set to True, the git commands will be logged.
+            :param log_level:
+                The level of the logged records (see the logging module). At
+                the DEBUG level, the output of the git commands is logged, at
+                the INFO level only the commands, their duration and exit code.
+            :param log_flush_interval:
+                If set, the log records are written every log_flush_interval
+                seconds by a background thread, rather than when the buffer is
+                full or when the process is over.
             :param force_committed_date:
                 As the git way updates the committed author/date when
                 cherry-picking, and since we offer to modify these values, we
@@ -43,41 +169,76 @@ class git_filter_rebase(Thread):
             :param dont_populate:
                 If set to True, this process won't repopulate the model after
                 the rewrite.
+            :param fast_import:
+                If set to True, the commits are written through a single git
+                fast-import stream rather than one git process per commit.
+            :param workers:
+                The number of workers picking the commits at the same time,
+                each one in its own worktree.
         """
         Thread.__init__(self)
 
-        self._start_commits = parent.get_start_write_from()
+        # If the last write stopped on a conflict, resume from it.
+        self._checkpoint = parent.get_write_checkpoint()
+        if self._checkpoint is not None and \
+           not self._checkpoint.is_valid_for(parent):
+            self._checkpoint = None
 
-        self._log = log
+        if self._checkpoint is not None:
+            self._start_commits = self._checkpoint.start_commits
+        else:
+            self._start_commits = parent.get_start_write_from()
+
+        self._logger = None
+        self._current = local()
         if log:
-            self._logfile = ".gitbuster_" + time.strftime("%d-%m-%Y.%H-%M")
+            logfile = ".gitbuster_" + time.strftime("%d-%m-%Y.%H-%M")
+            self._logger = BufferedLogger(os.path.join(parent._directory,
+                                                       logfile),
+                                          level=log_level,
+                                          flush_interval=log_flush_interval)
 
         self._force_committed_date = force_committed_date
         self._dont_populate = dont_populate
+        self._fast_import = fast_import
+        self._workers = workers
+        self._stream = None
         self._model = parent
         self._directory = parent._directory
         self._branch = parent._current_branch
 
-        self._to_rewrite_count = self._model.get_to_rewrite_count()
+        if self._checkpoint is not None:
+            self._to_rewrite_count = self._checkpoint.to_rewrite_count
+        else:
+            self._to_rewrite_count = self._model.get_to_rewrite_count()
+        self._metrics = WriteMetrics(self._to_rewrite_count)
         self._solutions = self._model.get_conflict_solutions()
 
         self._u_files = {}
         self._output = []
         self._errors = []
         self._updated_refs = {}
-        self._should_be_updated = []
+        self._updated_trees = {}
         self._last_updated_sha = None
         self._progress = None
         self._finished = False
+        self._cancel = Event()
+        self._cancelled = False
+        self._progress_callbacks = []
+        self._done_callbacks = []
         self._success = False
 
         if self._model.is_fake_model():
-            self._fallback_branch_name = Repo(self._directory).branches[0].name
+            a_repo = git.Repo(self._directory)
+            self._fallback_branch_name = a_repo.branches[0].name
         else:
             self._fallback_branch_name = self._branch.name
 
         if not self.model_is_applicable():
             raise GfbiException("Can't apply, the repository changed.")
+        if not self._model.is_fake_model() and is_dirty(self._directory):
+            raise GfbiException("Can't apply, the working tree has "
+                                "uncommitted changes.")
 
     def model_is_applicable(self):
         """
@@ -90,7 +251,7 @@ class git_filter_rebase(Thread):
             # No need to check fake models
             return True
 
-        a_repo = Repo(self._directory)
+        a_repo = git.Repo(self._directory)
         current_tip = a_repo.branches[self._branch.name].commit
         current_tip.hexsha
 
@@ -101,42 +262,57 @@ class git_filter_rebase(Thread):
         model_tip_hexsha = self._model.data(index)
         return current_tip.hexsha == model_tip_hexsha
 
-    def all_should_be_updated(self, updated_parents):
+    def log(self, message, level=INFO, **fields):
         """
-            Returns all the commits that should be updated, if the given commit
-            would be modified.
+            Logs a record, tagged with the commit being rewritten.
         """
-        should_be_updated = set()
-        for updated_parent in updated_parents:
-            for commit in self._model.c_data(updated_parent, "children"):
-                should_be_updated.add(commit)
-                should_be_updated.update(self.all_should_be_updated((commit,)))
-        return should_be_updated
-
-    def log(self, message):
-        if self._log:
-            handle = codecs.open(self._logfile, encoding='utf-8', mode='a')
-            log_stamp = unicode(time.strftime("[%d-%m-%Y %H:%M:%S] "))
-            handle.write(log_stamp + message.rstrip() + "\n")
-            handle.close()
-
-    def run_command(self, command):
-        self.log("Running: %s" % command.strip() + "\n")
-        output, errors = run_command(command)
-
-        for line in errors:
-            u_line = line.decode('utf-8')
-            self.log(u"STDERR: " + u_line + "\n")
+        if self._logger is not None:
+            fields.setdefault("commit", getattr(self._current, "commit", None))
+            self._logger.log(level, message.strip(), **fields)
 
-        for line in output:
-            u_line = line.decode('utf-8')
-            self.log(u"STDOUT: " + u_line + "\n")
+    def run_command(self, argv, cwd=None, env=None, input=None):
+        """
+            Runs a command and logs it, returns its output and errors as lists
+            of lines.
+
+            :param argv:
+                The list of the arguments of the command.
+            :param cwd:
+                The working tree in which we run the command. Defaults to the
+                directory of the repository.
+            :param env:
+                A dictionnary of environment variables for the command.
+            :param input:
+                The data written on the standard input of the command.
+        """
+        command = Command(argv, cwd or self._directory, env, input)
+        output, errors, status = command.run()
+
+        if self._logger is not None:
+            fields = {"command": decode(" ".join(command.argv)),
+                      "duration": command.duration,
+                      "exit_code": status}
+            if cwd is not None:
+                fields["cwd"] = cwd
+            stderr = [decode(line) for line in errors if line]
+            if stderr:
+                fields["stderr"] = stderr
+            self.log("Ran command", **fields)
+
+            if self._logger.is_enabled_for(DEBUG):
+                self.log("Command output", level=DEBUG,
+                         command=fields["command"],
+                         stdout=[decode(line) for line in output if line])
 
         return output, errors
 
-    def prepare_arguments(self, row):
-        commit_settings = ""
-        message = ""
+    def prepare_fields(self, row):
+        """
+            Returns the dictionnary of the environment variables (see
+            ENV_FIELDS) describing the commit at the given row, and its
+            message.
+        """
+        fields = {}
         columns = self._model.get_columns()
 
         for field in ACTOR_FIELDS:
@@ -145,8 +321,7 @@ class git_filter_rebase(Thread):
                 continue
 
             index = Index(row=row, column=columns.index(field))
-            value = self._model.data(index)
-            commit_settings = add_assign(commit_settings, field, value)
+            fields[ENV_FIELDS[field]] = self._model.data(index)
 
         for field in TIME_FIELDS:
             if "commit" in field and not self._force_committed_date:
@@ -155,43 +330,96 @@ class git_filter_rebase(Thread):
 
             index = Index(row=row, column=columns.index(field))
             _timestamp, _tz = self._model.data(index)
-            value = str(_timestamp) + " " + _tz.tzname(None)
-            commit_settings = add_assign(commit_settings, field, value)
+            fields[ENV_FIELDS[field]] = str(_timestamp) + " " + \
+                    _tz.tzname(None)
 
         field = "message"
         index = Index(row=row, column=columns.index(field))
         message = self._model.data(index)
 
-        return commit_settings, message
+        return fields, message
 
     def run(self):
         """
             Main method of the script. Launches the git command and
             logs if the option is set.
         """
-        os.chdir(self._directory)
         try:
             self.pick_and_commit()
+        except WriteCancelled:
+            self._cancelled = True
+            self.log("Write cancelled", level=WARNING)
         except Exception, e:
             self._errors.append(str(e))
+            self.log("Write failed: %s" % e, level=ERROR)
         finally:
             self.cleanup_repo()
+            if self._cancelled:
+                self.run_command(["git", "checkout", "-f",
+                                  self._fallback_branch_name])
+            self._metrics.finish()
+            self.log("Write summary", summary=self._metrics.summary())
+            if self._logger is not None:
+                self._logger.close()
         self._finished = True
 
+        for callback in self._done_callbacks:
+            callback(self)
+
+    def cancel(self):
+        """
+            Asks the process to stop. The commit being rewritten is finished,
+            then the original branch is checked out again and the repository
+            is left untouched.
+        """
+        self._cancel.set()
+
+    def check_cancelled(self):
+        """
+            Raises WriteCancelled if cancel() was called.
+        """
+        if self._cancel.is_set():
+            raise WriteCancelled("The write was cancelled.")
+
+    def is_cancelled(self):
+        """
+            Returns True if the process stopped because it was cancelled.
+        """
+        return self._cancelled
+
+    def add_progress_callback(self, callback):
+        """
+            The callback will be called with the progress, from the thread
+            of the process, every time a commit is rewritten.
+        """
+        self._progress_callbacks.append(callback)
+
+    def add_done_callback(self, callback):
+        """
+            The callback will be called with the process, from its thread,
+            when it is over. It should be added before starting the process.
+        """
+        self._done_callbacks.append(callback)
+
+    def notify_progress(self):
+        for callback in self._progress_callbacks:
+            callback(self._progress)
+
     def cleanup_repo(self):
         # Do some verifications before these cleanup steps.
-        a_repo = Repo(self._directory)
-        if a_repo.is_dirty():
-            self.run_command('git reset HEAD --hard')
+        if is_dirty(self._directory):
+            self.run_command(["git", "reset", "HEAD", "--hard"])
+        a_repo = git.Repo(self._directory)
 
         try:
             branches = [branch.name for branch in a_repo.branches]
 
             if 'gitbuster_rebase' in branches:
-                self.run_command('git checkout %s' % self._fallback_branch_name)
-                self.run_command('git branch -D gitbuster_rebase')
+                self.run_command(["git", "checkout",
+                                  self._fallback_branch_name])
+                self.run_command(["git", "branch", "-D", "gitbuster_rebase"])
         except TypeError:
-            self.run_command('git checkout %s' % self._fallback_branch_name)
+            self.run_command(["git", "checkout", self._fallback_branch_name])
 
     def ref_update(self, commit):
         """
@@ -200,6 +428,7 @@ class git_filter_rebase(Thread):
         model = self._model
 
         parents = model.c_data(commit, "parents")
+        self._current.commit = model.c_data(commit, "hexsha")
 
         if model.is_deleted(commit):
             # If the commit has been deleted, skip it
@@ -217,77 +446,440 @@ class git_filter_rebase(Thread):
 
             return True
 
-        if len(parents) != 1:
-            # This is a merge
-            for parent in parents:
-                if parent in self._should_be_updated and \
-                   parent not in self._updated_refs:
-                    # Meaning one of the parent branches of the merge hasn't
-                    # been rewritten yet => skip for now
-                    return True
-
         # The following will be useful to query the model
         commit_row = model.row_of(commit)
 
-        # Here the parent should be the one defined in the mode (we should call
-        # data()). Otherwise, we won't be able to insert or delete commits.
-        _parent = parents[0]
-        if _parent in self._updated_refs:
-            _parent_sha = self._updated_refs[_parent]
-        else:
-            _parent_sha = self._model.c_data(_parent, "hexsha")
-
-        self.run_command("git checkout -f %s" % _parent_sha)
+        new_parents = []
+        for parent in parents:
+            if parent in self._updated_refs:
+                new_parents.append(self._updated_refs[parent])
+            else:
+                new_parents.append(self._model.c_data(parent, "hexsha"))
+
+        if self._stream is not None:
+            with self._metrics.phase("fast-import"):
+                new_sha = self.stream_commit(commit, commit_row, parents,
+                                             new_parents)
+                self._last_updated_sha = new_sha
+                self._updated_refs[commit] = new_sha
+                self._progress = float(self._stream.progress()) / \
+                        self._to_rewrite_count
+            self._metrics.commit_done()
+            self.notify_progress()
+            return True
 
         to_pick_hexsha = model.c_data(commit, "hexsha")
-        if len(parents) == 1:
+        new_tree = self.reusable_tree(commit, parents)
+        if new_tree is None:
+            new_tree = self.pick_tree(to_pick_hexsha, len(parents),
+                                      new_parents[0],
+                                      solutions=self._solutions.get(commit))
+            if new_tree is None:
+                # There is an unsolved conflict
+                model.set_conflicting_commit(commit_row)
+                # Find out what were the hexsha of the conflicting commit
+                # and of it's parent, in order to find the diff.
+                with self._metrics.phase("conflict"):
+                    self.process_unmerged_state(new_parents[0])
+                self.cleanup_repo()
+                return False
+
+        fields, message = self.prepare_fields(commit_row)
+        new_sha = self.commit_tree(fields, message, new_tree, new_parents)
+        self.set_updated(commit, new_sha, new_tree)
+
+        return True
+
+    def set_updated(self, commit, new_sha, new_tree):
+        """
+            Records that the given commit has been rewritten.
+        """
+        self._last_updated_sha = new_sha
+        self._updated_refs[commit] = new_sha
+        self._updated_trees[commit] = new_tree
+
+        self._progress += 1. / self._to_rewrite_count
+        self._metrics.commit_done()
+        self.notify_progress()
+
+    def commit_tree(self, fields, message, new_tree, new_parents, cwd=None):
+        """
+            Creates the commit object and returns its hexsha.
+
+            :param fields:
+                The environment variables returned by prepare_fields().
+            :param message:
+                The commit message, given on the standard input.
+            :param cwd:
+                The working tree in which we run the command. Defaults to the
+                directory of the repository.
+        """
+        command = ["git", "commit-tree", new_tree]
+        for _parent in new_parents:
+            command += ["-p", _parent]
+
+        with self._metrics.phase("commit-tree"):
+            output, errors = self.run_command(command, cwd, env=fields,
+                                              input=message)
+        return output[0].strip()
+
+    def stream_commit(self, commit, commit_row, parents, new_parents):
+        """
+            Writes the rewritten commit to the fast-import stream and returns
+            its mark. The tree is either the original one, or the first parent
+            tree on which we apply the changes introduced by the commit.
+
+            Raises FastImportUnsupported if applying the changes would need a
+            real merge.
+        """
+        fields, message = self.prepare_fields(commit_row)
+
+        tree = self.reusable_tree(commit, parents)
+        operations = []
+        if tree is None:
+            if not parents:
+                raise FastImportUnsupported("Can't rewrite a root commit.")
+
+            to_pick_hexsha = self._model.c_data(commit, "hexsha")
+            changes = diff_operations(to_pick_hexsha + "^", to_pick_hexsha,
+                                      self._directory)
+            for src_mode, src_hexsha, dst_mode, dst_hexsha, path in changes:
+                entry = self._stream.ls(new_parents[0], path)
+                if src_hexsha is None:
+                    expected = None
+                else:
+                    expected = (src_mode, src_hexsha)
+
+                if entry != expected:
+                    raise FastImportUnsupported("%s needs a merge to apply "
+                                                "on its new parent." % path)
+                operations.append((dst_mode, dst_hexsha, path))
+
+        mark = self._stream.commit(fields, message, new_parents, tree=tree,
+                                   operations=operations)
+
+        if tree is None:
+            mode, tree = self._stream.ls(mark, "")
+        self._updated_trees[commit] = tree
+
+        return mark
+
+    def tree_of(self, commit):
+        """
+            Returns the hexsha of the tree the given commit has (or will have)
+            once the rewrite is done.
+        """
+        if commit in self._updated_trees:
+            return self._updated_trees[commit]
+        if isinstance(commit, DummyCommit):
+            # This inserted commit wasn't written
+            return None
+        return self._model.orig_c_data(commit, "tree").hexsha
+
+    def reusable_tree(self, commit, parents):
+        """
+            Returns the hexsha of the original tree of the commit if it is
+            still valid for the rewritten commit, None otherwise.
+
+            Cherry-picking a commit onto a tree that is the same as the tree of
+            its original first parent rebuilds the original tree of the commit.
+            This is the case when only metadata (names, dates, messages) has
+            been modified upstream, so we can skip the checkout and the
+            cherry-pick.
+
+            :param commit:
+                The commit that is about to be rewritten.
+            :param parents:
+                The parents of the commit, as defined in the model.
+        """
+        if isinstance(commit, DummyCommit):
+            # Inserted commits don't have an original tree
+            return None
+
+        orig_parents = self._model.orig_c_data(commit, "parents")
+        if not orig_parents or not parents:
+            if orig_parents or parents:
+                # The commit was turned into a root commit, or the other way
+                return None
+        elif self.tree_of(parents[0]) != orig_parents[0].tree.hexsha:
+            return None
+
+        return self._model.orig_c_data(commit, "tree").hexsha
+
+    def pick_tree(self, to_pick_hexsha, parents_count, parent_sha, cwd=None,
+                  solutions=None):
+        """
+            Checks out the rewritten first parent of the commit, cherry-picks
+            the commit on top of it and returns the hexsha of the resulting
+            tree. Returns None if there is an unsolved conflict, leaving the
+            working tree in the unmerged state.
+
+            :param to_pick_hexsha:
+                The hexsha of the commit we cherry-pick.
+            :param parents_count:
+                The number of parents of the commit.
+            :param parent_sha:
+                The hexsha of the rewritten first parent. Here the parent
+                should be the one defined in the model (we should call data()).
+                Otherwise, we won't be able to insert or delete commits.
+            :param cwd:
+                The working tree in which we pick the commit. Defaults to the
+                directory of the repository.
+            :param solutions:
+                The solutions to apply if there is a conflict (see
+                EditableGitModel.set_conflict_solutions), or None.
+        """
+        with self._metrics.phase("checkout"):
+            self.run_command(["git", "checkout", "-f", parent_sha], cwd)
+
+        if parents_count == 1:
             # This is not a merge
-            pick_command = "git cherry-pick -n %s" % to_pick_hexsha
+            pick_command = ["git", "cherry-pick", "-n", to_pick_hexsha]
         else:
             # This is a merge
-            pick_command = "git cherry-pick -n -m 1 %s" % to_pick_hexsha
+            pick_command = ["git", "cherry-pick", "-n", "-m", "1",
+                            to_pick_hexsha]
 
-        output, errors = self.run_command(pick_command)
+        with self._metrics.phase("cherry-pick"):
+            output, errors = self.run_command(pick_command, cwd)
         if [line for line in errors if "error: could not apply" in line]:
             # We have a merge conflict.
-            model.set_conflicting_commit(commit_row)
-            commit = model.get_conflicting_commit()
-            if commit in self._solutions:
-                apply_solutions(self._solutions[commit])
-            else:
-                # Find out what were the hexsha of the conflicting commit
-                # and of it's parent, in order to find the diff.
-                self.process_unmerged_state(_parent_sha)
-                self.cleanup_repo()
+            if solutions is None:
+                return None
+            with self._metrics.phase("conflict"):
+                apply_solutions(solutions, cwd or self._directory)
+
+        with self._metrics.phase("write-tree"):
+            output, errors = self.run_command(["git", "write-tree"], cwd)
+        return output[0].strip()
+
+    def start_rewrite(self):
+        """
+            Resets the state of the rewrite, or restores it from the
+            checkpoint, and returns the scheduler state: (waiting, ready).
+        """
+        self._last_updated_sha = None
+
+        if self._checkpoint is not None:
+            waiting, ready, self._updated_refs, self._updated_trees = \
+                    self._checkpoint.restore()
+            self._progress = self._checkpoint.progress
+            self._metrics.restart(max(self._to_rewrite_count -
+                                      len(self._updated_refs), 0))
+            self.log("Resuming from the checkpoint, %d commits already "
+                     "rewritten" % len(self._updated_refs))
+            return waiting, ready
+
+        self._metrics.restart()
+        self._updated_refs = {}
+        self._updated_trees = {}
+        self._progress = 0
+
+        waiting = schedule(self._model, self._start_commits)
+        return waiting, ready_commits(self._model, waiting)
+
+    def save_checkpoint(self, waiting, ready):
+        """
+            Stores the state of the rewrite in the model, so that the next
+            write resumes from here.
+
+            :param ready:
+                The commits ready to be updated, the conflicting commit first.
+        """
+        checkpoint = WriteCheckpoint(self._model, self._start_commits,
+                                     self._to_rewrite_count, waiting, ready,
+                                     self._updated_refs, self._updated_trees,
+                                     self._progress)
+        self._model.set_write_checkpoint(checkpoint)
+
+    def rewrite(self):
+        """
+            Rewrites the commits, starting from the commits returned by
+            get_start_write_from(). Returns False if there is a conflict.
+
+            Every commit is updated once, when all of its parents that should
+            be updated have been.
+        """
+        waiting, ready = self.start_rewrite()
+        while ready:
+            self.check_cancelled()
+            commit = ready.popleft()
+            if not self.ref_update(commit):
+                # There is a conflict
+                ready.appendleft(commit)
+                self.save_checkpoint(waiting, ready)
                 return False
 
-        output, errors = self.run_command("git write-tree")
-        new_tree = output[0].strip()
+            release_children(self._model, commit, waiting, ready)
+
+        return True
+
+    def parallel_rewrite(self):
+        """
+            Same as rewrite(), but the commits are written by a pool of
+            workers, each one in its own worktree. This way, the lines of
+            development that don't depend on each other are rewritten at the
+            same time.
+
+            If a worker hits an unsolved conflict, we wait for the other
+            workers and pick the conflicting commit again in the main working
+            tree, so that the unmerged state is processed as usual.
+        """
+        model = self._model
+        waiting, ready = self.start_rewrite()
+
+        tasks = Queue()
+        results = Queue()
+        worktrees = self.add_worktrees()
+        for worktree in worktrees:
+            worker = Thread(target=self.pick_worker,
+                            args=(worktree, tasks, results))
+            worker.setDaemon(True)
+            worker.start()
+
+        in_flight = 0
+        conflicts = []
+        error = None
+        try:
+            while in_flight or (error is None and (ready or conflicts)):
+                while ready and not conflicts and error is None:
+                    if self._cancel.is_set():
+                        # Wait for the commits in flight, then stop
+                        error = WriteCancelled("The write was cancelled.")
+                        break
+                    commit = ready.popleft()
+                    if model.is_deleted(commit):
+                        self.ref_update(commit)
+                        continue
+
+                    tasks.put(self.prepare_task(commit))
+                    in_flight += 1
+
+                if not in_flight:
+                    if conflicts and error is None:
+                        # Everything else is done, pick the conflicting commit
+                        # in the main working tree.
+                        commit = conflicts.pop()
+                        if not self.ref_update(commit):
+                            ready.extendleft(conflicts + [commit])
+                            self.save_checkpoint(waiting, ready)
+                            return False
+                        release_children(self._model, commit, waiting, ready)
+                    continue
+
+                commit, new_sha, new_tree = results.get()
+                in_flight -= 1
+                if isinstance(new_sha, Exception):
+                    error = new_sha
+                elif new_tree is None:
+                    conflicts.append(commit)
+                else:
+                    self.set_updated(commit, new_sha, new_tree)
+                    release_children(self._model, commit, waiting, ready)
+
+            if error is not None:
+                raise error
+        finally:
+            for worktree in worktrees:
+                tasks.put(None)
+            self.remove_worktrees(worktrees)
 
-        parent_string = ""
+        return True
+
+    def prepare_task(self, commit):
+        """
+            Returns everything a worker needs to write the given commit,
+            whose parents are already updated.
+        """
+        model = self._model
+
+        parents = model.c_data(commit, "parents")
+        new_parents = []
         for parent in parents:
             if parent in self._updated_refs:
-                _parent = self._updated_refs[parent]
+                new_parents.append(self._updated_refs[parent])
             else:
-                _parent = self._model.c_data(parent, "hexsha")
-
-            parent_string += "-p %s " % _parent
+                new_parents.append(model.c_data(parent, "hexsha"))
 
-        FIELDS, MESSAGE = self.prepare_arguments(commit_row)
-        with open("tmp_message", "w") as handle:
-            handle.write(MESSAGE)
-
-        output, errors = self.run_command(FIELDS +
-                                        "git commit-tree %s %s < tmp_message" %
-                                        (new_tree, parent_string))
-        new_sha = output[0].strip()
-        self._last_updated_sha = new_sha
-        self._updated_refs[commit] = new_sha
+        to_pick_hexsha = model.c_data(commit, "hexsha")
+        fields, message = self.prepare_fields(model.row_of(commit))
+        return (commit, to_pick_hexsha, len(parents), new_parents,
+                self.reusable_tree(commit, parents), fields, message,
+                self._solutions.get(commit))
 
-        self._progress += 1. / self._to_rewrite_count
-        for _commit in self._model.c_data(commit, "children"):
-            if not self.ref_update(_commit):
-                return False
+    def pick_worker(self, worktree, tasks, results):
+        """
+            Writes the commits given in the tasks queue in the given worktree,
+            until it gets None. The results queue gets (commit, new_sha,
+            new_tree) tuples, new_tree being None if there is a conflict.
+        """
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            commit, to_pick_hexsha, parents_count, new_parents, new_tree, \
+                    fields, message, solutions = task
+            self._current.commit = to_pick_hexsha
+            try:
+                if new_tree is None:
+                    new_tree = self.pick_tree(to_pick_hexsha, parents_count,
+                                              new_parents[0], worktree,
+                                              solutions)
+                new_sha = None
+                if new_tree is not None:
+                    new_sha = self.commit_tree(fields, message, new_tree,
+                                               new_parents, worktree)
+                results.put((commit, new_sha, new_tree))
+            except Exception, err:
+                results.put((commit, err, None))
+
+    def add_worktrees(self):
+        """
+            Adds a detached worktree for each worker, and returns their paths.
+        """
+        worktrees = []
+        for worker in xrange(self._workers):
+            worktree = mkdtemp(prefix=".gitbuster_worktree")
+            self.run_command(["git", "worktree", "add", "--detach", worktree,
+                              "HEAD"])
+            worktrees.append(worktree)
+        return worktrees
+
+    def remove_worktrees(self, worktrees):
+        for worktree in worktrees:
+            self.run_command(["git", "worktree", "remove", "--force",
+                              worktree])
+        self.run_command(["git", "worktree", "prune"])
+
+    def stream_rewrite(self):
+        """
+            Rewrites the commits through a single git fast-import stream. If
+            one of the commits needs a real merge, fall back on rewrite().
+        """
+        self.log("Starting git fast-import")
+        self._stream = FastImportStream(self._directory, log=self.log)
+        try:
+            self.rewrite()
+        except FastImportUnsupported, err:
+            self.log("Falling back to cherry-picking: %s" % err,
+                     level=WARNING)
+            self._stream.abort()
+            self._stream = None
+            return self.rewrite()
+        except:
+            self._stream.abort()
+            self._stream = None
+            raise
+
+        marks = self._stream.close()
+        self._stream = None
+
+        for commit, mark in self._updated_refs.items():
+            # Commits restored from a checkpoint already have a hexsha
+            self._updated_refs[commit] = marks.get(mark, mark)
+        self._last_updated_sha = marks.get(self._last_updated_sha,
+                                           self._last_updated_sha)
 
         return True
 
@@ -295,22 +887,28 @@ class git_filter_rebase(Thread):
         """
             This is the method that actually does the rebasing.
         """
-        self._should_be_updated = self.all_should_be_updated(self._start_commits)
+        if self._fast_import:
+            rewritten = self.stream_rewrite()
+        elif self._workers > 1:
+            rewritten = self.parallel_rewrite()
+        else:
+            rewritten = self.rewrite()
 
-        self._progress = 0
-        for commit in self._start_commits:
-            if not self.ref_update(commit):
-                # There is a conflict
-                return False
+        self._current.commit = None
+        if not rewritten:
+            # There is a conflict
+            return False
+        self._model.set_write_checkpoint(None)
 
         # Update other references (as branches, tags)
         if self._last_updated_sha is None:
             self._errors.append("Error: No commit was updated.")
             return False
 
-        command = "git update-ref refs/heads/gitbuster_rebase %s"
-        self.run_command(command % self._last_updated_sha)
-        output, errors = self.run_command("git checkout gitbuster_rebase")
+        if not self.update_refs():
+            return False
+        output, errors = self.run_command(["git", "checkout",
+                                           "gitbuster_rebase"])
 
         if "error: pathspec 'gitbuster_rebase' did not match" in errors[0]:
             # Something, somewhere, went very wrong.
@@ -322,11 +920,11 @@ class git_filter_rebase(Thread):
         if self._model.is_name_modified():
             # The model may be fake
             new_branch_name = self._model.get_new_branch_name()
-            self.run_command('git branch -M %s' % new_branch_name)
+            self.run_command(["git", "branch", "-M", new_branch_name])
             if not self._model.is_fake_model():
-                self.run_command('git branch -D %s' % self._branch.name)
+                self.run_command(["git", "branch", "-D", self._branch.name])
 
-            branches = Repo(self._directory).branches
+            branches = git.Repo(self._directory).branches
             new_branch = [branch for branch in branches
                           if branch.name == new_branch_name][0]
             self._model.set_current_branch(new_branch, force=True)
@@ -336,12 +934,122 @@ class git_filter_rebase(Thread):
             # after the creation.
             self._branch = new_branch
         else:
-            self.run_command('git branch -M %s' % self._branch.name)
+            self.run_command(["git", "branch", "-M", self._branch.name])
 
+        self._model.set_commit_map(self.commit_map())
         if not self._dont_populate:
-            self._model.populate()
+            self._model.apply_commit_map(self._updated_refs)
         self._success = True
 
+    def rewritten_hexsha(self, commit):
+        """
+            Returns the hexsha of the given commit after the rewrite. A deleted
+            commit is replaced by its first parent. Returns None if the commit
+            and all its first parents were deleted.
+        """
+        model = self._model
+        while model.is_deleted(commit):
+            parents = model.c_data(commit, "parents")
+            if not parents:
+                return None
+            commit = parents[0]
+
+        if commit in self._updated_refs:
+            return self._updated_refs[commit]
+        return model.c_data(commit, "hexsha")
+
+    def update_refs(self):
+        """
+            Moves the gitbuster_rebase branch to the rewritten tip of the
+            model and, if the model has other references, moves them to
+            their rewritten commits. Annotated tags are re-created on the new
+            commits. Everything is done in a single git update-ref
+            transaction, so either all the references move or none.
+        """
+        model = self._model
+
+        head = self._last_updated_sha
+        if model.get_refs():
+            head = self.rewritten_hexsha(model.get_commits()[0])
+        commands = ["update %s %s" % (FAST_IMPORT_REF, head)]
+
+        if model.get_refs():
+            commits = dict((commit.hexsha, commit)
+                           for commit in model.get_commits()
+                           if not isinstance(commit, DummyCommit))
+            skipped = (FAST_IMPORT_REF, "refs/heads/%s" % self._branch.name)
+
+            for refname, hexsha, object_type, target_hexsha, target_type in \
+                    list_refs(model.get_refs(), self._directory):
+                if refname in skipped:
+                    continue
+
+                if object_type == "commit":
+                    target_hexsha = hexsha
+                elif target_type != "commit":
+                    continue
+
+                if target_hexsha not in commits:
+                    continue
+                new_hexsha = self.rewritten_hexsha(commits[target_hexsha])
+                if new_hexsha is None:
+                    self.log("Not moving %s, its history was deleted" %
+                             refname, level=WARNING)
+                    continue
+                if new_hexsha == target_hexsha:
+                    continue
+
+                if object_type == "tag":
+                    new_hexsha = self.rewrite_tag(hexsha, new_hexsha)
+                commands.append("update %s %s %s" % (refname, new_hexsha,
+                                                     hexsha))
+
+        output, errors = self.run_command(["git", "update-ref", "--stdin"],
+                                          input="\n".join(commands) + "\n")
+
+        if errors[0]:
+            self._errors.append("Error: Couldn't update the references: " +
+                                errors[0])
+            return False
+        return True
+
+    def rewrite_tag(self, tag_hexsha, new_hexsha):
+        """
+            Writes a copy of the given annotated tag, pointing to the new
+            commit, and returns its hexsha. The signature of the tag, that
+            would be invalid, is dropped.
+        """
+        output, errors = self.run_command(["git", "cat-file", "tag",
+                                           tag_hexsha])
+        content = "\n".join(output)
+        header, message = content.split("\n\n", 1)
+        header = header.split("\n")
+        header[0] = "object %s" % new_hexsha
+        signature = message.find("-----BEGIN PGP SIGNATURE-----")
+        if signature != -1:
+            message = message[:signature]
+
+        output, errors = self.run_command(["git", "hash-object", "-t", "tag",
+                                           "-w", "--stdin"],
+                                          input="\n".join(header) + "\n\n" +
+                                                message)
+        return output[0].strip()
+
+    def commit_map(self):
+        """
+            Returns the dictionnary of the hexshas of the rewritten commits
+            and their new hexsha. Deleted commits are mapped to None.
+        """
+        model = self._model
+        commit_map = {}
+        for commit, new_hexsha in self._updated_refs.items():
+            if not isinstance(commit, DummyCommit):
+                commit_map[commit.hexsha] = new_hexsha
+        for commit in model.get_deleted_commits():
+            if not isinstance(commit, DummyCommit):
+                commit_map[commit.hexsha] = None
+        return commit_map
+
     def process_unmerged_state(self, orig_hexsha):
         """
             Process the current unmerged state and inform the model about
@@ -360,6 +1068,15 @@ class git_filter_rebase(Thread):
         """
         return self._progress
 
+    def metrics(self):
+        """
+            Returns the summary of the write metrics: the number of rewritten
+            commits, the number of commits per second, the ETA and the
+            durations of the checkout, cherry-pick, write-tree, commit-tree
+            and conflict handling phases. See WriteMetrics.summary().
+        """
+        return self._metrics.summary()
+
     def output(self):
         """
             Returns the output as a list of lines
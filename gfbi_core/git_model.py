@@ -5,12 +5,17 @@
 # License: http://www.gnu.org/licenses/gpl-3.0.txt
 
 import sys
-from git import Repo
-from git.objects.util import altz_to_utctz_str
+from contextlib import contextmanager
 
 from gfbi_core.util import Timezone, DummyCommit, DummyBranch, GfbiException, \
-                           Index
-from gfbi_core import ACTOR_FIELDS, TIME_FIELDS
+                           Index, list_refs, LazyModule
+from gfbi_core.instrumentation import Instrumentation
+from gfbi_core.memory import footprint
+from gfbi_core import ACTOR_FIELDS, TIME_FIELDS, GITPYTHON_HINT
+
+git = LazyModule("git", GITPYTHON_HINT)
+git_util = LazyModule("git.util", GITPYTHON_HINT)
+objects_util = LazyModule("git.objects.util", GITPYTHON_HINT)
 
 
 class GitModel:
@@ -21,14 +26,20 @@ class GitModel:
     """
 
     def __init__(self, directory=".", fake_branch_name="", from_commits=False,
-                 remote_ref=None):
+                 remote_ref=None, refs=None):
         """
             Initializes the model with the repository root directory.
 
             :param directory:
                 Root directory of the git repository.
+            :param refs:
+                Other references (full names or prefixes as "refs/tags")
+                whose history is modelized along with the current branch.
+                Their commits come after the commits of the branch, and the
+                references are moved when the model is written.
         """
         self._directory = directory
+        self._refs = list(refs or [])
 
         self._remote_ref = False
         self._current_branch = None
@@ -45,11 +56,11 @@ class GitModel:
             self._from_commits = from_commits
         elif remote_ref:
             # This is a model on a remote repository
-            self._repo = Repo(directory)
+            self._repo = git.Repo(directory)
             self._remote_ref = remote_ref
             self._current_branch = False
         else:
-            self._repo = Repo(directory)
+            self._repo = git.Repo(directory)
             self._current_branch = self._repo.active_branch
 
         self._columns = ['hexsha',
@@ -60,10 +71,12 @@ class GitModel:
 
         self._changed_branch_once = False
         self._commits = []
+        self._rows = {}
         self._unpushed = []
         self._children = {}
 
         self._old_branch_name = ""
+        self._instrumentation = None
 
     def is_fake_model(self):
         return isinstance(self._current_branch, DummyBranch)
@@ -115,6 +128,38 @@ class GitModel:
             if not pushed:
                 self._unpushed.append(commit)
 
+        if self._refs:
+            self.populate_refs(branch_rev)
+
+    def populate_refs(self, branch_rev):
+        """
+            Appends the commits reachable from the other references of the
+            model, that aren't in the history of the current branch.
+        """
+        revs = set()
+        for refname, hexsha, object_type, target_hexsha, target_type in \
+                list_refs(self._refs, self._directory):
+            if object_type == "commit":
+                revs.add(hexsha)
+            elif target_type == "commit":
+                revs.add(target_hexsha)
+
+        if not revs:
+            return
+
+        revs = list(revs) + ["^" + branch_rev.hexsha]
+        for commit in self._repo.iter_commits(rev=revs):
+            self._commits.append(commit)
+            self._unpushed.append(commit)
+            for parent in commit.parents:
+                self._children.setdefault(parent, []).append(commit)
+
+    def get_refs(self):
+        """
+            Returns the other references modelized with the current branch.
+        """
+        return self._refs
+
     def is_commit_pushed(self, commit):
         """
             Returns True if the commit has been pushed to the remote branch.
@@ -164,7 +209,7 @@ class GitModel:
         if self.is_fake_model():
             # This is the moment after we wrote the model, the model is getting
             # real (not fake).
-            self._repo = Repo(self._directory)
+            self._repo = git.Repo(self._directory)
 
         self._current_branch = branch
         self._changed_branch_once = True
@@ -221,11 +266,13 @@ class GitModel:
         if field in TIME_FIELDS:
             if field == 'authored_date':
                 _timestamp = commit.authored_date
-                _utc_offset = altz_to_utctz_str(commit.author_tz_offset)
+                _utc_offset = objects_util.altz_to_utctz_str(
+                                                    commit.author_tz_offset)
                 _tz = Timezone(_utc_offset)
             elif field == 'committed_date':
                 _timestamp = commit.committed_date
-                _utc_offset = altz_to_utctz_str(commit.committer_tz_offset)
+                _utc_offset = objects_util.altz_to_utctz_str(
+                                                    commit.committer_tz_offset)
                 _tz = Timezone(_utc_offset)
             value = (_timestamp, _tz)
         elif field in ACTOR_FIELDS:
@@ -249,7 +296,21 @@ class GitModel:
         return value
 
     def row_of(self, commit):
-        return self._commits.index(commit)
+        """
+            Returns the row of the given commit. The rows are cached, the cache
+            is rebuilt when the commit isn't at the cached row anymore.
+        """
+        row = self._rows.get(commit)
+        if row is None or row >= len(self._commits) or \
+           self._commits[row] != commit:
+            if self._instrumentation is not None:
+                self._instrumentation.cache_miss("row_of")
+            self._rows = dict((_commit, _row)
+                              for _row, _commit in enumerate(self._commits))
+            row = self._rows.get(commit)
+            if row is None:
+                raise ValueError("%s is not in the model" % commit)
+        return row
 
     def get_old_branch_name(self):
         """
@@ -263,3 +324,79 @@ class GitModel:
             First commit is the last of _commits.
         """
         return index.row() == len(self._commits) - 1
+
+    def enable_instrumentation(self):
+        """
+            Starts counting and timing the calls of the hot methods of the
+            model (see gfbi_core.instrumentation), and returns the
+            Instrumentation object, whose report() can be read at any time.
+        """
+        if self._instrumentation is None:
+            Instrumentation(self).install()
+        return self._instrumentation
+
+    def disable_instrumentation(self):
+        """
+            Stops the instrumentation, the model runs its plain methods again.
+        """
+        if self._instrumentation is not None:
+            self._instrumentation.uninstall()
+
+    def get_instrumentation(self):
+        """
+            Returns the Instrumentation object, or None if it isn't enabled.
+        """
+        return self._instrumentation
+
+    @contextmanager
+    def instrumented(self):
+        """
+            Context manager instrumenting the model for the enclosed block
+            only. It yields a dictionnary that is filled with the report of the
+            block when it exits:
+
+                with model.instrumented() as report:
+                    model.data(index)
+                print report["data"]["calls"]
+        """
+        previous = self._instrumentation
+        if previous is not None:
+            previous.uninstall()
+
+        instrumentation = Instrumentation(self)
+        instrumentation.install()
+        report = {}
+        try:
+            yield report
+        finally:
+            instrumentation.uninstall()
+            report.update(instrumentation.report())
+            if previous is not None:
+                previous.install()
+
+    def memory_categories(self):
+        """
+            Returns the (name, object) tuples whose size is reported by
+            memory_footprint().
+        """
+        return [("commits", self._commits),
+                ("children", self._children),
+                ("unpushed", self._unpushed),
+                ("caches", self._rows)]
+
+    def memory_ignored(self):
+        """
+            Returns the objects that memory_footprint() doesn't count, since
+            the model doesn't own them: mainly the repository objects that
+            the GitPython commits refer to.
+        """
+        return [self, self._repo, self._current_branch]
+
+    def memory_footprint(self):
+        """
+            Returns an approximate breakdown of the memory used by the model,
+            as a dictionnary of numbers of bytes by category (see
+            memory_categories), and their "total". The objects shared by
+            several categories are counted in the first one.
+        """
+        return footprint(self.memory_categories(), self.memory_ignored())
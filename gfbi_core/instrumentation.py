@@ -0,0 +1,134 @@
+# instrumentation.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from threading import Lock
+import time
+
+# The methods of the models that are counted and timed.
+INSTRUMENTED_METHODS = ("data", "orig_data", "modified_data", "is_modified",
+                        "row_of", "c_data", "orig_c_data",
+                        "get_start_write_from", "all_children")
+# The methods that have a cache, and report their cache misses.
+CACHED_METHODS = ("row_of", "get_start_write_from", "all_children")
+
+
+class Instrumentation:
+    """
+        Counts the calls of the hot methods of a model, their cumulative time
+        and the hit rate of their caches.
+
+        The methods are only wrapped while the instrumentation is installed,
+        as attributes of the model instance, so that a model that isn't
+        instrumented runs the plain methods. The cached methods only check
+        the instrumentation of the model when they miss their cache.
+    """
+
+    def __init__(self, model):
+        """
+            Initialization of the Instrumentation.
+
+            :param model:
+                The GitModel or EditableGitModel to instrument.
+        """
+        self._model = model
+        self._lock = Lock()
+        self._installed = False
+        self.reset()
+
+    def reset(self):
+        """
+            Sets the counters back to zero.
+        """
+        self._lock.acquire()
+        try:
+            # For each method, [calls, cumulative time, cache misses]
+            self._counters = dict((name, [0, 0., 0])
+                                  for name in INSTRUMENTED_METHODS)
+        finally:
+            self._lock.release()
+
+    def install(self):
+        """
+            Wraps the methods of the model.
+        """
+        if self._installed:
+            return
+        for name in INSTRUMENTED_METHODS:
+            method = getattr(self._model, name, None)
+            if method is not None:
+                setattr(self._model, name, self._wrap(name, method))
+        self._model._instrumentation = self
+        self._installed = True
+
+    def uninstall(self):
+        """
+            Gives the model its plain methods back.
+        """
+        if not self._installed:
+            return
+        for name in INSTRUMENTED_METHODS:
+            self._model.__dict__.pop(name, None)
+        self._model._instrumentation = None
+        self._installed = False
+
+    def _wrap(self, name, method):
+        counters = self._counters
+        lock = self._lock
+
+        def instrumented(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                duration = time.time() - start
+                lock.acquire()
+                try:
+                    counter = counters[name]
+                    counter[0] += 1
+                    counter[1] += duration
+                finally:
+                    lock.release()
+
+        instrumented.__name__ = name
+        instrumented.__doc__ = method.__doc__
+        return instrumented
+
+    def cache_miss(self, name):
+        """
+            Called by the cached methods when they miss their cache.
+        """
+        self._lock.acquire()
+        try:
+            self._counters[name][2] += 1
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """
+            Returns a dictionnary with, for every method that was called, the
+            number of calls, the cumulative time (including the time spent in
+            the other instrumented methods it calls), the average time, and
+            for the cached methods, the number of misses and the hit rate.
+        """
+        self._lock.acquire()
+        try:
+            counters = dict((name, list(counter))
+                            for name, counter in self._counters.items())
+        finally:
+            self._lock.release()
+
+        report = {}
+        for name, (calls, duration, misses) in counters.items():
+            if not calls:
+                continue
+            entry = {"calls": calls,
+                     "time": duration,
+                     "average": duration / calls}
+            if name in CACHED_METHODS:
+                entry["misses"] = misses
+                entry["hit_rate"] = float(calls - misses) / calls
+            report[name] = entry
+        return report
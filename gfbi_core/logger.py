@@ -0,0 +1,135 @@
+# logger.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from threading import Thread, Lock, Event
+from logging import DEBUG, INFO, WARNING, ERROR, getLevelName
+import json
+import time
+
+
+class BufferedLogger:
+    """
+        Logs structured records as JSON lines. The records are kept in memory
+        and written when the buffer is full, when flush() is called, or
+        periodically by a background thread.
+    """
+
+    def __init__(self, path, level=DEBUG, buffer_size=1000,
+                 flush_interval=None):
+        """
+            Initialization of the BufferedLogger.
+
+            :param path:
+                The path of the log file. Records are appended.
+            :param level:
+                Records with a lower level (see the logging module levels) are
+                dropped without being formatted.
+            :param buffer_size:
+                The number of records kept in memory before writing them.
+            :param flush_interval:
+                If set, a background thread flushes the buffer every
+                flush_interval seconds.
+        """
+        self._path = path
+        self._level = level
+        self._buffer_size = buffer_size
+        self._buffer = []
+        self._lock = Lock()
+        self._closed = Event()
+
+        self._flusher = None
+        if flush_interval:
+            self._flusher = Thread(target=self.flush_periodically,
+                                   args=(flush_interval,))
+            self._flusher.setDaemon(True)
+            self._flusher.start()
+
+    def is_enabled_for(self, level):
+        """
+            Returns True if records of the given level are logged.
+        """
+        return level >= self._level
+
+    def log(self, level, message, **fields):
+        """
+            Logs a record.
+
+            :param level:
+                The level of the record, as the logging module levels.
+            :param message:
+                A short description of the record.
+            :param fields:
+                Any other information (commit, command, duration, exit_code,
+                ...) stored in the record.
+        """
+        if level < self._level:
+            return
+
+        record = {"time": time.time(),
+                  "level": getLevelName(level),
+                  "message": decode(message)}
+        record.update(fields)
+
+        self._lock.acquire()
+        try:
+            self._buffer.append(record)
+            full = len(self._buffer) >= self._buffer_size
+        finally:
+            self._lock.release()
+
+        if full:
+            self.flush()
+
+    def debug(self, message, **fields):
+        self.log(DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(ERROR, message, **fields)
+
+    def flush(self):
+        """
+            Writes the buffered records to the log file.
+        """
+        self._lock.acquire()
+        try:
+            records, self._buffer = self._buffer, []
+            if records:
+                handle = open(self._path, "a")
+                for record in records:
+                    handle.write(json.dumps(record) + "\n")
+                handle.close()
+        finally:
+            self._lock.release()
+
+    def flush_periodically(self, interval):
+        while not self._closed.is_set():
+            self._closed.wait(interval)
+            self.flush()
+
+    def close(self):
+        """
+            Flushes the records and stops the background thread.
+        """
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+def decode(value):
+    """
+        Returns a unicode version of the given value, so that any output of
+        git can be dumped as JSON.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
@@ -0,0 +1,96 @@
+# memory.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from types import ModuleType, FunctionType, MethodType
+import sys
+
+# Objects that aren't followed: they aren't owned by the models.
+SKIPPED_TYPES = (type, ModuleType, FunctionType, MethodType)
+
+
+def deep_size(obj, seen=None):
+    """
+        Returns the approximate number of bytes used by the object and by the
+        objects it refers to, as given by sys.getsizeof. The objects whose id
+        is in seen are not counted, and the counted objects are added to it,
+        so that shared objects are only counted once across several calls.
+
+        The lazy attributes of the GitPython objects are not loaded: only the
+        slots that are already set are followed.
+
+        >>> seen = set()
+        >>> shared = "x" * 1000
+        >>> deep_size([shared], seen) > 1000
+        True
+        >>> deep_size((shared,), seen) < 1000
+        True
+    """
+    if seen is None:
+        seen = set()
+
+    size = 0
+    to_visit = [obj]
+    while to_visit:
+        obj = to_visit.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            to_visit.extend(obj.iterkeys())
+            to_visit.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            to_visit.extend(obj)
+        elif not isinstance(obj, basestring):
+            to_visit.extend(attributes(obj))
+    return size
+
+
+def attributes(obj):
+    """
+        Returns the values of the attributes of the object, from its
+        dictionnary and from its slots, without calling __getattr__.
+    """
+    values = []
+    dictionnary = getattr(obj, "__dict__", None)
+    if isinstance(dictionnary, dict):
+        values.append(dictionnary)
+
+    cls = type(obj)
+    for klass in getattr(cls, "__mro__", (cls,)):
+        slots = klass.__dict__.get("__slots__", ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        for slot in slots:
+            descriptor = klass.__dict__.get(slot)
+            if descriptor is None or not hasattr(descriptor, "__get__"):
+                continue
+            try:
+                values.append(descriptor.__get__(obj, klass))
+            except AttributeError:
+                # The slot isn't set (a lazy attribute that isn't loaded)
+                continue
+    return values
+
+
+def footprint(categories, ignored=()):
+    """
+        Returns a dictionnary of the approximate number of bytes of each
+        category, and of their total. The objects shared by several
+        categories are counted in the first one.
+
+        :param categories:
+            A list of (name, object) tuples.
+        :param ignored:
+            Objects that are not counted, nor followed.
+    """
+    seen = set(id(obj) for obj in ignored)
+    report = {}
+    for name, obj in categories:
+        report[name] = report.get(name, 0) + deep_size(obj, seen)
+    report["total"] = sum(report.values())
+    return report
@@ -0,0 +1,177 @@
+# metrics.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from contextlib import contextmanager
+from threading import Lock
+from math import ceil
+import time
+
+PHASES = ("checkout", "cherry-pick", "write-tree", "commit-tree", "conflict",
+          "fast-import")
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values, percent):
+    """
+        Returns the given percentile of a sorted list of values.
+
+        >>> percentile([1, 2, 3, 4], 50)
+        2
+        >>> percentile([1, 2, 3, 4], 99)
+        4
+        >>> percentile([], 50)
+    """
+    if not sorted_values:
+        return None
+    rank = int(ceil(percent / 100. * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+class WriteMetrics:
+    """
+        Collects the durations of the phases of a write, and the rate at which
+        the commits are rewritten. It can be queried while the write process
+        is running.
+    """
+
+    def __init__(self, total=0, smoothing=0.1):
+        """
+            Initialization of the WriteMetrics object.
+
+            :param total:
+                The number of commits that will be rewritten.
+            :param smoothing:
+                The weight of the last commit in the moving average of the
+                time spent per commit, used to compute the ETA.
+        """
+        self._lock = Lock()
+        self._total = total
+        self._smoothing = smoothing
+        self._durations = dict((phase, []) for phase in PHASES)
+        self._done = 0
+        self._start = time.time()
+        self._end = None
+        self._last_done = self._start
+        self._average = None
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Context manager timing the enclosed block as the given phase.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, duration):
+        """
+            Records the duration of a phase.
+        """
+        self._lock.acquire()
+        try:
+            self._durations.setdefault(name, []).append(duration)
+        finally:
+            self._lock.release()
+
+    def commit_done(self):
+        """
+            Called every time a commit is rewritten.
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            elapsed = now - self._last_done
+            self._last_done = now
+            self._done += 1
+            if self._average is None:
+                self._average = elapsed
+            else:
+                self._average += self._smoothing * (elapsed - self._average)
+        finally:
+            self._lock.release()
+
+    def restart(self, total=None):
+        """
+            Called when the rewrite starts over, for instance when the
+            fast-import stream falls back on cherry-picking: the commits are
+            counted again, the durations of the phases are kept.
+
+            :param total:
+                The number of commits left to rewrite, when it changes: a
+                write resumed from a checkpoint only counts the commits that
+                weren't rewritten yet.
+        """
+        self._lock.acquire()
+        try:
+            if total is not None:
+                self._total = total
+            self._done = 0
+            self._average = None
+            self._last_done = time.time()
+        finally:
+            self._lock.release()
+
+    def finish(self):
+        """
+            Called when the write process is over.
+        """
+        self._end = time.time()
+
+    def elapsed(self):
+        """
+            Returns the number of seconds since the write started.
+        """
+        return (self._end or time.time()) - self._start
+
+    def commits_per_second(self):
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.
+        return self._done / elapsed
+
+    def eta(self):
+        """
+            Returns the estimated number of seconds before the end of the
+            rewrite, or None if no commit has been rewritten yet.
+        """
+        if self._end is not None:
+            return 0.
+        if self._average is None:
+            return None
+        return max(self._total - self._done, 0) * self._average
+
+    def summary(self):
+        """
+            Returns a dictionnary describing the write: the number of
+            rewritten commits, the rate, the ETA, and for every phase the
+            count, the cumulative duration and the percentiles.
+        """
+        self._lock.acquire()
+        try:
+            durations = dict((name, sorted(values))
+                             for name, values in self._durations.items())
+        finally:
+            self._lock.release()
+
+        phases = {}
+        for name, values in durations.items():
+            if not values:
+                continue
+            phase = {"count": len(values),
+                     "total": sum(values),
+                     "max": values[-1]}
+            for percent in PERCENTILES:
+                phase["p%d" % percent] = percentile(values, percent)
+            phases[name] = phase
+
+        return {"commits": self._done,
+                "total": self._total,
+                "elapsed": self.elapsed(),
+                "commits_per_second": self.commits_per_second(),
+                "eta": self.eta(),
+                "phases": phases}
@@ -0,0 +1,214 @@
+# plan.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    Edit plans: files describing modifications of a branch, read as a stream
+    so that they don't have to fit in memory.
+
+    In the JSON format, every line is an object:
+
+        {"hexsha": "722be91...", "set": {"author_name": "Wallace Henry",
+                                         "authored_date": "1331467200 +0100"}}
+        {"hexsha": "5ee6370...", "delete": true}
+        {"branch": "new_branch_name"}
+        {"reorder": {"start": "2012-03-01", "end": "2012-04-01",
+                     "hours": [["09:00", "18:00"]], "weekdays": [0, 1, 2]}}
+
+    In the CSV format, the columns are hexsha, field and value. The field can
+    also be "delete", "branch" (the hexsha is then empty) or "reorder" (the
+    value is then the JSON object above).
+
+    The dates are either a timestamp, which keeps the timezone of the commit,
+    or a timestamp followed by a timezone.
+"""
+
+from datetime import datetime
+import csv
+import json
+
+from gfbi_core import NOT_EDITABLE_FIELDS, TIME_FIELDS
+from gfbi_core.util import GfbiException, Timezone
+from gfbi_core.non_continuous_timelapse import DEFAULT_AUTHORIZED_WEEKDAYS
+
+FORMATS = ("json", "csv")
+# Fields of the model that are computed from the others.
+COMPUTED_FIELDS = ("parents", "tree", "children")
+CSV_HEADER = ["hexsha", "field", "value"]
+
+
+class PlanError(GfbiException):
+    """
+        Raised when a line of the plan can't be read or applied.
+    """
+
+    def __init__(self, line_number, message):
+        GfbiException.__init__(self, "Line %d: %s" % (line_number, message))
+        self.line_number = line_number
+
+
+def read_plan(stream, format="json"):
+    """
+        Yields the operations of the plan, as (line number, operation)
+        tuples, where the operation is one of:
+            * ("set", hexsha, field, value)
+            * ("delete", hexsha)
+            * ("branch", name)
+            * ("reorder", specification)
+
+        :param stream:
+            An iterable of the lines of the plan, as an opened file.
+        :param format:
+            "json" or "csv", see FORMATS.
+    """
+    if format == "json":
+        return read_json_plan(stream)
+    elif format == "csv":
+        return read_csv_plan(stream)
+    raise GfbiException("Unknown plan format: %s" % format)
+
+
+def read_json_plan(stream):
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError, error:
+            raise PlanError(line_number, str(error))
+        for operation in record_operations(line_number, record):
+            yield operation
+
+
+def record_operations(line_number, record):
+    """
+        Returns the (line number, operation) tuples of a record of the JSON
+        format, already decoded.
+    """
+    if not isinstance(record, dict):
+        raise PlanError(line_number, "Expected an object.")
+
+    operations = []
+    if "branch" in record:
+        operations.append((line_number, ("branch", record["branch"])))
+    if "reorder" in record:
+        operations.append((line_number, ("reorder", record["reorder"])))
+    if "set" in record or "delete" in record:
+        hexsha = record.get("hexsha")
+        if not hexsha:
+            raise PlanError(line_number, "Missing hexsha.")
+        for field, value in sorted(record.get("set", {}).items()):
+            operations.append((line_number, ("set", hexsha, field, value)))
+        if record.get("delete"):
+            operations.append((line_number, ("delete", hexsha)))
+    return operations
+
+
+def read_csv_plan(stream):
+    reader = csv.reader(stream)
+    for row in reader:
+        line_number = reader.line_num
+        if not row:
+            continue
+        if line_number == 1 and row == CSV_HEADER:
+            continue
+        if len(row) != 3:
+            raise PlanError(line_number, "Expected %s." %
+                                         ", ".join(CSV_HEADER))
+
+        hexsha, field, value = row
+        if field == "branch":
+            yield line_number, ("branch", value)
+        elif field == "reorder":
+            try:
+                yield line_number, ("reorder", json.loads(value))
+            except ValueError, error:
+                raise PlanError(line_number, str(error))
+        elif not hexsha:
+            raise PlanError(line_number, "Missing hexsha.")
+        elif field == "delete":
+            yield line_number, ("delete", hexsha)
+        else:
+            yield line_number, ("set", hexsha, field, value.decode("utf-8"))
+
+
+def parse_date(value, orig_value):
+    """
+        Returns the (timestamp, Timezone) value of a date field.
+
+        >>> timestamp, tz = parse_date("1331467200 +0100", None)
+        >>> timestamp, tz.tzname(None)
+        (1331467200, '+0100')
+        >>> timestamp, tz = parse_date(1331467200, (0, Timezone('-0500')))
+        >>> timestamp, tz.tzname(None)
+        (1331467200, '-0500')
+    """
+    parts = str(value).split()
+    if len(parts) == 2:
+        return int(parts[0]), Timezone(parts[1])
+    elif len(parts) == 1:
+        tz = orig_value[1] if orig_value else Timezone("+0000")
+        return int(parts[0]), tz
+    raise ValueError("Invalid date: %r" % value)
+
+
+def parse_time(value):
+    return datetime.strptime(value, "%H:%M").time()
+
+
+def apply_plan(model, operations):
+    """
+        Applies the operations to the populated EditableGitModel, through the
+        bulk methods of the model: the modifications don't go in the history.
+        Returns a dictionnary counting the operations.
+
+        :param operations:
+            The (line number, operation) tuples, see read_plan().
+    """
+    commits = dict((commit.hexsha, commit) for commit in model.get_commits()
+                   if hasattr(commit, "hexsha"))
+    columns = model.get_columns()
+    stats = {"set": 0, "delete": 0, "branch": 0, "reorder": 0}
+    deleted = []
+
+    for line_number, operation in operations:
+        kind = operation[0]
+        try:
+            if kind in ("set", "delete"):
+                hexsha = operation[1]
+                if hexsha not in commits:
+                    raise GfbiException("Unknown commit: %s" % hexsha)
+                commit = commits[hexsha]
+
+            if kind == "set":
+                field, value = operation[2:]
+                if field not in columns or field in NOT_EDITABLE_FIELDS or \
+                   field in COMPUTED_FIELDS:
+                    raise GfbiException("Can't set the field %s" % field)
+                if field in TIME_FIELDS:
+                    value = parse_date(value, model.c_data(commit, field))
+                model.set_field_data(commit, field, value)
+            elif kind == "delete":
+                deleted.append(commit)
+            elif kind == "branch":
+                model.set_new_branch_name(operation[1], ignore_history=True)
+            elif kind == "reorder":
+                specification = operation[1]
+                dates = [datetime.strptime(specification[key], "%Y-%m-%d")
+                         for key in ("start", "end")]
+                hours = [(parse_time(start), parse_time(end))
+                         for start, end in specification.get("hours",
+                                                    [["00:00", "23:59"]])]
+                weekdays = specification.get("weekdays",
+                                             DEFAULT_AUTHORIZED_WEEKDAYS)
+                model.reorder_commits(dates, hours, weekdays)
+        except (GfbiException, ValueError, KeyError, TypeError), error:
+            if isinstance(error, PlanError):
+                raise
+            raise PlanError(line_number, str(error))
+        stats[kind] += 1
+
+    model.delete_commits(deleted)
+    return stats
@@ -0,0 +1,566 @@
+# server.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+"""
+    A long-running process keeping populated models in memory, so that
+    several tools can share the model of a branch instead of walking its
+    history again. The requests and the responses are JSON objects, one per
+    line, sent over a Unix socket:
+
+        {"id": 1, "method": "rows", "params": {"directory": "/path",
+                                               "start": 0, "count": 100}}
+        {"id": 1, "result": [["722be91...", [1331467200, "+0100"], ...]]}
+
+    Start the server with:
+
+        python -m gfbi_core.server --memory-budget 512
+
+    The socket is $XDG_RUNTIME_DIR/gfbi_core.sock, or /tmp/gfbi_core-UID.sock,
+    unless --socket is given. It is only accessible to its owner.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from optparse import OptionParser
+from threading import Lock
+import SocketServer
+import json
+import os
+import socket
+import time
+
+from gfbi_core import TIME_FIELDS
+from gfbi_core.util import GfbiException, Index, RefsWatcher, git_dirs
+from gfbi_core.plan import PlanError, record_operations, apply_plan
+
+
+def active_branch_name(directory):
+    """
+        Returns the name of the branch checked out in the repository.
+    """
+    git_dir, common_dir = git_dirs(directory)
+    with open(os.path.join(git_dir, "HEAD")) as handle:
+        head = handle.read().strip()
+    if not head.startswith("ref: refs/heads/"):
+        raise GfbiException("Repository is in detached HEAD state.")
+    return head[len("ref: refs/heads/"):]
+
+
+def encode_value(field, value):
+    """
+        Returns a value of the model that can be encoded in JSON: the dates
+        become [timestamp, timezone] and the commits become their hexsha.
+    """
+    if field in TIME_FIELDS:
+        if value is None:
+            return None
+        timestamp, tz = value
+        return [timestamp, tz.tzname(None)]
+    elif field in ("parents", "children"):
+        return [getattr(commit, "hexsha", None) for commit in value or []]
+    elif field == "tree":
+        return getattr(value, "hexsha", value)
+    return value
+
+
+class ModelEntry:
+    """
+        A populated model of the cache, with the state of the references it
+        was built from.
+    """
+
+    def __init__(self, key, common_dir):
+        self.key = key
+        self.refs = RefsWatcher(common_dir)
+        self.model = None
+        self.stamp = None
+        # True when the references changed under a model having modifications
+        self.stale = False
+        self.size = 0
+        self.measured = 0
+        self.users = 0
+        self.last_used = time.time()
+        # Held while the model is used
+        self.lock = Lock()
+
+    def is_modified(self):
+        model = self.model
+        return model is not None and bool(model.get_modifications() or
+                                          model.get_deleted_commits() or
+                                          model.is_name_modified())
+
+
+class ModelCache:
+    """
+        Keeps the populated models by repository and branch. A model is built
+        again when a reference of its repository changed, and the least
+        recently used models are dropped when their total size goes over the
+        memory budget.
+
+        The models having modifications that weren't written are never
+        dropped: when the references change under them, they are kept and
+        can't be written anymore.
+    """
+
+    def __init__(self, max_bytes=None, measure_interval=60):
+        """
+            Initialization of the ModelCache.
+
+            :param max_bytes:
+                The memory budget of the models, in bytes, as measured by
+                memory_footprint(). None for no budget.
+            :param measure_interval:
+                The minimum number of seconds between two measures of a
+                model modified by the requests. The models are always
+                measured after their populate.
+        """
+        self._max_bytes = max_bytes
+        self._measure_interval = measure_interval
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._stats = {"hits": 0, "populates": 0, "invalidations": 0,
+                       "evictions": 0}
+
+    def key(self, directory, branch=None):
+        directory = os.path.realpath(directory)
+        return directory, branch or active_branch_name(directory)
+
+    @contextmanager
+    def model(self, directory, branch=None, mutates=False, writes=False):
+        """
+            Context manager giving the populated EditableGitModel of the
+            branch (the checked out branch by default). The model is only
+            used by one request at a time.
+
+            :param mutates:
+                True if the request modifies the model, which is then measured
+                again (see measure_interval).
+            :param writes:
+                True if the request writes the model. A GfbiException is
+                raised if the references changed since the populate.
+        """
+        key = self.key(directory, branch)
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = ModelEntry(key, git_dirs(key[0])[1])
+            # The last used entries are at the end
+            self._entries[key] = entry
+            entry.users += 1
+        finally:
+            self._lock.release()
+
+        try:
+            entry.lock.acquire()
+            try:
+                stamp = entry.refs.stamp()
+                if entry.model is not None and stamp != entry.stamp:
+                    if entry.is_modified():
+                        entry.stale = True
+                    else:
+                        self._count("invalidations")
+                        entry.model = None
+                measure = mutates and \
+                        time.time() - entry.measured >= self._measure_interval
+                if entry.model is None:
+                    self._count("populates")
+                    entry.model = self.populate(*key)
+                    entry.stamp = stamp
+                    entry.stale = False
+                    measure = True
+                else:
+                    self._count("hits")
+
+                if writes and entry.stale:
+                    raise GfbiException("The repository changed since the "
+                                         "model was populated, drop the "
+                                         "model to populate it again.")
+
+                yield entry.model
+
+                if writes:
+                    # The write moved the references, the model is up to date
+                    entry.stamp = entry.refs.stamp()
+                if measure:
+                    self.measure(entry)
+            finally:
+                entry.last_used = time.time()
+                entry.lock.release()
+        finally:
+            self._lock.acquire()
+            try:
+                entry.users -= 1
+            finally:
+                self._lock.release()
+            self.evict()
+
+    def measure(self, entry):
+        entry.size = entry.model.memory_footprint()["total"]
+        entry.measured = time.time()
+
+    def populate(self, directory, branch):
+        # Imported here, so that the server starts without the backends.
+        from gfbi_core.editable_git_model import EditableGitModel
+
+        model = EditableGitModel(directory)
+        if model.get_current_branch().name != branch:
+            for head in model.get_branches():
+                if head.name == branch:
+                    model.set_current_branch(head)
+                    break
+            else:
+                raise GfbiException("No branch %s in %s" % (branch, directory))
+        model.populate()
+        return model
+
+    def evict(self):
+        """
+            Drops the least recently used idle models, until the models fit in
+            the memory budget.
+        """
+        if self._max_bytes is None:
+            return
+
+        self._lock.acquire()
+        try:
+            total = sum(entry.size for entry in self._entries.values())
+            for key, entry in self._entries.items():
+                if total <= self._max_bytes:
+                    break
+                if entry.users or entry.is_modified():
+                    continue
+                del self._entries[key]
+                total -= entry.size
+                self._stats["evictions"] += 1
+        finally:
+            self._lock.release()
+
+    def drop(self, directory, branch=None):
+        """
+            Drops the model of the branch, returns False if it wasn't cached.
+        """
+        key = self.key(directory, branch)
+        self._lock.acquire()
+        try:
+            return self._entries.pop(key, None) is not None
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            self._stats[name] += 1
+        finally:
+            self._lock.release()
+
+    def stats(self, measure=False):
+        """
+            Returns the counters of the cache, and the models it holds.
+
+            :param measure:
+                If True, the idle models are measured again first.
+        """
+        if measure:
+            self._lock.acquire()
+            try:
+                entries = self._entries.values()
+            finally:
+                self._lock.release()
+            for entry in entries:
+                if entry.lock.acquire(False):
+                    try:
+                        if entry.model is not None:
+                            self.measure(entry)
+                    finally:
+                        entry.lock.release()
+            self.evict()
+
+        self._lock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats["models"] = [{"directory": entry.key[0],
+                                "branch": entry.key[1],
+                                "size": entry.size,
+                                "modified": entry.is_modified(),
+                                "stale": entry.stale,
+                                "idle": time.time() - entry.last_used}
+                               for entry in self._entries.values()]
+            stats["size"] = sum(entry.size
+                                for entry in self._entries.values())
+        finally:
+            self._lock.release()
+        return stats
+
+
+class ModelServer:
+    """
+        Answers the requests, independently of the transport. Every method
+        takes the directory of the repository and optionally the branch.
+    """
+
+    METHODS = ("info", "rows", "column", "edit", "write", "drop", "stats")
+
+    def __init__(self, cache=None):
+        self.cache = cache or ModelCache()
+
+    def handle(self, request):
+        """
+            Returns the response to the request, as dictionnaries.
+        """
+        response = {"id": request.get("id")}
+        method = request.get("method")
+        try:
+            if method not in self.METHODS:
+                raise GfbiException("Unknown method: %s" % method)
+            params = dict((str(name), value)
+                          for name, value in request.get("params", {}).items())
+            response["result"] = getattr(self, method)(**params)
+        except Exception, error:
+            # A bad request, a missing repository or a failing git command
+            # must not close the connection.
+            response["error"] = "%s: %s" % (error.__class__.__name__, error)
+        return response
+
+    def info(self, directory, branch=None):
+        with self.cache.model(directory, branch) as model:
+            return {"branch": model.get_current_branch().name,
+                    "columns": model.get_columns(),
+                    "row_count": model.row_count(),
+                    "modified": model.get_modified_count(),
+                    "deleted": model.get_deleted_count()}
+
+    def rows(self, directory, start=0, count=100, columns=None, branch=None):
+        """
+            Returns the values of the given columns (all of them by default)
+            of count rows from start.
+        """
+        with self.cache.model(directory, branch) as model:
+            fields = columns or model.get_columns()
+            column_numbers = [model.get_column(field) for field in fields]
+            end = min(start + count, model.row_count())
+            return [[encode_value(field, model.data(Index(row, column)))
+                     for field, column in zip(fields, column_numbers)]
+                    for row in xrange(max(start, 0), end)]
+
+    def column(self, directory, field, start=0, count=None, branch=None):
+        """
+            Returns the values of a column, from start.
+        """
+        with self.cache.model(directory, branch) as model:
+            column = model.get_column(field)
+            end = model.row_count()
+            if count is not None:
+                end = min(start + count, end)
+            return [encode_value(field, model.data(Index(row, column)))
+                    for row in xrange(max(start, 0), end)]
+
+    def edit(self, directory, records, branch=None):
+        """
+            Applies the records, in the JSON format of the edit plans (see
+            gfbi_core.plan), and returns the operation counts.
+        """
+        operations = []
+        for number, record in enumerate(records, 1):
+            operations.extend(record_operations(number, record))
+        with self.cache.model(directory, branch, mutates=True) as model:
+            try:
+                return apply_plan(model, operations)
+            except PlanError, error:
+                raise ValueError("Record %d: %s" % (error.line_number, error))
+
+    def write(self, directory, branch=None, **options):
+        """
+            Writes the model and returns "written" or "conflict". The options
+            are the ones of EditableGitModel.write().
+        """
+        options = dict((str(name), value) for name, value in options.items())
+        options.setdefault("log", False)
+        with self.cache.model(directory, branch, mutates=True,
+                              writes=True) as model:
+            if model.write(**options).result():
+                return "written"
+            return "conflict"
+
+    def drop(self, directory, branch=None):
+        return self.cache.drop(directory, branch)
+
+    def stats(self, measure=False):
+        return self.cache.stats(measure)
+
+
+class LocalTransport:
+    """
+        Sends the requests to a ModelServer of the same process, through the
+        same JSON encoding as the socket.
+    """
+
+    def __init__(self, server):
+        self._server = server
+
+    def send(self, request):
+        request = json.loads(json.dumps(request))
+        return json.loads(json.dumps(self._server.handle(request)))
+
+
+class UnixSocketTransport:
+    """
+        Sends the requests to a server listening on a Unix socket.
+    """
+
+    def __init__(self, path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rwb")
+
+    def send(self, request):
+        self._file.write(json.dumps(request) + "\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise GfbiException("The server closed the connection.")
+        return json.loads(line)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+class ModelClient:
+    """
+        Calls the methods of a ModelServer through a transport.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._last_id = 0
+
+    def call(self, method, **params):
+        self._last_id += 1
+        response = self._transport.send({"id": self._last_id,
+                                         "method": method,
+                                         "params": params})
+        if "error" in response:
+            raise GfbiException(response["error"])
+        return response["result"]
+
+    def info(self, directory, branch=None):
+        return self.call("info", directory=directory, branch=branch)
+
+    def rows(self, directory, start=0, count=100, columns=None, branch=None):
+        return self.call("rows", directory=directory, start=start,
+                         count=count, columns=columns, branch=branch)
+
+    def column(self, directory, field, start=0, count=None, branch=None):
+        return self.call("column", directory=directory, field=field,
+                         start=start, count=count, branch=branch)
+
+    def edit(self, directory, records, branch=None):
+        return self.call("edit", directory=directory, records=records,
+                         branch=branch)
+
+    def write(self, directory, branch=None, **options):
+        return self.call("write", directory=directory, branch=branch,
+                         **options)
+
+    def drop(self, directory, branch=None):
+        return self.call("drop", directory=directory, branch=branch)
+
+    def stats(self, measure=False):
+        return self.call("stats", measure=measure)
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+            except ValueError, error:
+                response = {"id": None, "error": "ValueError: %s" % error}
+            else:
+                response = self.server.model_server.handle(request)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+class UnixSocketServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    """
+        Serves a ModelServer on a Unix socket, with a thread per connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, model_server):
+        self.model_server = model_server
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+
+    def server_bind(self):
+        # The socket is created readable and writable by its owner only:
+        # the clients can write any branch the user can.
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+
+def default_socket_path():
+    """
+        Returns the path of the socket of the current user: in
+        $XDG_RUNTIME_DIR if it is set, in /tmp otherwise.
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "gfbi_core.sock")
+    return "/tmp/gfbi_core-%d.sock" % os.getuid()
+
+
+def is_served(path):
+    """
+        Returns True if a server answers on the Unix socket at path.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except socket.error:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m gfbi_core.server [options]")
+    parser.add_option("--socket", default=default_socket_path(),
+                      help="the path of the Unix socket ($XDG_RUNTIME_DIR/"
+                           "gfbi_core.sock or /tmp/gfbi_core-UID.sock by "
+                           "default)")
+    parser.add_option("--memory-budget", type="int",
+                      help="the memory budget of the models, in megabytes")
+    options, arguments = parser.parse_args(argv)
+
+    max_bytes = None
+    if options.memory_budget is not None:
+        max_bytes = options.memory_budget * 1024 * 1024
+
+    if os.path.exists(options.socket):
+        if is_served(options.socket):
+            parser.error("a server already listens on %s" % options.socket)
+        # Left by a server that didn't stop cleanly
+        os.remove(options.socket)
+    server = UnixSocketServer(options.socket,
+                              ModelServer(ModelCache(max_bytes)))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(options.socket)
+
+
+if __name__ == "__main__":
+    main()
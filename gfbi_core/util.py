@@ -6,19 +6,14 @@
 
 from datetime import timedelta, tzinfo
 from subprocess import Popen, PIPE
-from git import Repo
+from threading import Thread, Timer
+from collections import deque
 import codecs
+import time
+import sys
+import os
 
 
-STATUSES = (
-    ("both deleted:", "DD"),
-    ("added by us:", "AU"),
-    ("deleted by them:", "UD"),
-    ("added by them:", "UA"),
-    ("deleted by us:", "DU"),
-    ("both added:", "AA"),
-    ("both modified:", "UU")
-)
 REBASE_PATCH_FILE = ".git/rebase-merge/patch"
 
 
@@ -185,129 +180,625 @@ class GfbiException(Exception):
     pass
 
 
-def run_command(command):
-    process = Popen(command, shell=True, stdout=PIPE, stderr=PIPE)
-    output, errors = process.communicate()
+class CommandTimeout(GfbiException):
+    """
+        Raised when a command didn't finish before its timeout.
+    """
+    pass
 
-    return output.split('\n'), errors.split('\n')
 
+class LazyModule:
+    """
+        A module that is only imported when one of its attributes is first
+        used, so that importing gfbi_core doesn't import the backends. The
+        attributes are then cached on the LazyModule.
+
+        >>> lazy_json = LazyModule("json")
+        >>> "dumps" in lazy_json.__dict__
+        False
+        >>> lazy_json.dumps([1])
+        '[1]'
+        >>> LazyModule("no_such_module").is_available()
+        False
+    """
 
-def get_unmerged_files(conflicting_hexsha, orig_hexsha, directory):
+    def __init__(self, name, hint=""):
+        """
+            Initialization of the LazyModule.
+
+            :param name:
+                The full name of the module, as "git.objects.util".
+            :param hint:
+                Appended to the message of the ImportError, to tell how to
+                install the module.
+        """
+        self._name = name
+        self._hint = hint
+        self._module = None
+        self._error = None
+
+    def _load(self):
+        if self._module is None:
+            if self._error is None:
+                try:
+                    __import__(self._name)
+                    self._module = sys.modules[self._name]
+                except ImportError, error:
+                    self._error = " ".join((str(error), self._hint)).strip()
+            if self._error is not None:
+                raise ImportError(self._error)
+        return self._module
+
+    def is_available(self):
+        """
+            Returns True if the module can be imported.
+        """
+        try:
+            self._load()
+        except ImportError:
+            return False
+        return True
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = getattr(self._load(), name)
+        self.__dict__[name] = value
+        return value
+
+
+class Command:
+    """
+        Runs a command given as an argument vector, without the shell, in an
+        explicit directory. The output can be streamed line by line, only the
+        last lines of the error output are kept.
     """
-        Collect several information about the current unmerged state.
 
-        :param from_hexsha, to_hexsha:
-            These parameters are used to provide the diff that should have been
-            applied by the conflicting commit.
+    def __init__(self, argv, cwd=None, env=None, input=None, timeout=None,
+                 max_errors=1000):
+        """
+            Initialization of the Command.
+
+            :param argv:
+                The list of the arguments, as ["git", "write-tree"].
+            :param cwd:
+                The directory in which the command runs.
+            :param env:
+                A dictionnary of environment variables added to the current
+                environment.
+            :param input:
+                The data written on the standard input of the command.
+            :param timeout:
+                If set, the command is killed after timeout seconds and
+                CommandTimeout is raised.
+            :param max_errors:
+                The number of lines of the error output that are kept.
+        """
+        self.argv = [encode_argument(argument) for argument in argv]
+        self.cwd = cwd
+        self.env = env
+        self.input = input
+        self.timeout = timeout
+        self.returncode = None
+        self.duration = None
+        self._errors = deque(maxlen=max_errors)
+
+    def stream(self):
+        """
+            Runs the command and yields the lines of its output, with their
+            end of line character.
+        """
+        environment = None
+        if self.env:
+            environment = dict(os.environ)
+            for name, value in self.env.items():
+                environment[name] = encode_argument(value)
+
+        start = time.time()
+        process = Popen(self.argv, cwd=self.cwd, env=environment,
+                        stdin=PIPE if self.input is not None else None,
+                        stdout=PIPE, stderr=PIPE)
+
+        timed_out = []
+        timer = None
+        if self.timeout is not None:
+            def kill():
+                timed_out.append(True)
+                process.kill()
+            timer = Timer(self.timeout, kill)
+            timer.start()
+
+        feeders = [Thread(target=self._read_errors, args=(process.stderr,))]
+        if self.input is not None:
+            feeders.append(Thread(target=self._write_input,
+                                  args=(process.stdin,)))
+        for feeder in feeders:
+            feeder.setDaemon(True)
+            feeder.start()
+
+        try:
+            for line in iter(process.stdout.readline, ""):
+                yield line
+        finally:
+            process.stdout.close()
+            for feeder in feeders:
+                feeder.join()
+            self.returncode = process.wait()
+            if timer is not None:
+                timer.cancel()
+            self.duration = time.time() - start
+
+        if timed_out:
+            raise CommandTimeout("%s didn't finish in %s seconds." %
+                                 (" ".join(self.argv), self.timeout))
+
+    def lines(self):
+        """
+            Runs the command and yields the lines of its output.
+
+            >>> list(Command(["printf", "a\\nb\\n"]).lines())
+            ['a', 'b']
+            >>> list(Command(["sleep", "5"], timeout=0.1).lines())
+            Traceback (most recent call last):
+            ...
+            CommandTimeout: sleep 5 didn't finish in 0.1 seconds.
+        """
+        for line in self.stream():
+            yield line.rstrip("\n")
+
+    def run(self):
+        """
+            Runs the command and returns (output, errors, returncode), where
+            output and errors are lists of lines.
+        """
+        output = "".join(self.stream())
+        return output.split("\n"), self.errors(), self.returncode
+
+    def errors(self):
+        """
+            Returns the last lines of the error output.
+        """
+        return "".join(self._errors).split("\n")
+
+    def _read_errors(self, pipe):
+        for line in iter(pipe.readline, ""):
+            self._errors.append(line)
+        pipe.close()
+
+    def _write_input(self, pipe):
+        try:
+            pipe.write(encode_argument(self.input))
+            pipe.close()
+        except IOError:
+            # The command exited without reading its input
+            pass
+
+
+def encode_argument(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def run_command(argv, cwd=None, env=None, input=None, timeout=None):
+    """
+        Runs a command and returns its output and errors as lists of lines.
+        See Command for the parameters.
     """
-    u_files = {}
+    output, errors, status = run_command_with_status(argv, cwd, env, input,
+                                                     timeout)
+
+    return output, errors
 
-    # Fetch diffs
-    provide_unmerged_status(u_files)
-    provide_diffs(u_files, conflicting_hexsha)
-    provide_unmerged_contents(u_files)
-    provide_orig_contents(u_files, orig_hexsha, directory)
 
-    return u_files
+def run_command_with_status(argv, cwd=None, env=None, input=None,
+                            timeout=None):
+    """
+        Same as run_command(), but also returns the exit code of the command.
+    """
+    return Command(argv, cwd, env, input, timeout).run()
 
 
-def provide_unmerged_status(u_files):
+def list_refs(patterns, directory=None):
     """
-        Reads the output of 'git status' to find the unmerged statuses.
+        Returns the references matching the given patterns, as a list of
+        (refname, hexsha, object_type, target_hexsha, target_type). The
+        target is the object pointed by an annotated tag, or None.
+
+        :param patterns:
+            Full reference names or prefixes, as given to git for-each-ref
+            (for instance "refs/heads" matches every branch).
     """
-    command = "git --no-pager status"
-    output, errors = run_command(command)
+    if not patterns:
+        return []
+
+    format = "%(refname) %(objectname) %(objecttype) " \
+             "%(*objectname) %(*objecttype)"
+    output, errors = run_command(["git", "for-each-ref",
+                                  "--format=%s" % format] + list(patterns),
+                                 directory)
+
+    refs = []
     for line in output:
-        for status, short_status in STATUSES:
-            if status in line:
-                u_file = line.split(status)[1].strip()
-                git_status = short_status
-                u_files.setdefault(u_file, {})["git_status"] = git_status
-                break
+        if not line.strip():
+            continue
+        refname, hexsha, object_type, target_hexsha, target_type = \
+                (line.split(" ") + [""] * 5)[:5]
+        refs.append((refname, hexsha, object_type, target_hexsha or None,
+                     target_type or None))
+    return refs
+
+
+def git_dirs(directory):
+    """
+        Returns the git directory and the common git directory of the working
+        tree. They differ in a linked worktree, where .git is a file pointing
+        to the git directory of the worktree, which itself has a commondir
+        file pointing to the main repository.
+
+        :param directory:
+            The directory of the working tree.
+    """
+    git_dir = os.path.join(directory, ".git")
+    if os.path.isfile(git_dir):
+        with open(git_dir) as handle:
+            content = handle.read().strip()
+        if not content.startswith("gitdir: "):
+            raise GfbiException("Not a git directory: %s" % git_dir)
+        git_dir = os.path.join(directory, content[len("gitdir: "):])
+    git_dir = os.path.normpath(git_dir)
+
+    common_dir = git_dir
+    commondir_file = os.path.join(git_dir, "commondir")
+    if os.path.isfile(commondir_file):
+        with open(commondir_file) as handle:
+            common_dir = os.path.normpath(
+                            os.path.join(git_dir, handle.read().strip()))
+    return git_dir, common_dir
+
+
+def refs_stamp(common_dir):
+    """
+        Returns a value that changes when a reference is created, updated or
+        deleted: the modification times of packed-refs and of the loose
+        reference directories. git writes the loose references by renaming a
+        lock file, which updates the modification time of their directory.
 
+        This lists every reference directory, use a RefsWatcher to check the
+        references repeatedly.
 
-def provide_diffs(u_files, conflicting_hexsha):
+        :param common_dir:
+            The common git directory, see git_dirs().
     """
-        Process the output of git diff rather than calling git diff on
-        every file in the path.
+    return RefsWatcher(common_dir).stamp()
+
+
+class RefsWatcher:
+    """
+        Computes the same stamp as refs_stamp(), but only lists the reference
+        directories when one of them changed: the other calls only stat
+        packed-refs and the directories found the last time. A new
+        subdirectory changes the modification time of its parent, so it is
+        always noticed.
     """
-    command = "git --no-pager diff %s~ %s" % \
-            (conflicting_hexsha, conflicting_hexsha)
-    diff_output, errors = run_command(command)
 
-    u_file = None
-    diff = ""
-    for line in diff_output:
-        if line[:10] == 'diff --git':
-            if u_file and diff:
-                u_files.setdefault(u_file, {})["diff"] = diff
-                diff = ""
-            u_file = line.split('diff --git a/')[1].split(' ')[0]
+    def __init__(self, common_dir):
+        """
+            Initialization of the RefsWatcher.
 
-            if u_file not in u_files:
-                # This isn't an unmerged file, don't log the diff
-                u_file = None
+            :param common_dir:
+                The common git directory, see git_dirs().
+        """
+        self._common_dir = common_dir
+        self._directories = []
+        self._stamp = None
 
-        if u_file:
-            diff += line + "\n"
+    def _stat(self):
+        stamp = [mtime(os.path.join(self._common_dir, "packed-refs"))]
+        for path in self._directories:
+            stamp.append((path, mtime(path)))
+        return tuple(stamp)
 
-    # Write the last diff
-    if u_file:
-        u_files.setdefault(u_file, {})["diff"] = diff
+    def stamp(self):
+        """
+            Returns a value that changes when a reference is created, updated
+            or deleted.
+        """
+        stamp = self._stat()
+        if stamp != self._stamp:
+            self._directories = [path for path, dirnames, filenames
+                                 in os.walk(os.path.join(self._common_dir,
+                                                         "refs"))]
+            stamp = self._stamp = self._stat()
+        return stamp
 
 
-def provide_unmerged_contents(u_files):
+def mtime(path):
     """
-        Fetches the unmerged contents of the files.
+        Returns the modification time of path, or None if it doesn't exist.
     """
-    # Make a backup of the unmerged file.
-    for u_file, file_info in u_files.items():
-        short_status = file_info["git_status"]
-        unmerged_content = ""
-        if not short_status == "DD":
-            handle = codecs.open(u_file, encoding='utf-8', mode='r')
-            unmerged_content = handle.read()
-            handle.close()
-        u_files.setdefault(u_file, {})["unmerged_content"] = unmerged_content
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
 
 
-def provide_orig_contents(u_files, orig_hexsha, directory):
+def is_dirty(directory, untracked_files=False):
+    """
+        Returns True if the index or the working tree of the repository differ
+        from HEAD, as GitPython's Repo.is_dirty() does, without reading the
+        unchanged files.
+
+        The status of libgit2 is used when pygit2 is available (see
+        gfbi_repo.Repo.is_dirty). Otherwise git stops at the first change:
+        "git diff --quiet" compares the working tree to the index using the
+        stat data of the index, "git diff --cached --quiet" compares the index
+        to HEAD.
+
+        :param directory:
+            The directory of the working tree.
+        :param untracked_files:
+            If True, untracked files also make the repository dirty.
     """
-        This method fetches the content of the files before the merge.
+    from gfbi_core.gfbi_repo import Repo, pygit2
+
+    if pygit2.is_available():
+        return Repo(directory).is_dirty(untracked_files=untracked_files)
+
+    for argv in (["git", "diff", "--quiet"],
+                 ["git", "diff", "--cached", "--quiet"]):
+        output, errors, status = run_command_with_status(argv, directory)
+        if status == 1:
+            return True
+        if status != 0:
+            raise GfbiException("\n".join(errors))
+
+    if untracked_files:
+        command = Command(["git", "ls-files", "--others", "--exclude-standard",
+                           "--directory", "--no-empty-directory"], directory)
+        for line in command.lines():
+            return True
+    return False
+
 
-        Possible optimization: use git.repo.tree.
+def get_unmerged_files(conflicting_hexsha, orig_hexsha, directory):
     """
-    repo = Repo(directory)
-    commit = repo.commit(rev=orig_hexsha)
-    tree = commit.tree
+        Collect several information about the current unmerged state.
 
-    # Use Commit.tree[file].data_stream.read()
-    for u_file, file_info in u_files.items():
-        git_status = file_info["git_status"]
-        orig_content = ""
-        if git_status not in ('UA', 'DU', 'DD'):
-            blob = tree[u_file]
-            orig_content = blob.data_stream.read()
-        u_files.setdefault(u_file, {})["orig_content"] = orig_content
+        Returns a dictionnary of UnmergedFile objects. Only the git status
+        is read right away, the diffs and the contents are loaded when they
+        are first accessed.
 
+        :param conflicting_hexsha:
+            The hexsha of the conflicting commit. The diff that should have
+            been applied is the diff of this commit.
+        :param orig_hexsha:
+            The hexsha of the commit on which we tried to apply it.
+    """
+    snapshot = ConflictSnapshot(conflicting_hexsha, orig_hexsha, directory)
+    return snapshot.files
 
-def apply_solutions(solutions):
+
+def read_blobs(hexshas, directory=None):
+    """
+        Reads the given blobs with a single git cat-file process, and returns
+        a dictionnary of their hexsha and their content.
+    """
+    if not hexshas:
+        return {}
+
+    output, errors = run_command(["git", "cat-file", "--batch"], directory,
+                                 input="\n".join(hexshas) + "\n")
+    output = "\n".join(output)
+
+    blobs = {}
+    position = 0
+    while position < len(output):
+        header_end = output.index("\n", position)
+        header = output[position:header_end].split(" ")
+        position = header_end + 1
+        if header[1] == "missing":
+            continue
+        size = int(header[2])
+        blobs[header[0]] = output[position:position + size]
+        position += size + 1
+    return blobs
+
+
+class UnmergedFile(dict):
+    """
+        The information about an unmerged file (see
+        EditableGitModel.set_unmerged_files). The "diff", "unmerged_content"
+        and "orig_content" keys are loaded from the ConflictSnapshot on their
+        first access.
+    """
+
+    def __init__(self, snapshot, git_status, orig_blob):
+        dict.__init__(self, git_status=git_status)
+        self._snapshot = snapshot
+        self.orig_blob = orig_blob
+        self.unmerged_blob = None
+
+    def __missing__(self, key):
+        if key == "diff":
+            self._snapshot.load_diffs()
+        elif key == "orig_content":
+            self._snapshot.load_orig_contents()
+        elif key == "unmerged_content":
+            self._snapshot.load_unmerged_contents()
+        else:
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+
+class ConflictSnapshot:
+    """
+        The unmerged state of the repository, read from
+        git status --porcelain=v2, which gives the git status and the blobs
+        of the stages of every unmerged path.
+    """
+
+    # Diffs are asked for this number of paths at a time, to keep the
+    # command line short.
+    DIFF_PATHS = 100
+
+    def __init__(self, conflicting_hexsha, orig_hexsha, directory=None):
+        self._conflicting_hexsha = conflicting_hexsha
+        self._orig_hexsha = orig_hexsha
+        self._directory = directory
+        self.files = {}
+
+        output, errors = run_command(["git", "status", "--porcelain=v2", "-z"],
+                                     directory)
+
+        entries = iter("\n".join(output).split("\0"))
+        for entry in entries:
+            if entry.startswith("2 "):
+                # Renamed entries are followed by the original path
+                entries.next()
+            elif entry.startswith("u "):
+                fields = entry.split(" ", 10)
+                git_status, orig_blob, path = fields[1], fields[8], fields[10]
+                self.files[path] = UnmergedFile(self, git_status, orig_blob)
+
+        # The working tree will be cleaned up, save the unmerged contents
+        # (with the conflict markers) as blobs.
+        paths = [u_file for u_file, file_info in self.files.items()
+                 if file_info["git_status"] != "DD"]
+        if paths:
+            output, errors = run_command(["git", "hash-object", "-w",
+                                          "--stdin-paths"], directory,
+                                         input="\n".join(paths) + "\n")
+            for path, hexsha in zip(paths, output):
+                self.files[path].unmerged_blob = hexsha
+
+    def load_diffs(self):
+        """
+            Fetches the diffs of the conflicting commit, limited to the
+            unmerged paths.
+        """
+        paths = sorted(self.files)
+        for u_file in paths:
+            self.files[u_file]["diff"] = ""
+
+        for start in xrange(0, len(paths), self.DIFF_PATHS):
+            command = ["git", "--no-pager", "diff",
+                       self._conflicting_hexsha + "~", self._conflicting_hexsha,
+                       "--"] + paths[start:start + self.DIFF_PATHS]
+            diff_output, errors = run_command(command, self._directory)
+
+            u_file = None
+            for line in diff_output:
+                if line[:10] == 'diff --git':
+                    # The line is "diff --git a/<path> b/<path>"
+                    u_file = line[len('diff --git a/'):]
+                    u_file = u_file[:(len(u_file) - 3) / 2]
+                    if u_file not in self.files:
+                        u_file = None
+
+                if u_file:
+                    self.files[u_file]["diff"] += line + "\n"
+
+    def load_orig_contents(self):
+        """
+            Fetches the content of the files before the merge, with a single
+            git cat-file process.
+        """
+        hexshas = [file_info.orig_blob for file_info in self.files.values()
+                   if file_info["git_status"] not in ('UA', 'DU', 'DD')]
+        blobs = read_blobs(hexshas, self._directory)
+
+        for file_info in self.files.values():
+            file_info["orig_content"] = blobs.get(file_info.orig_blob, "")
+
+    def load_unmerged_contents(self):
+        """
+            Fetches the unmerged contents of the files, with a single git
+            cat-file process.
+        """
+        hexshas = [file_info.unmerged_blob
+                   for file_info in self.files.values()
+                   if file_info.unmerged_blob is not None]
+        blobs = read_blobs(hexshas, self._directory)
+
+        for file_info in self.files.values():
+            content = blobs.get(file_info.unmerged_blob, "")
+            file_info["unmerged_content"] = content.decode('utf-8')
+
+
+def apply_solutions(solutions, cwd=None):
     """
         This apply the given solutions to the repository.
 
+        The contents to add are written as blobs by a single git hash-object
+        process, then every path is updated by a single git update-index
+        process, whatever the number of files. Symbolic links are staged
+        as links (mode 120000), their blob being the path they point to.
+
         :param solutions:
             See EditableGitModel.set_conflict_solutions.
+        :param cwd:
+            The working tree in which the solutions are applied. Defaults to
+            the current directory.
     """
+    to_add = []
+    to_delete = []
     for filepath, action in solutions.items():
+        path = os.path.join(cwd or ".", filepath)
         if action[0] == "delete":
-            command = 'git rm %s'
-        elif action[0] == "add":
-            command = 'git add %s'
-        elif action[0] == "add_custom":
+            to_delete.append(filepath)
+            if os.path.lexists(path):
+                os.remove(path)
+            continue
+
+        if action[0] == "add_custom":
             custom_content = action[1]
-            handle = codecs.open(filepath, encoding='utf-8', mode='w')
+            handle = codecs.open(path, encoding='utf-8', mode='w')
             handle.write(custom_content)
             handle.close()
-            command = 'git add %s'
-
-        run_command(command % filepath)
+        to_add.append(filepath)
+
+    entries = []
+    files = []
+    for filepath in to_add:
+        path = os.path.join(cwd or ".", filepath)
+        if os.path.islink(path):
+            # The blob of a symbolic link is its target
+            output, errors, status = run_command_with_status(
+                            ["git", "hash-object", "-w", "--stdin"], cwd,
+                            input=os.readlink(path))
+            if status != 0 or not output or not output[0].strip():
+                raise GfbiException("Couldn't hash %s: %s" %
+                                    (filepath, "\n".join(errors).strip()))
+            entries.append(("120000", output[0].strip(), filepath))
+        else:
+            files.append(filepath)
+
+    if files:
+        output, errors, status = run_command_with_status(
+                            ["git", "hash-object", "-w", "--stdin-paths"],
+                            cwd, input="\n".join(files) + "\n")
+        blobs = [line.strip() for line in output if line.strip()]
+        if status != 0 or len(blobs) != len(files):
+            raise GfbiException("Couldn't hash the solved files: %s" %
+                                "\n".join(errors).strip())
+        for filepath, hexsha in zip(files, blobs):
+            mode = "100644"
+            if os.lstat(os.path.join(cwd or ".", filepath)).st_mode & 0111:
+                mode = "100755"
+            entries.append((mode, hexsha, filepath))
+
+    # Removing a path (mode 0) drops its unmerged stages
+    index_info = []
+    for filepath in to_delete:
+        index_info.append("0 %s\t%s" % ("0" * 40, filepath))
+    for mode, hexsha, filepath in entries:
+        index_info.append("0 %s\t%s" % ("0" * 40, filepath))
+        index_info.append("%s %s\t%s" % (mode, hexsha, filepath))
+
+    if index_info:
+        output, errors, status = run_command_with_status(
+                            ["git", "update-index", "-z", "--index-info"], cwd,
+                            input="\0".join(index_info) + "\0")
+        if status != 0:
+            raise GfbiException("Couldn't apply the conflict solutions.")
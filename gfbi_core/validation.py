@@ -1,5 +1,16 @@
-from os import waitpid
-from subprocess import Popen
+from collections import OrderedDict
+from threading import Lock
+
+INVALID_NAME = "Invalid name, see http://www.kernel.org/" \
+               "pub/software/scm/git/docs/git-check-ref-format.html"
+# Characters that can't appear anywhere in a reference name
+FORBIDDEN_CHARACTERS = frozenset(" ~^:?*[\\\x7f" +
+                                 "".join(chr(code) for code in xrange(32)))
+CACHE_SIZE = 1024
+
+_cache = OrderedDict()
+_cache_lock = Lock()
+
 
 def validate_branch_name(candidate):
     """
@@ -28,14 +39,71 @@ docs/git-check-ref-format.html
     ValueError: Invalid name, \
 see http://www.kernel.org/pub/software/scm/git/\
 docs/git-check-ref-format.html
+    """
+    error = cached_error(candidate)
+    if error is not None:
+        raise ValueError(error)
+
+
+def validate_branch_names(candidates):
+    """
+    Checks a batch of names, and returns a dictionnary of the names and of
+    their error message, None for the valid names.
+
+    >>> sorted(validate_branch_names(["master", "a..b"]).items())
+    [('a..b', 'Invalid name, see http://www.kernel.org/pub/software/scm/git/\
+docs/git-check-ref-format.html'), ('master', None)]
+    """
+    return dict((candidate, cached_error(candidate))
+                for candidate in candidates)
+
+
+def cached_error(candidate):
+    """
+    Same as branch_name_error(), with a LRU cache of the last CACHE_SIZE
+    names.
+    """
+    _cache_lock.acquire()
+    try:
+        if candidate in _cache:
+            error = _cache.pop(candidate)
+            _cache[candidate] = error
+            return error
+    finally:
+        _cache_lock.release()
+
+    error = branch_name_error(candidate)
+
+    _cache_lock.acquire()
+    try:
+        _cache[candidate] = error
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    finally:
+        _cache_lock.release()
+    return error
+
+
+def branch_name_error(candidate):
+    """
+    Returns the reason why the name is invalid, or None. The rules are the
+    ones of git check-ref-format, for "refs/tags/<candidate>".
     """
     if not candidate:
-        raise ValueError("Invalid name: got empty string")
+        return "Invalid name: got empty string"
     if any (item in candidate for item in " \t\n"):
-        raise ValueError("Invalid name: has spaces in it")
-    command = u'git check-ref-format refs/tags/%s' % candidate
-    process = Popen(command.split())
-    status = waitpid(process.pid, 0)[1]
-    if status != 0:
-        raise ValueError("Invalid name, see http://www.kernel.org/"
-            "pub/software/scm/git/docs/git-check-ref-format.html")
+        return "Invalid name: has spaces in it"
+
+    if isinstance(candidate, unicode):
+        candidate = candidate.encode('utf-8')
+
+    if FORBIDDEN_CHARACTERS.intersection(candidate) or ".." in candidate or \
+       "@{" in candidate or candidate.endswith("."):
+        return INVALID_NAME
+
+    for component in candidate.split("/"):
+        if not component or component.startswith(".") or \
+           component.endswith(".lock"):
+            return INVALID_NAME
+
+    return None
@@ -0,0 +1,140 @@
+# write_handle.py
+# Copyright (C) 2011 Julien Miotte <miotte.julien@gmail.com>
+#
+# This module is part of gfbi_core and is released under the GPLv3
+# License: http://www.gnu.org/licenses/gpl-3.0.txt
+
+from threading import Event, Lock
+from Queue import Queue, Empty
+
+from gfbi_core.util import GfbiException
+from gfbi_core.git_filter_rebase import WriteCancelled
+
+
+class WriteHandle:
+    """
+        Follows a write process without polling it: the progress updates are
+        pushed in a queue, and the completion can be waited for or notified
+        through callbacks, as with a future.
+    """
+
+    def __init__(self, process):
+        """
+            Initialization of the WriteHandle. It should be built before the
+            process is started.
+
+            :param process:
+                The git_filter_rebase process.
+        """
+        self._process = process
+        self._updates = Queue()
+        self._done = Event()
+        self._lock = Lock()
+        self._callbacks = []
+
+        process.add_progress_callback(self._updates.put)
+        process.add_done_callback(self._process_done)
+
+    def _process_done(self, process):
+        self._lock.acquire()
+        try:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+
+        self._updates.put(None)
+        for callback in callbacks:
+            callback(self)
+
+    def progress_updates(self, timeout=None):
+        """
+            Yields the progress of the write every time a commit is
+            rewritten, until the write is over.
+
+            :param timeout:
+                If set, raises GfbiException if no update came in timeout
+                seconds.
+        """
+        while True:
+            try:
+                progress = self._updates.get(timeout=timeout)
+            except Empty:
+                raise GfbiException("No progress in %s seconds." % timeout)
+            if progress is None:
+                return
+            yield progress
+
+    def add_done_callback(self, callback):
+        """
+            The callback will be called with the handle when the write is
+            over, from the thread of the process. If it is already over, the
+            callback is called right away.
+        """
+        self._lock.acquire()
+        try:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+            Waits for the end of the write. Returns True if it is over.
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def cancel(self):
+        """
+            Asks the write to stop after the commit being rewritten. The
+            original branch is then checked out again. Returns False if the
+            write is already over.
+        """
+        if self.done():
+            return False
+        self._process.cancel()
+        return True
+
+    def cancelled(self):
+        return self._process.is_cancelled()
+
+    def metrics(self):
+        """
+            Returns the metrics of the write, see WriteMetrics.summary().
+        """
+        return self._process.metrics()
+
+    def exception(self, timeout=None):
+        """
+            Waits for the end of the write and returns the exception that
+            result() would raise, or None.
+        """
+        if not self.wait(timeout):
+            raise GfbiException("The write isn't over.")
+
+        if self._process.is_cancelled():
+            return WriteCancelled("The write was cancelled.")
+        errors = self._process.errors()
+        if errors:
+            return GfbiException("\n".join(errors))
+        return None
+
+    def result(self, timeout=None):
+        """
+            Waits for the end of the write. Returns True if the model was
+            written, and False if the write stopped on a conflict (see
+            EditableGitModel.get_conflicting_commit).
+
+            Raises WriteCancelled if the write was cancelled, GfbiException
+            if it failed.
+        """
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self._process.is_success()
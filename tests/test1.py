@@ -1,10 +1,28 @@
 from subprocess import Popen, PIPE
+from threading import Event, Thread
 from gfbi_core.git_model import GitModel
 from gfbi_core.editable_git_model import EditableGitModel
-from gfbi_core.util import Index, Timezone
+from gfbi_core.util import Index, Timezone, GfbiException, git_dirs, \
+                           refs_stamp, is_dirty, RefsWatcher, \
+                           apply_solutions
+from gfbi_core.git_filter_rebase import WriteCancelled
+from gfbi_core.metrics import WriteMetrics
+from gfbi_core.fast_import import FastImportStream
+from gfbi_core.validation import validate_branch_names
+from benchmarks.synthetic import generate_repository
+from gfbi_core.batch import BatchRunner, Policy
+from gfbi_core.cli import main as cli_main
+from gfbi_core.server import ModelServer, ModelCache, ModelClient, \
+        LocalTransport, UnixSocketTransport, UnixSocketServer, \
+        default_socket_path, is_served, main as server_main
+from StringIO import StringIO
+import json
+from git import Repo
 from git.objects.util import altz_to_utctz_str
 from datetime import datetime
 import os
+import socket
+import sys
 import time
 
 REPOSITORY_NAME = "/tmp/tests_git"
@@ -95,8 +113,8 @@ def commit(message,
 
     run_command(command)
 
-def write_and_wait(model):
-    model.write()
+def write_and_wait(model, **kwargs):
+    model.write(**kwargs)
 
     total_wait = 0
     time.sleep(1)
@@ -209,6 +227,853 @@ def test_cant_apply_changed_repo():
             new_msg == "new input\n" and
             prev_msg == orig_msg), error
 
+def test_metadata_rewrite_keeps_trees():
+    a_model = EditableGitModel(REPOSITORY_NAME)
+    a_model.populate()
+    tree_col = a_model.get_column("tree")
+    orig_trees = [a_model.data(Index(row, tree_col)).hexsha
+                  for row in xrange(a_model.row_count())]
+
+    a_model.start_history_event()
+    a_model.set_data(Index(3, a_model.get_column("author_email")),
+                     "jeanjean@jp.com")
+    write_and_wait(a_model)
+
+    new_model = GitModel(REPOSITORY_NAME)
+    new_model.populate()
+    new_trees = [new_model.data(Index(row, tree_col)).hexsha
+                 for row in xrange(new_model.row_count())]
+    assert orig_trees == new_trees, "The trees changed: %s // %s" % \
+            (orig_trees, new_trees)
+
+def test_engines_are_identical():
+    tips = []
+    for options in ({}, {"fast_import": True}, {"workers": 2}):
+        clone = REPOSITORY_NAME + "_clone"
+        os.chdir(REPOSITORY_NAME)
+        run_command('rm -rf ' + clone)
+        run_command('git clone -q %s %s' % (REPOSITORY_NAME, clone))
+
+        a_model = EditableGitModel(clone)
+        a_model.populate()
+        a_model.start_history_event()
+        a_model.set_data(Index(2, a_model.get_column("message")), "Rewritten")
+        a_model.set_data(Index(4, a_model.get_column("author_name")), "Gromit")
+        write_and_wait(a_model, force_committed_date=True, **options)
+
+        new_model = GitModel(clone)
+        new_model.populate()
+        tips.append(new_model.data(Index(0, 0)))
+
+    assert len(set(tips)) == 1, "The engines wrote different commits: %s" % \
+            tips
+
+def fast_import_model(directory):
+    """
+        Returns a model of a new repository, in which the commits following
+        the deleted one are rewritten by applying their changes.
+    """
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for number, name in enumerate(("a", "b", "c", "a")):
+        run_command('echo "%s" >> %s' % (name, name))
+        run_command('git add %s' % name)
+        date = "Sun Mar 11 12:%02d:00 2012 +0100" % number
+        commit("commit %s" % name, author_date=date, committer_date=date)
+
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    commits = a_model.get_commits()
+    a_model.delete_commits([commits[2]])
+    a_model.set_field_data(commits[3], "message", "Rewritten")
+    return a_model
+
+def test_fast_import_operations():
+    directory = REPOSITORY_NAME + "_fast_import"
+    tips = []
+    for options in ({}, {"fast_import": True}):
+        a_model = fast_import_model(directory)
+        assert a_model.write(log=False, force_committed_date=True,
+                             dont_populate=True, **options).result()
+        phases = a_model.write_metrics()["phases"]
+        if options:
+            assert "cherry-pick" not in phases, "The stream fell back."
+        tips.append(GitModel(directory).get_current_branch().commit.hexsha)
+    assert tips[0] == tips[1], "The engines wrote different commits: %s" % \
+            tips
+    assert not os.path.exists(os.path.join(directory, "b"))
+
+    # The committer date is the date of the write, as with commit-tree
+    start = int(time.time())
+    a_model = fast_import_model(directory)
+    assert a_model.write(log=False, dont_populate=True,
+                         fast_import=True).result()
+    tip = GitModel(directory).get_current_branch().commit
+    assert tip.committed_date >= start, (tip.committed_date, start)
+
+    # An aborted stream leaves the repository untouched
+    stream = FastImportStream(directory)
+    stream.commit({"GIT_AUTHOR_NAME": "Aborted",
+                   "GIT_AUTHOR_EMAIL": "aborted@example.com",
+                   "GIT_AUTHOR_DATE": "1331467200 +0100"}, "Aborted\n",
+                  [tip.hexsha], tree=tip.tree.hexsha)
+    stream.abort()
+    refs = Popen(["git", "show-ref"], cwd=directory,
+                 stdout=PIPE).communicate()[0]
+    assert "gitbuster_rebase" not in refs, refs
+
+def conflicting_model(directory):
+    """
+        Returns a model of a new repository, modified so that the write will
+        conflict on the last commit.
+    """
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for value in xrange(4):
+        run_command('echo "%d" > conflicting_file' % value)
+        run_command('git add conflicting_file')
+        commit("commit %d" % value)
+
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    a_model.start_history_event()
+    commits = a_model.get_commits()
+    # Rewrite commit 1, delete commit 2: commit 3 can't apply on commit 1
+    a_model.set_data(Index(2, a_model.get_column("message")), "rewritten 1")
+    a_model.set_data(Index(2, a_model.get_column("children")), [commits[0]])
+    a_model.remove_rows(1, 1)
+    a_model.set_data(Index(0, a_model.get_column("parents")), [commits[2]])
+    return a_model
+
+def test_resume_after_conflict():
+    directory = REPOSITORY_NAME + "_conflict"
+    a_model = conflicting_model(directory)
+    commits = a_model.get_commits()
+
+    write_and_wait(a_model, dont_populate=True)
+    assert a_model.get_conflicting_commit() == commits[0], \
+            "The write didn't stop on the conflict"
+    assert a_model.get_write_checkpoint() is not None, \
+            "The write didn't store a checkpoint"
+    u_file = a_model.get_unmerged_files()["conflicting_file"]
+    assert u_file["git_status"] == "UU"
+    assert u_file["orig_content"] == "1\n", u_file["orig_content"]
+    assert "+3" in u_file["diff"], u_file["diff"]
+    assert "<<<<<<<" in u_file["unmerged_content"], u_file["unmerged_content"]
+
+    a_model.set_conflict_solutions({"conflicting_file":
+                                    ("add_custom", u"solved\n")})
+    write_and_wait(a_model, dont_populate=True)
+    metrics = a_model.write_metrics()
+    assert metrics["commits"] == 1, \
+            "The write didn't resume from the conflicting commit"
+    # Only the commits left by the checkpoint are counted
+    assert metrics["total"] == 1, metrics
+
+    new_model = GitModel(directory)
+    new_model.populate()
+    messages = [new_model.data(Index(row, new_model.get_column("message")))
+                for row in xrange(new_model.row_count())]
+    assert messages == ["commit 3\n", "rewritten 1", "commit 0\n"], messages
+
+def test_scan_conflicts():
+    directory = REPOSITORY_NAME + "_scan"
+    a_model = conflicting_model(directory)
+    commits = a_model.get_commits()
+
+    conflicts = a_model.scan_conflicts(workers=2)
+    assert conflicts == {commits[0]: {"conflicting_file": "UU"}}, conflicts
+
+    a_model.set_conflict_solutions({"conflicting_file":
+                                    ("add_custom", u"solved\n")},
+                                   commit=commits[0])
+    assert a_model.scan_conflicts() == {}, "The solutions were ignored"
+    write_and_wait(a_model, dont_populate=True)
+    assert a_model.get_conflicting_commit() is None, \
+            "The write stopped on a solved conflict"
+    assert open("conflicting_file").read() == "solved\n"
+
+def test_scan_stacked_conflicts():
+    directory = REPOSITORY_NAME + "_scan_stacked"
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for value in xrange(5):
+        run_command('echo "%d" > conflicting_file' % value)
+        run_command('git add conflicting_file')
+        commit("commit %d" % value)
+
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    commits = a_model.get_commits()
+    # Deleting commit 1 makes commit 2 conflict, solving it with a custom
+    # content makes commit 3 conflict too.
+    a_model.delete_commits([commits[3]])
+    conflicts = a_model.scan_conflicts()
+    assert conflicts == {commits[2]: {"conflicting_file": "UU"}}, conflicts
+
+    a_model.set_conflict_solutions({"conflicting_file":
+                                    ("add_custom", u"solved\n")},
+                                   commit=commits[2])
+    conflicts = a_model.scan_conflicts(workers=2)
+    assert conflicts == {commits[1]: {"conflicting_file": "UU"}}, conflicts
+
+    a_model.set_conflict_solutions({"conflicting_file":
+                                    ("add_custom", u"3\n")},
+                                   commit=commits[1])
+    assert a_model.scan_conflicts() == {}, "The solutions were ignored"
+    write_and_wait(a_model, dont_populate=True)
+    assert a_model.get_conflicting_commit() is None, \
+            "The write stopped on a solved conflict"
+    assert open("conflicting_file").read() == "4\n"
+
+def test_apply_solutions():
+    directory = REPOSITORY_NAME + "_solutions"
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    run_command('echo target > target_file')
+    run_command('ln -s target_file link_file')
+    run_command('echo script > script_file')
+    run_command('chmod +x script_file')
+
+    apply_solutions({"link_file": ("add",), "script_file": ("add",)},
+                    directory)
+    process = Popen("git ls-files -s", shell=True, stdout=PIPE)
+    staged = {}
+    for line in process.communicate()[0].splitlines():
+        mode, hexsha, stage_and_path = line.split(" ", 2)
+        staged[stage_and_path.split("\t")[1]] = (mode, hexsha)
+    link_blob = Popen("printf target_file | git hash-object --stdin",
+                      shell=True, stdout=PIPE).communicate()[0].strip()
+    assert staged["link_file"] == ("120000", link_blob), staged
+    assert staged["script_file"][0] == "100755", staged
+
+    try:
+        apply_solutions({"missing_file": ("add",)}, directory)
+        hash_failed = False
+    except GfbiException:
+        hash_failed = True
+    assert hash_failed, "A file that can't be hashed was solved"
+
+def test_write_metrics():
+    metrics = WriteMetrics(total=4)
+    assert metrics.eta() is None
+    metrics.commit_done()
+    metrics.commit_done()
+    summary = metrics.summary()
+    assert summary["commits"] == 2 and summary["eta"] >= 0, summary
+    metrics.finish()
+    assert metrics.eta() == 0.
+
+    directory = REPOSITORY_NAME + "_metrics"
+    run_command("rm -rf " + directory)
+    generate_repository(directory, commits=5)
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    for _commit in a_model.get_commits()[:3]:
+        a_model.set_field_data(_commit, "author_name", "Metrics")
+    assert a_model.write(log=False, dont_populate=True).result()
+    summary = a_model.write_metrics()
+    assert summary["commits"] == summary["total"] == 3, summary
+    assert summary["eta"] == 0. and summary["elapsed"] > 0, summary
+    assert abs(summary["commits_per_second"] -
+               3 / summary["elapsed"]) < 1e-6, summary
+    phase = summary["phases"]["commit-tree"]
+    assert phase["count"] == 3, summary
+    assert 0 <= phase["p50"] <= phase["p90"] <= phase["max"] <= \
+            phase["total"], phase
+
+    # The metrics survive the refresh of the model after the write
+    a_model.populate()
+    for _commit in a_model.get_commits()[:2]:
+        a_model.set_field_data(_commit, "author_name", "Populated")
+    handle = a_model.write(log=False)
+    assert handle.result(timeout=15)
+    summary = a_model.write_metrics()
+    assert summary is not None and summary["commits"] == 2, summary
+    assert handle.metrics()["commits"] == 2
+    assert a_model.is_write_success()
+    assert a_model.get_commits()[0].author.name == "Populated"
+    run_command("rm -rf " + directory)
+
+    # The fast-import phase is kept when the write falls back on
+    # cherry-picking
+    a_model = conflicting_model(REPOSITORY_NAME + "_metrics_fallback")
+    assert not a_model.write(log=False, dont_populate=True,
+                             fast_import=True).result()
+    phases = a_model.write_metrics()["phases"]
+    # The second attempt is the commit needing a merge
+    assert phases["fast-import"]["count"] == 2, phases
+    assert phases["cherry-pick"]["count"] == 1, phases
+    assert phases["conflict"]["count"] == 1, phases
+
+def test_rewrite_all_refs():
+    directory = REPOSITORY_NAME + "_refs"
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for value in xrange(3):
+        run_command('echo "%d" > file' % value)
+        run_command('git add file')
+        commit("commit %d" % value)
+    run_command('git tag -a -m "annotated" annotated HEAD~1')
+    run_command('git tag lightweight HEAD~1')
+    run_command('git checkout -q -b side HEAD~1')
+    run_command('echo "side" > side_file')
+    run_command('git add side_file')
+    commit("side commit")
+    run_command('git checkout -q master')
+
+    a_model = EditableGitModel(directory, refs=["refs/heads", "refs/tags"])
+    a_model.populate()
+    assert a_model.row_count() == 4, "The side branch wasn't modelized"
+    a_model.start_history_event()
+    a_model.set_data(Index(1, a_model.get_column("author_name")), "Rewritten")
+    write_and_wait(a_model)
+
+    a_repo = Repo(directory)
+    master = a_repo.branches["master"].commit
+    side = a_repo.branches["side"].commit
+    assert master.parents[0] == side.parents[0], \
+            "The shared history was rewritten twice"
+    assert master.parents[0].author.name == "Rewritten"
+    for tag in ("annotated", "lightweight"):
+        assert a_repo.tags[tag].commit == master.parents[0], \
+                "The tag %s wasn't moved" % tag
+    assert a_repo.tags["annotated"].tag.message == "annotated"
+
+def test_write_handle():
+    directory = REPOSITORY_NAME + "_handle"
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for value in xrange(20):
+        run_command('echo "%d" > file' % value)
+        run_command('git add file')
+        commit("commit %d" % value)
+    tip = Repo(directory).head.commit
+
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    a_model.start_history_event()
+    a_model.set_data(Index(19, a_model.get_column("author_name")), "Cancelled")
+
+    # The write waits after its first commit until it is cancelled
+    cancelled = Event()
+    def wait_for_cancel(progress):
+        cancelled.wait(15)
+    handle = a_model.write(dont_populate=True,
+                           progress_callback=wait_for_cancel)
+    assert handle.cancel(), "The write was over before being cancelled"
+    cancelled.set()
+    progress = list(handle.progress_updates(timeout=15))
+    assert len(progress) <= 1, "The write wasn't cancelled"
+    assert handle.cancelled()
+    assert isinstance(handle.exception(), WriteCancelled)
+    a_repo = Repo(directory)
+    assert a_repo.active_branch.name == "master"
+    assert a_repo.head.commit == tip, "The cancelled write moved the branch"
+
+    a_model.set_data(Index(19, a_model.get_column("author_name")), "Written")
+    done = []
+    handle = a_model.write(dont_populate=True)
+    handle.add_done_callback(done.append)
+    progress = list(handle.progress_updates(timeout=15))
+    assert handle.result(timeout=15) is True
+    assert done == [handle], "The done callback wasn't called"
+    assert len(progress) == 20 and round(progress[-1], 6) == 1, progress
+
+def test_incremental_refresh():
+    directory = REPOSITORY_NAME + "_refresh"
+    os.chdir("/tmp")
+    run_command('rm -rf ' + directory)
+    run_command('git init -q ' + directory)
+    os.chdir(directory)
+    for value in xrange(5):
+        run_command('echo "%d" > file_%d' % (value, value))
+        run_command('git add file_%d' % value)
+        commit("commit %d" % value)
+
+    a_model = EditableGitModel(directory)
+    a_model.populate()
+    a_model.start_history_event()
+    commits = a_model.get_commits()
+    a_model.set_data(Index(3, a_model.get_column("message")), "rewritten 1")
+    a_model.set_data(Index(3, a_model.get_column("children")), [commits[1]])
+    a_model.remove_rows(2, 1)
+    a_model.set_data(Index(1, a_model.get_column("parents")), [commits[3]])
+    write_and_wait(a_model)
+
+    new_model = EditableGitModel(directory)
+    new_model.populate()
+    assert a_model.get_commits() == new_model.get_commits(), \
+            "The model wasn't refreshed"
+    for column in ("hexsha", "parents", "children", "message"):
+        for row in xrange(new_model.row_count()):
+            index = Index(row, new_model.get_column(column))
+            assert a_model.data(index) == new_model.data(index), \
+                    "%s differs at row %d" % (column, row)
+
+    commit_map = a_model.get_commit_map()
+    assert commit_map[commits[2].hexsha] is None
+    assert commit_map[commits[3].hexsha] == new_model.get_commits()[2].hexsha
+    a_model.export_commit_map("commit_map")
+    lines = open("commit_map").read().splitlines()
+    assert lines[0] == "old new" and len(lines) == 5, lines
+
+def test_concurrent_writes():
+    models = []
+    for name in ("_first", "_second"):
+        directory = REPOSITORY_NAME + name
+        os.chdir("/tmp")
+        run_command('rm -rf ' + directory)
+        run_command('git init -q ' + directory)
+        os.chdir(directory)
+        for value in xrange(5):
+            run_command('echo "%d" > file' % value)
+            run_command('git add file')
+            commit("commit %d" % value)
+
+        a_model = EditableGitModel(directory)
+        a_model.populate()
+        a_model.start_history_event()
+        a_model.set_data(Index(4, a_model.get_column("message")), "it's" + name)
+        models.append(a_model)
+
+    os.chdir("/tmp")
+    handles = [_model.write() for _model in models]
+    for handle in handles:
+        assert handle.result(timeout=15) is True, handle.exception()
+    assert os.getcwd() == "/tmp", "The write changed the current directory"
+
+    for name in ("_first", "_second"):
+        a_repo = Repo(REPOSITORY_NAME + name)
+        messages = [_commit.message for _commit in a_repo.iter_commits()]
+        assert messages[-1] == "it's" + name, messages
+
+def test_branch_names_conformance():
+    # Every name of up to 3 characters from an alphabet of the characters
+    # the check-ref-format rules care about.
+    alphabet = ["a", ".", "/", "@", "{", "~", "\\", "*", "-", "\xc3\xa9"]
+    names = [""]
+    for length in xrange(3):
+        names += [name + char for name in names if len(name) == length
+                  for char in alphabet]
+    names += ["a.lock", "a.lock/b", "a/b.lock", "a..b", "@", "a@{b",
+              "a/.b", "a/b.", "a.b", "a\x01b", "a\x7fb", "a:b", "a?b",
+              "a[b", "a^b"]
+
+    errors = validate_branch_names(names)
+    for name in names:
+        if not name or " " in name:
+            continue
+        process = Popen(["git", "check-ref-format", "refs/tags/" + name],
+                        stdout=PIPE, stderr=PIPE)
+        process.communicate()
+        assert (process.returncode == 0) == (errors[name] is None), \
+                "%r: git says %d, we say %s" % (name, process.returncode,
+                                                 errors[name])
+
+def test_worktree_refs():
+    worktree = REPOSITORY_NAME + "_worktree"
+    run_command("rm -rf " + worktree)
+    run_command("git -C %s worktree add -q -b worktree_branch %s" %
+                (REPOSITORY_NAME, worktree))
+    try:
+        git_dir, common_dir = git_dirs(worktree)
+        assert common_dir == os.path.join(REPOSITORY_NAME, ".git"), common_dir
+        assert open(os.path.join(git_dir, "HEAD")).read() == \
+                "ref: refs/heads/worktree_branch\n"
+
+        stamp = refs_stamp(common_dir)
+        assert refs_stamp(common_dir) == stamp
+        run_command("git -C %s branch stamp_branch" % worktree)
+        assert refs_stamp(common_dir) != stamp, "A new branch wasn't noticed."
+        stamp = refs_stamp(common_dir)
+        run_command("git -C %s pack-refs --all" % worktree)
+        assert refs_stamp(common_dir) != stamp, "Packing wasn't noticed."
+
+        watcher = RefsWatcher(common_dir)
+        stamp = watcher.stamp()
+        assert watcher.stamp() == stamp == refs_stamp(common_dir)
+        run_command("git -C %s branch nested/stamp_branch" % worktree)
+        assert watcher.stamp() != stamp, "A new directory wasn't noticed."
+        stamp = watcher.stamp()
+        run_command("git -C %s branch -f nested/stamp_branch HEAD~1" %
+                    worktree)
+        assert watcher.stamp() != stamp, "A nested branch move wasn't noticed."
+        assert watcher.stamp() == refs_stamp(common_dir)
+    finally:
+        run_command("git -C %s branch -D stamp_branch nested/stamp_branch" %
+                    REPOSITORY_NAME)
+        run_command("git -C %s worktree remove --force %s" %
+                    (REPOSITORY_NAME, worktree))
+        run_command("git -C %s branch -D worktree_branch" % REPOSITORY_NAME)
+
+def test_dirty_check():
+    os.chdir(REPOSITORY_NAME)
+    assert not is_dirty(REPOSITORY_NAME)
+
+    run_command("echo untracked > untracked_file")
+    assert not is_dirty(REPOSITORY_NAME)
+    assert is_dirty(REPOSITORY_NAME, untracked_files=True)
+
+    run_command("git add untracked_file")
+    assert is_dirty(REPOSITORY_NAME)
+    run_command("git reset -q HEAD untracked_file")
+    run_command("rm untracked_file")
+
+    # Touching a file without changing it doesn't make the tree dirty.
+    run_command("touch init_file")
+    assert not is_dirty(REPOSITORY_NAME)
+    run_command("echo change >> init_file")
+    assert is_dirty(REPOSITORY_NAME)
+
+    a_model = EditableGitModel(REPOSITORY_NAME)
+    a_model.populate()
+    a_model.start_history_event()
+    a_model.set_data(Index(0, a_model.get_column("message")), "dirty write")
+    try:
+        a_model.write()
+        write_failed = False
+    except GfbiException:
+        write_failed = True
+    run_command("git checkout -q init_file")
+    assert write_failed, "The write didn't fail on a dirty working tree"
+
+def test_synthetic_repository():
+    hexshas = []
+    for directory in (REPOSITORY_NAME + "_synthetic_1",
+                      REPOSITORY_NAME + "_synthetic_2"):
+        run_command("rm -rf " + directory)
+        generate_repository(directory, commits=30, width=3, branches=2,
+                            tags=2, conflicts=2)
+        a_model = EditableGitModel(directory)
+        a_model.populate()
+        hexshas.append([commit.hexsha for commit in a_model.get_commits()])
+        merges = [commit for commit in a_model.get_commits()
+                  if len(commit.parents) == 3]
+        run_command("rm -rf " + directory)
+
+    assert len(hexshas[0]) == 30, len(hexshas[0])
+    assert len(merges) == 7, len(merges)
+    assert hexshas[0] == hexshas[1], "The synthetic repository changed."
+
+def test_instrumentation():
+    a_model = EditableGitModel(REPOSITORY_NAME)
+    a_model.populate()
+    commits = a_model.get_commits()
+
+    with a_model.instrumented() as report:
+        for _commit in commits:
+            a_model.c_data(_commit, "message")
+    assert "data" not in a_model.__dict__, "The model is still instrumented."
+    assert report["c_data"]["calls"] == len(commits), report
+    assert report["data"]["calls"] == len(commits), report
+    assert report["row_of"]["calls"] == len(commits), report
+    # The rows are computed once
+    assert report["row_of"]["misses"] == 1, report
+    assert report["c_data"]["time"] >= report["data"]["time"], report
+
+    instrumentation = a_model.enable_instrumentation()
+    a_model.get_to_rewrite_count()
+    a_model.get_to_rewrite_count()
+    report = instrumentation.report()
+    assert report["get_start_write_from"]["hit_rate"] == .5, report
+    a_model.disable_instrumentation()
+    assert a_model.get_instrumentation() is None
+
+def test_memory_footprint():
+    a_model = EditableGitModel(REPOSITORY_NAME)
+    a_model.populate()
+
+    report = a_model.memory_footprint()
+    for category in ("commits", "children", "unpushed", "caches",
+                     "modifications", "history", "orig_model"):
+        assert category in report, report
+    assert report["total"] == sum(value for name, value in report.items()
+                                  if name != "total"), report
+    # The repository objects aren't counted
+    assert report["total"] < 10000 * a_model.row_count(), report
+
+    a_model.start_history_event()
+    a_model.set_data(Index(0, a_model.get_column("message")), "x" * 10000)
+    new_report = a_model.memory_footprint()
+    assert new_report["modifications"] > report["modifications"] + 10000, \
+            new_report
+
+def test_lazy_imports():
+    script = "import sys, warnings\n" \
+             "import gfbi_core.editable_git_model\n" \
+             "print [name for name in ('git', 'pygit2') " \
+             "if name in sys.modules], " \
+             "[item for item in warnings.filters if item[0] == 'always']"
+    process = Popen([sys.executable, "-c", script], stdout=PIPE)
+    output = process.communicate()[0]
+    assert output.strip() == "[] []", output
+
+def test_batch_runner():
+    directories = [REPOSITORY_NAME + "_batch_%d" % number
+                   for number in xrange(3)]
+    for directory in directories:
+        run_command("rm -rf " + directory)
+        generate_repository(directory, commits=5, seed=len(directory))
+    missing = REPOSITORY_NAME + "_batch_missing"
+    run_command("rm -rf " + missing)
+
+    policy = Policy(identities={"author@example.com": ("New Author",
+                                                       "new@example.com")})
+    progress = []
+    runner = BatchRunner(directories + [missing], policy, processes=2)
+    summary = runner.run(progress=lambda result, done, total:
+                                    progress.append((done, total)))
+
+    assert sorted(progress) == [(1, 4), (2, 4), (3, 4), (4, 4)], progress
+    assert summary["written"] == 3 and summary["failed"] == 1, summary
+    results = dict((result["directory"], result)
+                   for result in summary["results"])
+    assert results[missing]["error"], results[missing]
+    for directory in directories:
+        assert results[directory]["modified"] == 5, results[directory]
+        a_model = GitModel(directory)
+        a_model.populate()
+        for _commit in a_model.get_commits():
+            assert _commit.author.email == "new@example.com"
+            assert _commit.author.name == "New Author"
+            assert _commit.committer.email == "committer@example.com"
+
+    # Running the policy again doesn't change anything
+    summary = BatchRunner(directories, policy, processes=2).run()
+    assert summary["unchanged"] == 3, summary
+    for directory in directories:
+        run_command("rm -rf " + directory)
+
+def run_cli(argv, plan):
+    output = StringIO()
+    errors = StringIO()
+    exit_code = cli_main(argv, stdin=StringIO(plan), stdout=output,
+                         stderr=errors)
+    summary = output.getvalue() and json.loads(output.getvalue())
+    return exit_code, summary, errors.getvalue()
+
+def test_cli():
+    directory = REPOSITORY_NAME + "_cli"
+    run_command("rm -rf " + directory)
+    generate_repository(directory, commits=4)
+    a_model = GitModel(directory)
+    a_model.populate()
+    hexshas = [_commit.hexsha for _commit in a_model.get_commits()]
+
+    plan = "\n".join(json.dumps(record) for record in [
+        {"hexsha": hexshas[1], "set": {"author_name": "Plan Author",
+                                       "authored_date": "1331467200 +0200"}},
+        {"hexsha": hexshas[0], "set": {"message": "Planned\n"}}])
+
+    exit_code, summary, errors = run_cli(["-C", directory, "--dry-run", "-"],
+                                         plan)
+    assert exit_code == 0 and summary["status"] == "dry-run", summary
+    assert summary["modified"] == 2 and summary["to_rewrite"] == 2, summary
+    a_model.populate()
+    assert [_commit.hexsha for _commit in a_model.get_commits()] == hexshas
+
+    exit_code, summary, errors = run_cli(["-C", directory, "-"], plan)
+    assert exit_code == 0 and summary["status"] == "written", summary
+    a_model.populate()
+    commits = a_model.get_commits()
+    assert commits[0].message == "Planned\n"
+    assert commits[1].author.name == "Plan Author"
+    assert commits[1].authored_date == 1331467200
+    assert commits[2].hexsha == hexshas[2]
+
+    csv_plan = "hexsha,field,value\n%s,author_email,csv@example.com\n" % \
+            commits[0].hexsha
+    exit_code, summary, errors = run_cli(["-C", directory, "--format", "csv",
+                                          "-"], csv_plan)
+    assert exit_code == 0 and summary["status"] == "written", summary
+    a_model.populate()
+    assert a_model.get_commits()[0].author.email == "csv@example.com"
+
+    exit_code, summary, errors = run_cli(["-C", directory, "-"],
+                                         '{"hexsha": "%s", "set": '
+                                         '{"hexsha": "0"}}' % hexshas[2])
+    assert exit_code == 2 and "Line 1" in errors, errors
+    assert summary["status"] == "error" and summary["line"] == 1, summary
+
+    exit_code, summary, errors = run_cli(["-C", directory,
+                                          directory + "_missing.json"], "")
+    assert exit_code == 2 and summary["status"] == "error", summary
+    assert "IOError" in summary["error"], summary
+
+    run_command("cd %s && echo dirty >> $(git ls-files | head -1)" %
+                directory)
+    plan = json.dumps({"hexsha": a_model.get_commits()[0].hexsha,
+                       "set": {"message": "Dirty\n"}})
+    exit_code, summary, errors = run_cli(["-C", directory, "-"], plan)
+    assert exit_code == 1 and summary["status"] == "error", summary
+    assert "uncommitted changes" in summary["error"], summary
+
+    exit_code, summary, errors = run_cli(["-C", directory + "_missing", "-"],
+                                         plan)
+    assert exit_code == 1 and summary["status"] == "error", summary
+    run_command("rm -rf " + directory)
+
+def test_model_server():
+    directories = [REPOSITORY_NAME + "_server_%d" % number
+                   for number in xrange(2)]
+    for directory in directories:
+        run_command("rm -rf " + directory)
+        generate_repository(directory, commits=6, seed=len(directory))
+    directory = directories[0]
+    server = ModelServer(ModelCache())
+    client = ModelClient(LocalTransport(server))
+
+    info = client.info(directory)
+    assert info["row_count"] == 6 and info["modified"] == 0, info
+    rows = client.rows(directory, start=4, count=10,
+                       columns=["hexsha", "authored_date"])
+    assert len(rows) == 2 and len(rows[0][1]) == 2, rows
+    hexshas = client.column(directory, "hexsha")
+    assert hexshas[4:] == [row[0] for row in rows], hexshas
+    assert client.stats()["populates"] == 1
+
+    stats = client.edit(directory, [{"hexsha": hexshas[1],
+                                     "set": {"author_name": "Served"}}])
+    assert stats["set"] == 1, stats
+    assert client.info(directory)["modified"] == 1
+    assert client.column(directory, "author_name", 1, 1) == ["Served"]
+    try:
+        client.edit(directory, [{"hexsha": "0", "delete": True}])
+        assert False, "Expected an unknown commit error"
+    except GfbiException, error:
+        assert "Record 1" in str(error), error
+
+    assert client.write(directory) == "written"
+    a_model = GitModel(directory)
+    a_model.populate()
+    assert a_model.get_commits()[1].author.name == "Served"
+    # Our own write doesn't invalidate the model
+    assert client.info(directory)["modified"] == 0
+    assert client.stats()["invalidations"] == 0
+
+    run_command("cd %s && git commit -q --allow-empty -m external" %
+                directory)
+    assert client.info(directory)["row_count"] == 7
+    assert client.stats()["invalidations"] == 1
+
+    # The edits that weren't written survive a change of the references, but
+    # can't be written anymore
+    top = client.column(directory, "hexsha", 0, 1)[0]
+    client.edit(directory, [{"hexsha": top, "set": {"message": "Kept\n"}}])
+    run_command("cd %s && git branch unrelated" % directory)
+    assert client.column(directory, "message", 0, 1) == ["Kept\n"]
+    assert client.stats()["models"][0]["stale"]
+    try:
+        client.write(directory)
+        assert False, "Expected a repository changed error"
+    except GfbiException, error:
+        assert "repository changed" in str(error), error
+    assert client.drop(directory)
+    assert client.info(directory)["modified"] == 0
+
+    # A failing request gets an error response
+    try:
+        client.info(directory + "_missing")
+        assert False, "Expected an error for a missing repository"
+    except GfbiException, error:
+        assert "Error" in str(error), error
+    assert client.info(directory)["row_count"] == 7
+
+    # A budget fitting a single model evicts the least recently used one
+    cache = ModelCache(max_bytes=1)
+    client = ModelClient(LocalTransport(ModelServer(cache)))
+    client.info(directories[1])
+    client.info(directory)
+    stats = client.stats()
+    assert stats["evictions"] == 2 and not stats["models"], stats
+    client.edit(directory, [{"branch": "served"}])
+    client.info(directories[1])
+    stats = client.stats()
+    assert [model["directory"] for model in stats["models"]] == \
+            [os.path.realpath(directory)], stats
+    for directory in directories:
+        run_command("rm -rf " + directory)
+
+def test_server_socket():
+    path = REPOSITORY_NAME + "_server.sock"
+    run_command("rm -f " + path)
+    runtime_dir = os.environ.pop("XDG_RUNTIME_DIR", None)
+    assert default_socket_path() == "/tmp/gfbi_core-%d.sock" % os.getuid()
+    os.environ["XDG_RUNTIME_DIR"] = "/run/user/1000"
+    assert default_socket_path() == "/run/user/1000/gfbi_core.sock"
+    if runtime_dir is None:
+        del os.environ["XDG_RUNTIME_DIR"]
+    else:
+        os.environ["XDG_RUNTIME_DIR"] = runtime_dir
+
+    # A socket left by a server that didn't stop cleanly isn't served
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    assert os.path.exists(path) and not is_served(path)
+    os.remove(path)
+
+    server = UnixSocketServer(path, ModelServer(ModelCache()))
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        assert os.stat(path).st_mode & 0777 == 0600, oct(os.stat(path).st_mode)
+        assert is_served(path)
+        transport = UnixSocketTransport(path)
+        assert ModelClient(transport).stats()["populates"] == 0
+        transport.close()
+
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            server_main(["--socket", path])
+            refused = False
+        except SystemExit:
+            refused = True
+        finally:
+            sys.stderr = stderr
+        assert refused, "A second server replaced the running one"
+        assert is_served(path), "The socket of the running server was removed"
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(path)
+
+def test_cli_delete():
+    directory = REPOSITORY_NAME + "_cli_delete"
+    heads = []
+    for options in ([], ["--fast-import"], ["--workers", "2"]):
+        run_command("rm -rf " + directory)
+        generate_repository(directory, commits=4)
+        a_model = GitModel(directory)
+        a_model.populate()
+        commits = a_model.get_commits()
+        messages = [_commit.message for _commit in commits]
+
+        plan = json.dumps({"hexsha": commits[1].hexsha, "delete": True})
+        exit_code, summary, errors = run_cli(["-C", directory, "-"] + options,
+                                             plan)
+        assert exit_code == 0 and summary["status"] == "written", summary
+        a_model.populate()
+        new_messages = [_commit.message for _commit in a_model.get_commits()]
+        assert new_messages == messages[:1] + messages[2:], new_messages
+        heads.append(a_model.get_commits()[0].tree.hexsha)
+    assert len(set(heads)) == 1, heads
+    run_command("rm -rf " + directory)
+
 create_repository()
 populate_repository()
 
@@ -225,5 +1090,53 @@ test_field_has_changed(4, author_name_col, "JeanJean")
 print "Test message"
 message_col = columns.index("message")
 test_field_has_changed(3, message_col, "Boing boing boing")
+print "Test metadata rewrite keeps trees"
+test_metadata_rewrite_keeps_trees()
+print "Test fast-import operations"
+test_fast_import_operations()
+print "Test engines are identical"
+test_engines_are_identical()
+print "Test resume after conflict"
+test_resume_after_conflict()
+print "Test scan conflicts"
+test_scan_conflicts()
+print "Test scan stacked conflicts"
+test_scan_stacked_conflicts()
+print "Test apply solutions"
+test_apply_solutions()
+print "Test write metrics"
+test_write_metrics()
+print "Test rewrite all refs"
+test_rewrite_all_refs()
+print "Test write handle"
+test_write_handle()
+print "Test incremental refresh"
+test_incremental_refresh()
+print "Test concurrent writes"
+test_concurrent_writes()
+print "Test branch names conformance"
+test_branch_names_conformance()
+print "Test worktree refs"
+test_worktree_refs()
+print "Test dirty check"
+test_dirty_check()
+print "Test synthetic repository"
+test_synthetic_repository()
+print "Test instrumentation"
+test_instrumentation()
+print "Test memory footprint"
+test_memory_footprint()
+print "Test lazy imports"
+test_lazy_imports()
+print "Test batch runner"
+test_batch_runner()
+print "Test cli"
+test_cli()
+print "Test cli delete"
+test_cli_delete()
+print "Test model server"
+test_model_server()
+print "Test server socket"
+test_server_socket()
 print "Test can't apply changed"
 test_cant_apply_changed_repo()